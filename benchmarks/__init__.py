@@ -0,0 +1,15 @@
+"""
+检索 / 导入热路径的基准测试
+
+    python -m benchmarks.run search --sizes 10000 100000 1000000 --output results/search.json
+    python -m benchmarks.run encode [--real-model] --output results/encode.json
+    python -m benchmarks.run import --images 2000 --output results/import.json
+    python -m benchmarks.run load --size 100000 --concurrency 1 4 16 --output results/load.json
+    python -m benchmarks.run all --output results/all.json
+
+默认使用 mongomock (pip install mongomock) 在内存中生成数据, 不需要 mongod;
+--mongo-url 指向本地 mongod 时数据写入 clip_search_bench 库, 结束后删除.
+模型默认为 StubEncoder (固定随机投影, 与 CLIPModel 接口一致), --real-model 时加载 config.json 中的 CLIP 模型.
+同一个 --seed 生成的数据完全相同, 结果 JSON 中记录了机器 / 配置 / git commit, 便于前后对比.
+peak RSS 是进程级的单调值, 需要单独比较某个规模的内存时只传一个 --sizes.
+"""
@@ -0,0 +1,41 @@
+import numpy as np
+from PIL import Image
+from utils.logger import logger
+from benchmarks.common import get_bench_model, measure, record
+
+
+def _images(rng, count, size=(640, 480)):
+    return [Image.fromarray(rng.integers(0, 256, (size[1] // 16, size[0] // 16, 3), dtype=np.uint8)).resize(size, Image.BILINEAR)
+            for _ in range(count)]
+
+
+def run(args):
+    """
+    文本 / 图像编码: 单条与 batch, 以及导入流水线使用的像素输入 (已缩放裁剪的 uint8)
+    """
+    rng = np.random.default_rng(args.seed)
+    model = get_bench_model(args.real_model)
+    model_name = getattr(model, "backend", "torch")
+    repeat = args.queries + args.warmup
+    results = []
+
+    texts = [f"a photo of object {i} on a table" for i in range(repeat * args.batch)]
+    results.append(record("encode_text", measure(model.get_text_feature, [(text,) for text in texts[:repeat]]),
+                          model=model_name, batch=1))
+    stats = measure(model.get_text_features, [(texts[i * args.batch:(i + 1) * args.batch],) for i in range(repeat)])
+    stats["items_per_sec"] = round(stats["qps"] * args.batch, 2)
+    results.append(record("encode_text", stats, model=model_name, batch=args.batch))
+
+    images = _images(rng, args.batch)
+    results.append(record("encode_image", measure(model.get_image_feature, [(images[i % len(images)],) for i in range(repeat)]),
+                          model=model_name, batch=1))
+    stats = measure(model.get_image_features, [(images,)] * max(repeat // 4, args.warmup + 1))
+    stats["items_per_sec"] = round(stats["qps"] * len(images), 2)
+    results.append(record("encode_image", stats, model=model_name, batch=len(images)))
+
+    n_px = model.input_resolution
+    pixels = rng.integers(0, 256, (args.batch, n_px, n_px, 3), dtype=np.uint8)
+    stats = measure(model.get_pixel_features, [(pixels,)] * max(repeat // 4, args.warmup + 1))
+    stats["items_per_sec"] = round(stats["qps"] * len(pixels), 2)
+    results.append(record("encode_pixels", stats, model=model_name, batch=len(pixels)))
+    return results
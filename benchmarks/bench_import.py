@@ -0,0 +1,98 @@
+import os
+import time
+import numpy as np
+from PIL import Image
+from config.config import settings
+from utils.logger import logger
+from utils.client import MongoDBClient
+from service.server import SearchServer
+from service.import_pipeline import ImportPipeline
+from benchmarks.common import ID_STRIDE, get_bench_model, make_images, random_unit_vectors, latency_stats, record
+
+
+WORKSPACE_ID = 1
+DATASET_ID = 900
+
+
+def _register_files(ids, paths):
+    """
+    data_workspace_detail 中登记图片路径, dataset_files 中登记 dataset 归属
+    """
+    MongoDBClient("data_workspace_detail").get_collection().insert_many(
+        [{"workspace_id": WORKSPACE_ID, "id": int(id), "file_path": path} for id, path in zip(ids, paths)])
+    MongoDBClient("dataset_files").get_collection().insert_many(
+        [{"dataset_id": DATASET_ID, "workspace_file_id": int(id)} for id in ids])
+
+
+def bench_write(server, rng, count, batch_size):
+    """
+    只测 write_image_features: bulk upsert + feature cache / 索引同步
+    """
+    ids = np.arange(count, dtype=np.int64) + DATASET_ID * ID_STRIDE + ID_STRIDE // 2
+    MongoDBClient("dataset_files").get_collection().insert_many(
+        [{"dataset_id": DATASET_ID, "workspace_file_id": int(id)} for id in ids])
+    samples = []
+    for start in range(0, count, batch_size):
+        batch = ids[start:start + batch_size].tolist()
+        features = random_unit_vectors(rng, len(batch), server.feat_dim)
+        _time_start = time.perf_counter()
+        server.write_image_features(batch, features, [(640, 480)] * len(batch), ["jpg"] * len(batch))
+        samples.append(time.perf_counter() - _time_start)
+    stats = latency_stats(samples)
+    stats["images_per_sec"] = round(count / sum(samples), 2) if samples else 0.0
+    return record("write_image_features", stats, images=count, batch=batch_size)
+
+
+def bench_batch_sync(server, model, paths, batch_size):
+    """
+    逐批用 PIL 打开原图后调用 import_image_batch_sync (接口导入的路径)
+    """
+    ids = np.arange(len(paths), dtype=np.int64) + DATASET_ID * ID_STRIDE + ID_STRIDE // 4
+    samples = []
+    for start in range(0, len(paths), batch_size):
+        _time_start = time.perf_counter()
+        images = [Image.open(os.path.join(settings.root_path, path)) for path in paths[start:start + batch_size]]
+        server.import_image_batch_sync(ids[start:start + batch_size].tolist(), images, model)
+        samples.append(time.perf_counter() - _time_start)
+    stats = latency_stats(samples)
+    stats["images_per_sec"] = round(len(paths) / sum(samples), 2) if samples else 0.0
+    return record("import_image_batch_sync", stats, images=len(paths), batch=batch_size)
+
+
+def bench_pipeline(server, model, paths, args):
+    """
+    workspace 导入流水线端到端: 分页 -> 进程池解码 -> 编码 -> 写入
+    """
+    ids = np.arange(len(paths), dtype=np.int64) + DATASET_ID * ID_STRIDE
+    _register_files(ids, paths)
+    pipeline = ImportPipeline(server, model, batch_size=settings.image_batch_size,
+                              decode_workers=args.decode_workers, queue_size=settings.import_queue_size)
+    pages = []
+    _time_start = time.perf_counter()
+    pipeline.run(WORKSPACE_ID, on_page=lambda checkpoint, counters: pages.append(counters))
+    elapsed = time.perf_counter() - _time_start
+    stats = {
+        "seconds": round(elapsed, 3),
+        "images_per_sec": round(len(paths) / elapsed, 2),
+        "done": sum(counters["done"] for counters in pages),
+        "failed": sum(counters["failed"] for counters in pages),
+        "stages": pipeline.stage_stats(),
+    }
+    return record("import_pipeline", stats, images=len(paths), batch=pipeline.batch_size, decode_workers=pipeline.decode_workers)
+
+
+def run(args):
+    rng = np.random.default_rng(args.seed)
+    model = get_bench_model(args.real_model)
+    server = SearchServer(MongoDBClient(settings.mongodb_collection), model)
+    _time_start = time.time()
+    paths = make_images(settings.root_path, args.images, seed=args.seed)
+    logger.info(f"{len(paths)} benchmark images written in {time.time() - _time_start:.1f}s")
+
+    results = [
+        bench_write(server, rng, args.images, settings.image_batch_size),
+        bench_batch_sync(server, model, paths, settings.image_batch_size),
+        bench_pipeline(server, model, paths, args),
+    ]
+    server.close()
+    return results
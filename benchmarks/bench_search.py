@@ -0,0 +1,97 @@
+import time
+import asyncio
+import numpy as np
+from config.config import settings
+from utils.logger import logger
+from utils.client import MongoDBClient
+from models.model_utils import cosine_similarity, topk, merge_topk
+from service.server import SearchServer
+from service.feature_cache import normalize_rows
+from service.vector_index import get_scorer
+from benchmarks.common import build_dataset, random_unit_vectors, measure, latency_stats, record
+
+
+# 过滤条件: 无过滤 / 选择性低 (约 58% 的行满足, 走全量打分后掩码) / 选择性高 (约 25%, 只对选中的行打分)
+FILTERS = {
+    "none": {},
+    "min_size_1024": {"minimum_width": 1024, "minimum_height": 1024},
+    "extension_png": {"extension_choice": ["png"]},
+}
+
+
+def bench_kernels(size, dim, queries, topn, rng, chunk_size):
+    """
+    mongo 回退路径的打分内核: 单个 chunk 的 cosine_similarity, 全量分数上的 topk 与 merge_topk
+    """
+    results = []
+    chunk = random_unit_vectors(rng, min(size, chunk_size), dim)
+    results.append(record("cosine_similarity", measure(cosine_similarity, [(query, chunk) for query in queries]), size=size,
+                          rows=len(chunk)))
+    scores = rng.standard_normal(size).astype(np.float32)
+    results.append(record("topk", measure(topk, [(scores, topn)] * len(queries)), size=size, topn=topn))
+    ids = np.arange(size)
+
+    def merge(scores):
+        heap = []
+        for start in range(0, size, chunk_size):
+            merge_topk(heap, scores[start:start + chunk_size], ids[start:start + chunk_size], topn)
+        return heap
+    results.append(record("merge_topk", measure(merge, [(scores,)] * len(queries)), size=size, topn=topn, chunk_size=chunk_size))
+    return results
+
+
+def bench_size(args, size, dataset_id, rng):
+    results = []
+    server = SearchServer(MongoDBClient(settings.mongodb_collection), None)
+    _time_start = time.time()
+    build_dataset(server, dataset_id, size, seed=args.seed)
+    results.append(record("build_dataset", {"seconds": round(time.time() - _time_start, 3)}, size=size))
+
+    queries = [query.reshape(1, -1) for query in random_unit_vectors(rng, args.queries + args.warmup, server.feat_dim)]
+    results.extend(bench_kernels(size, server.feat_dim, queries, args.topn, rng, server._MAX_SPLIT_SIZE))
+
+    # 冷加载: mongo / 分片 -> feature cache
+    _time_start = time.perf_counter()
+    dataset = server.feature_cache.get(dataset_id)
+    results.append(record("feature_cache_load", {"seconds": round(time.perf_counter() - _time_start, 3)}, size=size,
+                          resident=dataset is not None, nbytes=dataset.nbytes if dataset is not None else 0))
+    if dataset is None:
+        logger.warning(f"dataset of {size} vectors exceeds feature-cache-mb, resident benchmarks skipped")
+    else:
+        scorer = get_scorer()
+        stats = measure(scorer.search, [(dataset, normalize_rows(query).reshape(-1), args.topn) for query in queries])
+        results.append(record("parallel_scorer", stats, size=size, threads=scorer.threads, topn=args.topn))
+        for filter_name, filter_options in FILTERS.items():
+            stats = measure(server.search_nearest_clip_feature,
+                            [(query, dataset_id, args.topn, filter_options) for query in queries])
+            results.append(record("search_nearest_clip_feature", stats, size=size, filter=filter_name, topn=args.topn, path="resident"))
+
+        batch = np.concatenate(queries[:args.batch])
+        samples = []
+        for _ in range(max(args.queries // args.batch, 1)):
+            _time_start = time.perf_counter()
+            asyncio.run(server.search_nearest_clip_features_async(batch, dataset_id, args.topn))
+            samples.append(time.perf_counter() - _time_start)
+        stats = latency_stats(samples)
+        stats["query_qps"] = round(stats["qps"] * len(batch), 2)
+        results.append(record("search_nearest_clip_features_batch", stats, size=size, batch=len(batch), topn=args.topn))
+
+    # 超出 feature cache 预算时逐块扫描 mongo 的回退路径; 分片 / 共享存储不受 feature cache 预算限制
+    if settings.feature_store == "mongo" and size <= args.scan_max_size:
+        server.feature_cache.max_bytes = 0
+        server.feature_cache.invalidate(dataset_id)
+        scan_queries = queries[:args.warmup + max(args.queries // 10, 3)]
+        stats = measure(server.search_nearest_clip_feature, [(query, dataset_id, args.topn) for query in scan_queries], warmup=1)
+        results.append(record("search_nearest_clip_feature", stats, size=size, filter="none", topn=args.topn, path="mongo_scan"))
+
+    server.mongo_collection.delete_many({"dataset_ids": dataset_id})
+    server.close()
+    return results
+
+
+def run(args):
+    rng = np.random.default_rng(args.seed)
+    results = []
+    for i, size in enumerate(args.sizes):
+        results.extend(bench_size(args, size, i + 1, rng))
+    return results
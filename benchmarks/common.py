@@ -0,0 +1,292 @@
+import os
+import gc
+import sys
+import json
+import time
+import shutil
+import hashlib
+import platform
+import resource
+import subprocess
+import tempfile
+from datetime import datetime
+import numpy as np
+from PIL import Image
+from config.config import settings
+from utils.logger import logger
+
+
+BENCH_DATABASE = "clip_search_bench"
+# 每个 dataset 的 workspace_file_id 从 dataset_id * ID_STRIDE 开始, 不同规模的数据互不重叠
+ID_STRIDE = 10_000_000
+
+_mock_client = None
+
+
+def setup_mongo(mongo_url=None):
+    """
+    mongo_url 为空时把 database.mongodb 中的 MongoClient 换成进程内共享的 mongomock 客户端,
+    否则连接 mongo_url, 数据写入 clip_search_bench 库
+    """
+    global _mock_client
+    settings.mongodb_database = BENCH_DATABASE
+    if mongo_url is not None:
+        settings.mongodb_url = mongo_url
+        return
+    try:
+        import mongomock
+    except ImportError as e:
+        raise ImportError("benchmarks without --mongo-url need mongomock, install it with `pip install mongomock`") from e
+    import database.mongodb
+    if _mock_client is None:
+        _mock_client = mongomock.MongoClient()
+    database.mongodb.MongoClient = lambda *args, **kwargs: _mock_client
+
+
+def use_mock_mongo() -> bool:
+    return _mock_client is not None
+
+
+def drop_bench_database():
+    from utils.client import MongoDBClient
+    MongoDBClient.get_mongodb().client.drop_database(BENCH_DATABASE)
+
+
+def configure(args):
+    """
+    基准测试使用独立的 root_path, 特征文档上冗余 dataset_ids, 不查询 dataset_files
+    """
+    settings.root_path = tempfile.mkdtemp(prefix="clip_search_bench_")
+    settings.dataset_membership = "denormalized"
+    settings.feature_store = args.feature_store
+    settings.feature_quantization = args.quantization
+    settings.index_type = args.index_type
+    settings.feature_cache_mb = args.feature_cache_mb
+    setup_mongo(args.mongo_url)
+    return settings.root_path
+
+
+def cleanup(root_path):
+    shutil.rmtree(root_path, ignore_errors=True)
+    try:
+        drop_bench_database()
+    except Exception as e:
+        logger.error(f"Error dropping benchmark database: {e}")
+
+
+class StubEncoder:
+    """
+    与 CLIPModel 接口一致的假模型, 用于在没有模型权重 / GPU 的机器上测检索与导入路径
+
+    图像特征为 8x8 平均池化后的像素经过固定随机投影, 文本特征由文本的 md5 生成, 结果只取决于输入与 seed.
+    """
+
+    def __init__(self, feat_dim: int, input_resolution: int = 224, seed: int = 0, pool: int = 8):
+        rng = np.random.default_rng(seed)
+        self.feat_dim = feat_dim
+        self.input_resolution = input_resolution
+        self.backend = "stub"
+        self._pool = pool
+        self._projection = rng.standard_normal((pool * pool * 3, feat_dim)).astype(np.float32)
+
+    def get_pixel_features(self, pixels, batch_size=None):
+        from service.feature_cache import normalize_rows
+        pixels = np.asarray(pixels)
+        n, height, width, _ = pixels.shape
+        if n == 0:
+            return np.empty((0, self.feat_dim), dtype=np.float32)
+        pool = self._pool
+        pooled = pixels[:, :height // pool * pool, :width // pool * pool].reshape(
+            n, pool, height // pool, pool, width // pool, 3).mean(axis=(2, 4), dtype=np.float32)
+        return normalize_rows((pooled.reshape(n, -1) / 255.0 - 0.5) @ self._projection)
+
+    def get_image_features(self, images, batch_size=None):
+        from utils.image_decode import resize_center_crop
+        pixels = []
+        image_sizes = []
+        for image in images:
+            try:
+                pixels.append(resize_center_crop(image.convert("RGB"), self.input_resolution))
+                image_sizes.append(image.size)
+            except Exception as e:
+                logger.error(f"Error preprocessing image: {e}")
+                image_sizes.append(None)
+        if not pixels:
+            return np.empty((0, self.feat_dim), dtype=np.float32), image_sizes
+        return self.get_pixel_features(np.stack(pixels)), image_sizes
+
+    def get_image_feature(self, image: Image.Image):
+        feats, image_sizes = self.get_image_features([image])
+        if image_sizes[0] is None:
+            return None, None
+        return feats, image_sizes[0]
+
+    def get_text_features(self, texts):
+        from service.feature_cache import normalize_rows
+        feats = [np.random.default_rng(int(hashlib.md5(text.encode("utf-8")).hexdigest()[:16], 16)).standard_normal(self.feat_dim)
+                 for text in texts]
+        return normalize_rows(np.array(feats, dtype=np.float32).reshape(len(texts), self.feat_dim))
+
+    def get_text_feature(self, text):
+        return self.get_text_features([text])
+
+
+def get_bench_model(real_model: bool = False):
+    if real_model:
+        from models.clip_model import get_model
+        return get_model()
+    from models.model_utils import get_feature_size
+    return StubEncoder(get_feature_size(settings.clip_model))
+
+
+def random_unit_vectors(rng, n, dim):
+    features = rng.standard_normal((n, dim), dtype=np.float32)
+    features /= np.linalg.norm(features, axis=1, keepdims=True)
+    return features
+
+
+def build_dataset(server, dataset_id: int, size: int, seed: int = 0, batch_size: int = 10000):
+    """
+    生成 size 个随机单位向量及宽高 / 类型元数据, 写入 search_datas (feature-store 为 shard 时同时写分片;
+    量化副本只在服务直接读取量化数据时写入). 返回 workspace_file_id 数组
+    """
+    from models.model_utils import quantized_document_fields
+    rng = np.random.default_rng(seed + dataset_id)
+    collection = server.mongo_collection
+    ids = np.arange(size, dtype=np.int64) + dataset_id * ID_STRIDE
+    extensions = np.array(["jpg", "png", "webp", "gif"])
+    created_time = datetime.now()
+    _time_start = time.time()
+    for start in range(0, size, batch_size):
+        end = min(size, start + batch_size)
+        features = random_unit_vectors(rng, end - start, server.feat_dim)
+        widths = rng.integers(64, 4096, end - start)
+        heights = rng.integers(64, 4096, end - start)
+        exts = extensions[rng.integers(0, len(extensions), end - start)]
+        documents = []
+        for row in range(end - start):
+            document = {
+                "workspace_file_id": int(ids[start + row]),
+                "width": int(widths[row]),
+                "height": int(heights[row]),
+                "extension": str(exts[row]),
+                "dataset_ids": [dataset_id],
+                "status": 1,
+                "created_time": created_time,
+                "feature": features[row].tobytes(),
+            }
+            if server.reads_quantized_features:
+                document.update(quantized_document_fields(features[row], settings.feature_quantization))
+            documents.append(document)
+        if server.use_shards:
+            server.shard_store.append(dataset_id, ids[start:end], features, widths, heights, exts.tolist())
+        collection.insert_many(documents, ordered=False)
+    logger.info(f"benchmark dataset {dataset_id}: {size} vectors built in {time.time() - _time_start:.1f}s")
+    gc.collect()
+    return ids
+
+
+def make_images(root_path: str, count: int, seed: int = 0, sizes=((640, 480), (1024, 768), (1920, 1080))):
+    """
+    在 root_path/images 下生成 count 张 JPEG / PNG, 返回相对 root_path 的路径
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(os.path.join(root_path, "images"), exist_ok=True)
+    paths = []
+    for i in range(count):
+        width, height = sizes[i % len(sizes)]
+        # 低频噪声放大到原图尺寸, 压缩率与真实照片接近
+        small = rng.integers(0, 256, (height // 32, width // 32, 3), dtype=np.uint8)
+        image = Image.fromarray(small).resize((width, height), Image.BILINEAR)
+        path = os.path.join("images", f"{i:06d}.{'png' if i % 10 == 0 else 'jpg'}")
+        image.save(os.path.join(root_path, path), quality=90)
+        paths.append(path)
+    return paths
+
+
+def latency_stats(samples, wall_time=None) -> dict:
+    """
+    samples 为每次调用的耗时 (秒); wall_time 为并发执行的总时长, 为空时按串行计算 QPS
+    """
+    samples = np.asarray(samples, dtype=np.float64)
+    if len(samples) == 0:
+        return {"count": 0}
+    wall_time = wall_time if wall_time is not None else float(samples.sum())
+    p50, p95, p99 = np.percentile(samples, [50, 95, 99])
+    return {
+        "count": int(len(samples)),
+        "mean_ms": round(float(samples.mean()) * 1000, 3),
+        "p50_ms": round(float(p50) * 1000, 3),
+        "p95_ms": round(float(p95) * 1000, 3),
+        "p99_ms": round(float(p99) * 1000, 3),
+        "max_ms": round(float(samples.max()) * 1000, 3),
+        "qps": round(len(samples) / wall_time, 2) if wall_time > 0 else 0.0,
+    }
+
+
+def measure(fn, args_list, warmup: int = 3):
+    """
+    依次以 args_list 中的参数调用 fn, 前 warmup 次不计入, 返回 latency_stats
+    """
+    for args in args_list[:warmup]:
+        fn(*args)
+    samples = []
+    for args in args_list[warmup:]:
+        _time_start = time.perf_counter()
+        fn(*args)
+        samples.append(time.perf_counter() - _time_start)
+    return latency_stats(samples)
+
+
+def peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux 上单位为 KB, macOS 上为字节
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def record(name, stats, **params) -> dict:
+    result = {"benchmark": name, **params, **stats, "peak_rss_mb": peak_rss_mb()}
+    logger.info(f"benchmark {result}")
+    return result
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))).stdout.strip()
+    except Exception:
+        return None
+
+
+def environment(args) -> dict:
+    return {
+        "time": datetime.now().isoformat(timespec="seconds"),
+        "git_commit": _git_commit(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "mongo": "mongomock" if use_mock_mongo() else settings.mongodb_url,
+        "args": {k: v for k, v in vars(args).items() if k != "func"},
+        "settings": {
+            "clip_model": settings.clip_model,
+            "feature_store": settings.feature_store,
+            "feature_quantization": settings.feature_quantization,
+            "index_type": settings.index_type,
+            "score_threads": settings.score_threads,
+            "search_workers": settings.search_workers,
+            "rerank_factor": settings.rerank_factor,
+        },
+    }
+
+
+def write_results(path, args, results):
+    report = {"environment": environment(args), "results": results}
+    if path:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False, default=str)
+        logger.info(f"benchmark results written to {path}")
+    else:
+        print(json.dumps(report, indent=2, ensure_ascii=False, default=str))
+    return report
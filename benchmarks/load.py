@@ -0,0 +1,91 @@
+import io
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from PIL import Image
+from config.config import settings
+from utils.logger import logger
+from benchmarks.common import get_bench_model, build_dataset, latency_stats, peak_rss_mb, use_mock_mongo
+
+
+DATASET_ID = 800
+
+
+def _create_app(model):
+    """
+    在 lifespan 启动前放入使用基准测试模型的 AppServices; mongomock 没有 motor 版本, 此时不使用 async collection
+    """
+    import main
+    from service.lifecycle import AppServices
+    services = AppServices(model_factory=lambda: model, async_mongo=not use_mock_mongo())
+    main.app.state.services = services
+    return main.app, services
+
+
+def _jpeg_bytes(rng, size=(640, 480)):
+    image = Image.fromarray(rng.integers(0, 256, (size[1] // 16, size[0] // 16, 3), dtype=np.uint8)).resize(size, Image.BILINEAR)
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=90)
+    return buffer.getvalue()
+
+
+def _requests(args, rng, count):
+    """
+    每个请求的 (method, url, kwargs); 文本各不相同, 不命中 embedding / result cache
+    """
+    requests = []
+    images = [_jpeg_bytes(rng) for _ in range(8)] if args.workload != "text" else []
+    for i in range(count):
+        if args.workload == "text":
+            requests.append(("/search/text", {"json": {"dataset_id": DATASET_ID, "text": f"load query {i} {rng.integers(1 << 30)}", "topn": args.topn}}))
+        elif args.workload == "image":
+            # 图片重复使用, 同一张图片第二次起命中 embedding cache, 只测检索
+            requests.append((f"/search/image/binary?dataset_id={DATASET_ID}&topn={args.topn}",
+                             {"content": images[i % len(images)], "headers": {"content-type": "image/jpeg"}}))
+        else:
+            queries = [{"text": f"load query {i} {j} {rng.integers(1 << 30)}"} for j in range(args.batch)]
+            requests.append(("/search/batch", {"json": {"dataset_id": DATASET_ID, "queries": queries, "topn": args.topn}}))
+    return requests
+
+
+def run(args):
+    """
+    通过 TestClient 对 FastAPI app 并发发请求, 分别统计每个并发度下的延迟分位数 / QPS / 状态码
+    """
+    from fastapi.testclient import TestClient
+    rng = np.random.default_rng(args.seed)
+    model = get_bench_model(args.real_model)
+    app, services = _create_app(model)
+    results = []
+    with TestClient(app) as client:
+        if not services.wait(timeout=600):
+            raise RuntimeError(f"services are {services.status()}: {services.error}")
+        server = services.server
+        build_dataset(server, DATASET_ID, args.size, seed=args.seed)
+        # 第一次请求把 dataset 加载到 feature cache
+        _time_start = time.perf_counter()
+        client.post("/search/text", json={"dataset_id": DATASET_ID, "text": "warmup", "topn": args.topn})
+        results.append({"benchmark": "load_warmup", "size": args.size, "seconds": round(time.perf_counter() - _time_start, 3)})
+
+        for concurrency in args.concurrency:
+            requests = _requests(args, rng, args.requests)
+            status = Counter()
+
+            def call(request):
+                url, kwargs = request
+                _time_start = time.perf_counter()
+                response = client.post(url, **kwargs)
+                status[response.status_code] += 1
+                return time.perf_counter() - _time_start
+
+            _time_start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=concurrency) as pool:
+                samples = list(pool.map(call, requests))
+            stats = latency_stats(samples, wall_time=time.perf_counter() - _time_start)
+            result = {"benchmark": "load", "workload": args.workload, "size": args.size, "concurrency": concurrency,
+                      **stats, "status": {str(code): count for code, count in status.items()}, "peak_rss_mb": peak_rss_mb()}
+            logger.info(f"benchmark {result}")
+            results.append(result)
+        server.mongo_collection.delete_many({"dataset_ids": DATASET_ID})
+    return results
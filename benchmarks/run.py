@@ -0,0 +1,89 @@
+"""
+基准测试入口, 用法见 benchmarks/__init__.py
+"""
+import argparse
+
+
+def _search(args):
+    from benchmarks import bench_search
+    return bench_search.run(args)
+
+
+def _encode(args):
+    from benchmarks import bench_encode
+    return bench_encode.run(args)
+
+
+def _import(args):
+    from benchmarks import bench_import
+    return bench_import.run(args)
+
+
+def _load(args):
+    from benchmarks import load
+    return load.run(args)
+
+
+def _all(args):
+    return _encode(args) + _search(args) + _import(args) + _load(args)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="clip search benchmarks")
+    parser.add_argument("--output", default=None, help="result json path, printed to stdout when omitted")
+    parser.add_argument("--mongo-url", default=None, help="local mongod, e.g. mongodb://127.0.0.1:27017; mongomock when omitted")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--queries", type=int, default=200, help="measured calls per benchmark")
+    parser.add_argument("--warmup", type=int, default=5)
+    parser.add_argument("--topn", type=int, default=20)
+    parser.add_argument("--batch", type=int, default=16, help="queries per batch search / texts and images per encode batch")
+    parser.add_argument("--real-model", action="store_true", help="load the CLIP model from config.json instead of the stub encoder")
+    parser.add_argument("--feature-store", default="mongo", choices=["mongo", "shard", "shared"])
+    parser.add_argument("--quantization", default="none", choices=["none", "float16", "int8"])
+    parser.add_argument("--index-type", default="exact", choices=["exact", "ivf_flat", "hnsw"])
+    parser.add_argument("--feature-cache-mb", type=int, default=4096)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    def add_search_args(p):
+        p.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000])
+        p.add_argument("--scan-max-size", type=int, default=100000, help="largest dataset to benchmark the mongo scan fallback on")
+
+    def add_import_args(p):
+        p.add_argument("--images", type=int, default=1000)
+        p.add_argument("--decode-workers", type=int, default=0, help="0 uses import-decode-workers")
+
+    def add_load_args(p):
+        p.add_argument("--size", type=int, default=100000)
+        p.add_argument("--requests", type=int, default=500, help="requests per concurrency level")
+        p.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16])
+        p.add_argument("--workload", default="text", choices=["text", "image", "batch"])
+
+    search = subparsers.add_parser("search", help="feature cache / scoring / top-k / search_nearest_clip_feature")
+    add_search_args(search)
+    search.set_defaults(func=_search)
+    encode = subparsers.add_parser("encode", help="text / image / pixel encoding")
+    encode.set_defaults(func=_encode)
+    import_parser = subparsers.add_parser("import", help="write_image_features / import_image_batch_sync / import pipeline")
+    add_import_args(import_parser)
+    import_parser.set_defaults(func=_import)
+    load = subparsers.add_parser("load", help="concurrent requests against the FastAPI app")
+    add_load_args(load)
+    load.set_defaults(func=_load)
+    all_parser = subparsers.add_parser("all", help="run every benchmark")
+    add_search_args(all_parser)
+    add_import_args(all_parser)
+    add_load_args(all_parser)
+    all_parser.set_defaults(func=_all)
+
+    args = parser.parse_args()
+    from benchmarks.common import configure, cleanup, write_results
+    root_path = configure(args)
+    try:
+        results = args.func(args)
+    finally:
+        cleanup(root_path)
+    write_results(args.output, args, results)
+
+
+if __name__ == "__main__":
+    main()
@@ -14,6 +14,12 @@ class Settings(BaseSettings):
     # mongodb_url: str = Field(default="http://localhost:27017", alias="mongodb-url")
     mongodb_url: str = Field(default="http://localhost:27017", env=" MONGODB_URL")
 
+    # motor 连接池
+    mongodb_max_pool_size: int = Field(default=100, alias="mongodb-max-pool-size")
+    mongodb_min_pool_size: int = Field(default=10, alias="mongodb-min-pool-size")
+    mongodb_max_idle_time_ms: int = Field(default=60000, alias="mongodb-max-idle-time-ms")
+    mongodb_wait_queue_timeout_ms: int = Field(default=5000, alias="mongodb-wait-queue-timeout-ms")
+
     mongodb_authsource: str = Field(default="admin", alias="mongodb-authsource")
     mongodb_username: str = Field(default=None, alias="mongodb-username")
     mongodb_password: str = Field(default=None, alias="mongodb-password")
@@ -22,11 +28,84 @@ class Settings(BaseSettings):
     # 设备配置
     device: str = Field(default="cpu", alias="device")
     storage_type: str = Field(default="float32", alias="storage-type")
+    # 常驻特征矩阵的量化方式: none / float16 / int8, 量化后用常驻的 float32 特征对 topn * rerank-factor 个候选精排;
+    # rerank-factor 大于 1 时加载读取 float32 特征, 否则只读取量化副本
+    feature_quantization: str = Field(default="none", alias="feature-quantization")
+    rerank_factor: int = Field(default=4, alias="rerank-factor")
+
+    # 检索配置
+    feature_cache_mb: int = Field(default=2048, alias="feature-cache-mb")
+    # 无法常驻的 dataset (超出预算 / 共享存储还没有发布) 在这段时间 (秒) 内不再重复加载
+    feature_cache_negative_ttl: float = Field(default=30.0, alias="feature-cache-negative-ttl")
+    search_workers: int = Field(default=4, alias="search-workers")
+    # 暴力打分的分片线程数, 0 为 CPU 核数; 与 torch 的 intra-op 线程同时繁忙时可适当调小
+    score_threads: int = Field(default=0, alias="score-threads")
+    score_shard_min_rows: int = Field(default=65536, alias="score-shard-min-rows")
+    batch_max_queries: int = Field(default=256, alias="batch-max-queries")
+    # 准入控制: 每类接口同时执行的请求数与排队上限, 排队已满返回 429, 排队超过 admission-queue-timeout-ms 返回 503
+    admission_search_concurrency: int = Field(default=16, alias="admission-search-concurrency")
+    admission_search_queue: int = Field(default=64, alias="admission-search-queue")
+    admission_import_concurrency: int = Field(default=2, alias="admission-import-concurrency")
+    admission_import_queue: int = Field(default=4, alias="admission-import-queue")
+    admission_queue_timeout_ms: int = Field(default=2000, alias="admission-queue-timeout-ms")
+    admission_retry_after: int = Field(default=1, alias="admission-retry-after")
+    # 同时执行的模型 encode / 常驻矩阵打分数; CPU 推理时一次 encode 已经用满 torch 的 intra-op 线程
+    encode_concurrency: int = Field(default=1, alias="encode-concurrency")
+    score_concurrency: int = Field(default=2, alias="score-concurrency")
+    # 在响应头 Server-Timing 中返回各阶段耗时
+    server_timing: bool = Field(default=False, alias="server-timing")
+    # 特征存储: mongo 为 search_datas 中的 BSON, shard 为 root_path/feature_shards 下的 memmap 分片,
+    # shared 为多个 worker 共享 root_path/shared_features 下由 loader 进程物化的只读矩阵
+    feature_store: str = Field(default="mongo", alias="feature-store")
+    shard_rows: int = Field(default=1000000, alias="shard-rows")
+    # shared: loader 检查新写入 / worker 检查新版本的间隔 (秒)
+    shared_store_poll_interval: float = Field(default=1.0, alias="shared-store-poll-interval")
+    # 增量同步其它实例 / 外部任务写入的特征: 轮询间隔 (秒, 0 表示关闭), 回看窗口 (秒), 每页文档数
+    # (需要先执行 python manage.py create-sync-indexes)
+    incremental_sync_interval: float = Field(default=2.0, alias="incremental-sync-interval")
+    incremental_sync_lookback: float = Field(default=5.0, alias="incremental-sync-lookback")
+    incremental_sync_batch_size: int = Field(default=1000, alias="incremental-sync-batch-size")
+    # dataset 归属: lookup 每次查询 dataset_files, denormalized 使用特征文档上的 dataset_ids
+    # (需要先执行 python manage.py backfill-dataset-ids)
+    dataset_membership: str = Field(default="lookup", alias="dataset-membership")
+    # 向量索引: exact / ivf_flat / hnsw
+    index_type: str = Field(default="exact", alias="index-type")
+    index_min_size: int = Field(default=50000, alias="index-min-size")
+    index_save_interval: int = Field(default=1000, alias="index-save-interval")
+    ivf_nlist: int = Field(default=0, alias="ivf-nlist")
+    ivf_nprobe: int = Field(default=16, alias="ivf-nprobe")
+    hnsw_m: int = Field(default=16, alias="hnsw-m")
+    hnsw_ef_construction: int = Field(default=200, alias="hnsw-ef-construction")
+    hnsw_ef: int = Field(default=64, alias="hnsw-ef")
     
     # CLIP 模型配置
     clip_model: str = Field(default="ViT-B/32", alias="clip-model")
     clip_model_download: str = Field(default="./models", alias="clip-model-download")
+    # 推理后端: torch (eager) / torchscript / onnx, 后两者需要先执行 manage.py export-model
+    inference_backend: str = Field(default="torch", alias="inference-backend")
+    onnx_quantized: bool = Field(default=False, alias="onnx-quantized")
+    model_artifacts_dir: str = Field(default="./models/artifacts", alias="model-artifacts-dir")
+    # 0 表示使用 torch / onnxruntime 的默认线程数
+    torch_intra_op_threads: int = Field(default=0, alias="torch-intra-op-threads")
+    torch_inter_op_threads: int = Field(default=0, alias="torch-inter-op-threads")
     import_image_base: str = Field(default="./data", alias="import-image-base")
+    image_batch_size: int = Field(default=32, alias="image-batch-size")
+    # 并发 query 编码合并, encode-batch-max-size 为 1 时关闭
+    encode_batch_max_wait_ms: float = Field(default=5, alias="encode-batch-max-wait-ms")
+    encode_batch_max_size: int = Field(default=16, alias="encode-batch-max-size")
+    # query embedding 缓存, ttl 单位为秒, 0 表示不过期
+    embedding_cache_size: int = Field(default=10000, alias="embedding-cache-size")
+    embedding_cache_ttl: float = Field(default=3600, alias="embedding-cache-ttl")
+    # 检索结果缓存, 通过 dataset 版本号失效
+    result_cache_size: int = Field(default=1000, alias="result-cache-size")
+    result_cache_ttl: float = Field(default=0, alias="result-cache-ttl")
+    import_workers: int = Field(default=2, alias="import-workers")
+    import_page_size: int = Field(default=1000, alias="import-page-size")
+    # 导入流水线: 读取+解码的进程数, 以及各阶段之间队列的容量 (以 batch 计)
+    import_decode_workers: int = Field(default=4, alias="import-decode-workers")
+    import_queue_size: int = Field(default=4, alias="import-queue-size")
+    # 导入任务的租约 (秒): 执行中的 worker 定期续租, 进程退出后其它 worker 在租约过期后接管
+    import_job_lease: float = Field(default=60, alias="import-job-lease")
     
     # OCR 配置
     enable_ocr: bool = Field(default=False, alias="enable-ocr")
@@ -46,6 +46,43 @@ class MongoDB:
     def __aexit__(self, exc_type, exc_val, exc_tb):
         self.close()
 
+
+class AsyncMongoDB:
+    """
+    基于 motor 的 async mongo 客户端, 连接池参数见 config.json 中的 mongodb-*-pool-size
+    """
+    def __init__(self):
+        logger.info(f"AsyncMongoDB init {settings.mongodb_url}")
+        self.mongodb_url = settings.mongodb_url
+        self.client = None
+        self.db = None
+
+    def connect(self):
+        if not self.client:
+            try:
+                self.client = AsyncIOMotorClient(self.mongodb_url,
+                    username=settings.mongodb_username,
+                    password=settings.mongodb_password,
+                    authSource=settings.mongodb_authsource,
+                    read_preference=ReadPreference.PRIMARY,
+                    maxPoolSize=settings.mongodb_max_pool_size,
+                    minPoolSize=settings.mongodb_min_pool_size,
+                    maxIdleTimeMS=settings.mongodb_max_idle_time_ms,
+                    waitQueueTimeoutMS=settings.mongodb_wait_queue_timeout_ms)
+                self.db = self.client[settings.mongodb_database]
+                logger.info("AsyncMongoDB connection established")
+            except Exception as e:
+                logger.error(f"AsyncMongoDB connection error: {e}")
+                raise ConnectionFailure("AsyncMongoDB connection error")
+
+    def close(self):
+        if self.client:
+            self.client.close()
+            self.client = None
+            self.db = None
+            logger.info("AsyncMongoDB connection closed")
+
+
 if __name__ == "__main__":
     mongo = MongoDB()
 
@@ -1,34 +1,33 @@
 from typing import Union, List
 from fastapi.responses import JSONResponse
 from typing import List, Optional
-from fastapi_socketio import SocketManager
 
 from PIL import Image
 import io
 import ast
 from fastapi import FastAPI, HTTPException,Form,WebSocket, WebSocketDisconnect
 from pydantic import BaseModel
-from fastapi import FastAPI, File, UploadFile, HTTPException, Form, APIRouter   
+from fastapi import FastAPI, File, UploadFile, HTTPException, Form, APIRouter, Request
+from fastapi.responses import PlainTextResponse
 from config.config import settings
-from models.clip_model import get_model
-from database.mongodb import MongoDB   
-from service.server import SearchServer
+from service.lifecycle import AppServices
 from routers import search
 from utils.logger import logger
+from utils.metrics import metrics, start_timing, finish_timing, server_timing_header
+import time
 
 #     "mongodb-url": "mongodb://10.112.20.37:9004",
 
 def lifespan(app: FastAPI):
-    app.state.db = MongoDB()
-    # start to load clip model 
-    app.state.model = get_model()
-    logger.info("Model loaded")
-
-    app.state.db.connect() 
+    # 模型 / mongo 连接只在这里创建一次, 后台加载, 不阻塞 /health; 加载并 warmup 完成后 /ready 返回 200
+    # 调用方 (例如 benchmarks) 可以在启动前放入自己的 AppServices
+    services = getattr(app.state, "services", None) or AppServices()
+    app.state.services = services
+    services.start()
 
     yield
     # Shutdown: Close database connections and clean up resources
-    app.state.db.close()
+    services.close()
 
     
 app = FastAPI(
@@ -41,6 +40,32 @@ app = FastAPI(
 app.include_router(search.router, prefix="/search", tags=["search"])
 
 
+@app.middleware("http")
+async def timing_middleware(request: Request, call_next):
+    """
+    记录每个接口的耗时; 开启 server-timing 时把各阶段耗时写入 Server-Timing 响应头
+    """
+    token = start_timing() if settings.server_timing else None
+    _time_start = time.perf_counter()
+    try:
+        response = await call_next(request)
+    finally:
+        elapsed = time.perf_counter() - _time_start
+        timings = finish_timing(token) if token is not None else None
+    route = request.scope.get("route")
+    metrics.observe("clip_search_request_seconds", elapsed, help="request latency by endpoint",
+                    path=getattr(route, "path", "unmatched"), method=request.method)
+    if timings is not None:
+        timings["total"] = elapsed
+        response.headers["Server-Timing"] = server_timing_header(timings)
+    return response
+
+
+@app.get("/metrics", tags=["metrics"])
+def prometheus_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
 @app.get("/", tags=["root"])
 def read_root():
     return {"message": "Welcome to the API"}
@@ -49,6 +74,18 @@ def read_root():
 @app.get("/health", tags=["health"])
 def health_check():
     return {"status": "healthy"}
+
+
+@app.get("/ready", tags=["health"])
+def readiness_check(request: Request):
+    """
+    模型加载并 warmup 完成后返回 200, 之前返回 503 (加载失败时 status 为 failed)
+    """
+    services = request.app.state.services
+    status = services.status()
+    if status != "ready":
+        return JSONResponse({"status": status}, status_code=503, headers={"Retry-After": "5"})
+    return {"status": status}
     
 
 if __name__ == "__main__":
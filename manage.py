@@ -0,0 +1,123 @@
+"""
+运维命令
+
+    python manage.py backfill-dataset-ids
+    python manage.py quantize-features --mode int8 [--drop-float32]
+    python manage.py backfill-extensions
+    python manage.py create-sync-indexes
+    python manage.py export-shards [--dataset-id 1 2 ...]
+    python manage.py compact-shards [--dataset-id 1 2 ...]
+    python manage.py export-model [--backend torchscript onnx] [--no-quantize]
+    python manage.py check-model-parity --backend onnx [--quantized]
+"""
+import argparse
+
+
+def backfill_dataset_ids(args):
+    from service.migrations import backfill_dataset_ids
+    backfill_dataset_ids(batch_size=args.batch_size)
+
+
+def quantize_features(args):
+    from service.migrations import quantize_features
+    quantize_features(args.mode, drop_float32=args.drop_float32, batch_size=args.batch_size)
+
+
+def backfill_extensions(args):
+    from service.migrations import backfill_extensions
+    backfill_extensions(batch_size=args.batch_size)
+
+
+def create_sync_indexes(args):
+    from service.migrations import create_sync_indexes
+    create_sync_indexes()
+
+
+def _shard_server():
+    from config.config import settings
+    from utils.client import MongoDBClient
+    from service.server import SearchServer
+    return SearchServer(MongoDBClient(settings.mongodb_collection), None)
+
+
+def _dataset_ids(args):
+    if args.dataset_id:
+        return args.dataset_id
+    from service import dataset_files_service
+    return dataset_files_service.find_all_dataset_ids()
+
+
+def export_shards(args):
+    server = _shard_server()
+    for dataset_id in _dataset_ids(args):
+        server.export_dataset_shards(dataset_id)
+
+
+def compact_shards(args):
+    server = _shard_server()
+    for dataset_id in _dataset_ids(args):
+        server.shard_store.compact(dataset_id)
+
+
+def export_model(args):
+    from config.config import settings
+    from models.clip_model import export_model
+    export_model(settings, backends=args.backend, quantize=not args.no_quantize)
+
+
+def check_model_parity(args):
+    from config.config import settings
+    from models.clip_model import check_parity
+    report = check_parity(settings, args.backend, quantized=args.quantized, n=args.samples)
+    print(report)
+    if min(item["min_cosine"] for item in report.values()) < args.min_cosine:
+        raise SystemExit(f"parity check failed: min cosine below {args.min_cosine}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="search service management commands")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    backfill = subparsers.add_parser("backfill-dataset-ids", help="denormalize dataset_files membership into feature documents")
+    backfill.add_argument("--batch-size", type=int, default=1000)
+    backfill.set_defaults(func=backfill_dataset_ids)
+
+    quantize = subparsers.add_parser("quantize-features", help="write float16 / int8 copies of existing features")
+    quantize.add_argument("--mode", choices=["float16", "int8"], required=True)
+    quantize.add_argument("--drop-float32", action="store_true", help="remove float32 features, disables exact rerank")
+    quantize.add_argument("--batch-size", type=int, default=1000)
+    quantize.set_defaults(func=quantize_features)
+
+    extensions = subparsers.add_parser("backfill-extensions", help="detect image types from file headers for documents without extension")
+    extensions.add_argument("--batch-size", type=int, default=1000)
+    extensions.set_defaults(func=backfill_extensions)
+
+    sync_indexes = subparsers.add_parser("create-sync-indexes", help="index created_time / updated_time for incremental sync")
+    sync_indexes.set_defaults(func=create_sync_indexes)
+
+    export = subparsers.add_parser("export-shards", help="build memmap feature shards from search_datas")
+    export.add_argument("--dataset-id", type=int, nargs="*")
+    export.set_defaults(func=export_shards)
+
+    compact = subparsers.add_parser("compact-shards", help="merge feature shards and drop deleted rows")
+    compact.add_argument("--dataset-id", type=int, nargs="*")
+    compact.set_defaults(func=compact_shards)
+
+    export_model_parser = subparsers.add_parser("export-model", help="export TorchScript / ONNX encoders from the downloaded CLIP weights")
+    export_model_parser.add_argument("--backend", choices=["torchscript", "onnx"], nargs="+", default=["torchscript", "onnx"])
+    export_model_parser.add_argument("--no-quantize", action="store_true", help="skip the dynamically quantized onnx model")
+    export_model_parser.set_defaults(func=export_model)
+
+    parity = subparsers.add_parser("check-model-parity", help="compare exported encoders with the eager model")
+    parity.add_argument("--backend", choices=["torchscript", "onnx"], required=True)
+    parity.add_argument("--quantized", action="store_true", help="check the dynamically quantized onnx model")
+    parity.add_argument("--samples", type=int, default=8)
+    parity.add_argument("--min-cosine", type=float, default=0.99)
+    parity.set_defaults(func=check_model_parity)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
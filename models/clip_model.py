@@ -1,11 +1,122 @@
+import os
+import json
 import time 
 from functools import lru_cache 
 from utils.logger import logger
 from PIL import Image 
+import numpy as np
 import torch
 import clip 
 
 from config.config import settings
+from models.model_utils import get_feature_size
+
+# CLIP preprocess 中 Normalize 的参数
+_CLIP_MEAN = (0.48145466, 0.4578275, 0.40821073)
+_CLIP_STD = (0.26862954, 0.26130258, 0.27577711)
+
+
+INFERENCE_BACKENDS = ("torch", "torchscript", "onnx")
+
+
+def configure_threads(config):
+    """
+    设置 torch 的 intra-op / inter-op 线程数, 0 表示使用 torch 的默认值
+    """
+    if config.torch_intra_op_threads > 0:
+        torch.set_num_threads(config.torch_intra_op_threads)
+    if config.torch_inter_op_threads > 0:
+        try:
+            torch.set_num_interop_threads(config.torch_inter_op_threads)
+        except RuntimeError as e:
+            # inter-op 线程池启动后不能再修改
+            logger.warning(f"Failed to set inter-op threads: {e}")
+
+
+def artifact_dir(config) -> str:
+    """
+    导出的 TorchScript / ONNX 模型所在目录, 按模型名区分
+    """
+    return os.path.join(config.model_artifacts_dir, config.clip_model.replace("/", "-"))
+
+
+def artifact_paths(config, backend: str, quantized: bool = False) -> dict:
+    root = artifact_dir(config)
+    if backend == "torchscript":
+        return {"image": os.path.join(root, "image.pt"), "text": os.path.join(root, "text.pt")}
+    suffix = ".int8.onnx" if quantized else ".onnx"
+    return {"image": os.path.join(root, "image" + suffix), "text": os.path.join(root, "text" + suffix)}
+
+
+def load_artifact_meta(config) -> dict:
+    path = os.path.join(artifact_dir(config), "meta.json")
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"{path} not found, run `python manage.py export-model` first")
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+class TorchEncoder:
+    """
+    eager PyTorch, 直接使用 clip.load 加载的模型
+    """
+
+    def __init__(self, model, device):
+        self.model = model
+        self.device = device
+
+    def encode_image(self, images: torch.Tensor) -> np.ndarray:
+        with torch.no_grad():
+            return self.model.encode_image(images.to(self.device)).detach().cpu().numpy()
+
+    def encode_text(self, tokens: torch.Tensor) -> np.ndarray:
+        with torch.no_grad():
+            return self.model.encode_text(tokens.to(self.device)).detach().cpu().numpy()
+
+
+class TorchScriptEncoder:
+    """
+    export-model 导出的 trace + freeze 后的 TorchScript 模型, 只支持 cpu
+    """
+
+    def __init__(self, image_path: str, text_path: str):
+        self.image_module = torch.jit.load(image_path, map_location="cpu").eval()
+        self.text_module = torch.jit.load(text_path, map_location="cpu").eval()
+
+    def encode_image(self, images: torch.Tensor) -> np.ndarray:
+        with torch.no_grad():
+            return self.image_module(images.cpu().float()).numpy()
+
+    def encode_text(self, tokens: torch.Tensor) -> np.ndarray:
+        with torch.no_grad():
+            return self.text_module(tokens.cpu().long()).numpy()
+
+
+class OnnxEncoder:
+    """
+    ONNX Runtime 的 CPUExecutionProvider, 可以使用动态量化 (int8 权重) 后的模型
+    """
+
+    def __init__(self, image_path: str, text_path: str, intra_op_threads: int = 0, inter_op_threads: int = 0):
+        try:
+            import onnxruntime as ort
+        except ImportError:
+            raise ImportError("inference-backend onnx requires onnxruntime, please `pip install onnxruntime`")
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if intra_op_threads > 0:
+            options.intra_op_num_threads = intra_op_threads
+        if inter_op_threads > 0:
+            options.inter_op_num_threads = inter_op_threads
+        self.image_session = ort.InferenceSession(image_path, options, providers=["CPUExecutionProvider"])
+        self.text_session = ort.InferenceSession(text_path, options, providers=["CPUExecutionProvider"])
+
+    def encode_image(self, images: torch.Tensor) -> np.ndarray:
+        return self.image_session.run(None, {"image": images.cpu().numpy().astype(np.float32)})[0]
+
+    def encode_text(self, tokens: torch.Tensor) -> np.ndarray:
+        return self.text_session.run(None, {"text": tokens.cpu().numpy().astype(np.int64)})[0]
+
 
 class CLIPModel():
     def __init__(self, config):
@@ -14,7 +125,27 @@ class CLIPModel():
             self.device = 'cpu'
         else:
             self.device = 'cuda' if torch.cuda.is_available() else 'cpu'
-        self.model, self.preprocess = self.get_model()
+        configure_threads(config)
+        self.backend = config.inference_backend
+        if self.backend not in INFERENCE_BACKENDS:
+            raise ValueError(f"Unknown inference backend: {self.backend}")
+        if self.backend == "torch":
+            self.model, self.preprocess = self.get_model()
+            # query 图片解码时 JPEG draft 的目标分辨率
+            self.input_resolution = getattr(self.model.visual, "input_resolution", 224)
+            self.encoder = TorchEncoder(self.model, self.device)
+        else:
+            # 导出的模型只在 cpu 上运行, 不需要加载 eager 权重
+            self.device = 'cpu'
+            self.model = None
+            self.input_resolution = load_artifact_meta(config)["input_resolution"]
+            self.preprocess = clip.clip._transform(self.input_resolution)
+            paths = artifact_paths(config, self.backend, quantized=config.onnx_quantized)
+            if self.backend == "torchscript":
+                self.encoder = TorchScriptEncoder(paths["image"], paths["text"])
+            else:
+                self.encoder = OnnxEncoder(paths["image"], paths["text"], config.torch_intra_op_threads, config.torch_inter_op_threads)
+        logger.info(f"CLIP {config.clip_model} loaded with {self.backend} backend")
 
     def get_model(self):
         args = {}
@@ -32,17 +163,64 @@ class CLIPModel():
             print(e)
             return None, None
         
-        with torch.no_grad():
-            feat = self.model.encode_image(image)
-            feat = feat.detach().cpu().numpy() 
+        feat = self.encoder.encode_image(image)
         return feat, image_size
     
+    def get_image_features(self, images, batch_size=None):
+        """
+        批量提取图像特征
+
+        参数:
+        - images (list[Image.Image]): 图像列表
+        - batch_size (int): 每次 encode_image 的 batch 大小, 默认使用 image-batch-size
+
+        返回:
+        - np.ndarray: (N, D) 特征矩阵, 只包含预处理成功的图像
+        - list: 与 images 对齐的 image.size, 预处理失败的图像为 None
+        """
+        batch_size = batch_size or self.config.image_batch_size
+        image_sizes = []
+        tensors = []
+        for image in images:
+            try:
+                tensors.append(self.preprocess(image))
+                image_sizes.append(image.size)
+            except Exception as e:
+                logger.error(f"Error preprocessing image: {e}")
+                image_sizes.append(None)
+
+        feats = []
+        for start in range(0, len(tensors), batch_size):
+            batch = torch.stack(tensors[start:start + batch_size])
+            feats.append(self.encoder.encode_image(batch))
+        if len(feats) == 0:
+            return np.empty((0, get_feature_size(self.config.clip_model)), dtype=np.float32), image_sizes
+        return np.concatenate(feats, axis=0), image_sizes
+
     def get_text_feature(self, text):
-        text = clip.tokenize([text]).to(self.device)
-        with torch.no_grad():
-            feat = self.model.encode_text(text)
-            feat = feat.detach().cpu().numpy()
-        return feat  
+        return self.get_text_features([text])
+
+    def get_pixel_features(self, pixels, batch_size=None):
+        """
+        对已经缩放 / 裁剪好的 (N, n_px, n_px, 3) uint8 像素提取特征, 只做归一化, 不再经过 preprocess
+        """
+        if len(pixels) == 0:
+            return np.empty((0, get_feature_size(self.config.clip_model)), dtype=np.float32)
+        batch_size = batch_size or self.config.image_batch_size
+        mean = torch.tensor(_CLIP_MEAN, device=self.device).view(1, 3, 1, 1)
+        std = torch.tensor(_CLIP_STD, device=self.device).view(1, 3, 1, 1)
+        feats = []
+        for start in range(0, len(pixels), batch_size):
+            batch = torch.from_numpy(np.ascontiguousarray(pixels[start:start + batch_size])).to(self.device)
+            batch = (batch.permute(0, 3, 1, 2).float() / 255.0 - mean) / std
+            feats.append(self.encoder.encode_image(batch))
+        return np.concatenate(feats, axis=0)
+
+    def get_text_features(self, texts):
+        """
+        批量提取文本特征, 返回 (N, D) 特征矩阵; 超过 context length 的文本截断, 不会让整批失败
+        """
+        return self.encoder.encode_text(clip.tokenize(texts, truncate=True))
     
 
 @lru_cache(maxsize=1)
@@ -55,6 +233,104 @@ def get_model() -> CLIPModel:
     return model
 
 
+class _ImageEncoderModule(torch.nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, image):
+        return self.model.encode_image(image)
+
+
+class _TextEncoderModule(torch.nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, text):
+        return self.model.encode_text(text)
+
+
+def _load_eager_cpu(config):
+    args = {}
+    if config.clip_model_download is not None:
+        args['download_root'] = config.clip_model_download
+    model, _ = clip.load(config.clip_model, device="cpu", jit=False, **args)
+    return model.float().eval()
+
+
+def export_model(config, backends=("torchscript", "onnx"), quantize: bool = True):
+    """
+    用已经下载的权重离线导出 TorchScript / ONNX 模型到 artifact_dir(config)
+
+    quantize 为 True 时额外导出动态量化 (int8 权重) 的 ONNX 模型.
+    """
+    model = _load_eager_cpu(config)
+    input_resolution = model.visual.input_resolution
+    root = artifact_dir(config)
+    os.makedirs(root, exist_ok=True)
+    image_module = _ImageEncoderModule(model).eval()
+    text_module = _TextEncoderModule(model).eval()
+    example_image = torch.randn(2, 3, input_resolution, input_resolution)
+    example_text = clip.tokenize(["a photo of a cat", "a photo of a dog"]).long()
+
+    if "torchscript" in backends:
+        paths = artifact_paths(config, "torchscript")
+        with torch.no_grad():
+            torch.jit.freeze(torch.jit.trace(image_module, example_image)).save(paths["image"])
+            torch.jit.freeze(torch.jit.trace(text_module, example_text)).save(paths["text"])
+        logger.info(f"torchscript model exported to {root}")
+
+    if "onnx" in backends:
+        paths = artifact_paths(config, "onnx")
+        with torch.no_grad():
+            torch.onnx.export(image_module, example_image, paths["image"], input_names=["image"], output_names=["feature"],
+                              dynamic_axes={"image": {0: "batch"}, "feature": {0: "batch"}}, opset_version=14)
+            torch.onnx.export(text_module, example_text, paths["text"], input_names=["text"], output_names=["feature"],
+                              dynamic_axes={"text": {0: "batch"}, "feature": {0: "batch"}}, opset_version=14)
+        logger.info(f"onnx model exported to {root}")
+        if quantize:
+            from onnxruntime.quantization import quantize_dynamic, QuantType
+            quantized_paths = artifact_paths(config, "onnx", quantized=True)
+            for name in ("image", "text"):
+                quantize_dynamic(paths[name], quantized_paths[name], weight_type=QuantType.QInt8)
+            logger.info(f"dynamically quantized onnx model exported to {root}")
+
+    with open(os.path.join(root, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump({"clip_model": config.clip_model, "input_resolution": input_resolution}, f)
+
+
+def check_parity(config, backend: str, quantized: bool = False, n: int = 8, seed: int = 0) -> dict:
+    """
+    比较导出模型与 eager 模型的特征, 返回图像 / 文本特征余弦相似度的最小值与平均值
+    """
+    model = _load_eager_cpu(config)
+    eager = TorchEncoder(model, "cpu")
+    paths = artifact_paths(config, backend, quantized=quantized)
+    if backend == "torchscript":
+        exported = TorchScriptEncoder(paths["image"], paths["text"])
+    else:
+        exported = OnnxEncoder(paths["image"], paths["text"], config.torch_intra_op_threads, config.torch_inter_op_threads)
+
+    generator = torch.Generator().manual_seed(seed)
+    input_resolution = model.visual.input_resolution
+    images = torch.rand(n, 3, input_resolution, input_resolution, generator=generator)
+    images = (images - torch.tensor(_CLIP_MEAN).view(1, 3, 1, 1)) / torch.tensor(_CLIP_STD).view(1, 3, 1, 1)
+    texts = clip.tokenize([f"a photo of object number {i}" for i in range(n)]).long()
+
+    def cosine(a, b):
+        a = a / np.linalg.norm(a, axis=1, keepdims=True)
+        b = b / np.linalg.norm(b, axis=1, keepdims=True)
+        return np.sum(a * b, axis=1)
+
+    report = {}
+    for name, inputs, encode in (("image", images, "encode_image"), ("text", texts, "encode_text")):
+        sim = cosine(getattr(eager, encode)(inputs).astype(np.float32), getattr(exported, encode)(inputs).astype(np.float32))
+        report[name] = {"min_cosine": float(sim.min()), "mean_cosine": float(sim.mean())}
+    logger.info(f"{backend}{' int8' if quantized else ''} parity against eager model: {report}")
+    return report
+
+
 if __name__ == "__main__":
     model = get_model() 
     print(model.config)
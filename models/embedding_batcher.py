@@ -0,0 +1,125 @@
+import time
+import queue
+import threading
+from concurrent.futures import Future
+import numpy as np
+from utils.logger import logger
+from utils.metrics import metrics
+
+
+class EmbeddingBatcher:
+    """
+    合并并发的 query 编码请求
+
+    各线程提交的 text / image query 先进入队列, 后台线程最多等待 max_wait_ms
+    或凑满 max_batch_size 个请求后, 对同类 query 做一次批量 encode_text /
+    encode_image, 再把每一行结果交还给对应的调用方. 传入 slots (PrioritySlots) 时
+    每次批量编码以交互优先级占用一个 encode slot.
+    """
+
+    TEXT = "text"
+    IMAGE = "image"
+
+    def __init__(self, model, max_wait_ms: float = 5, max_batch_size: int = 16, slots=None):
+        self.model = model
+        self.slots = slots
+        self.max_wait = max_wait_ms / 1000.0
+        self.max_batch_size = max(int(max_batch_size), 1)
+        self._queue = queue.Queue()
+        self._closed = False
+        self._worker = threading.Thread(target=self._run, name="embedding-batcher", daemon=True)
+        self._worker.start()
+
+    def submit(self, kind: str, payload) -> Future:
+        if self._closed:
+            raise RuntimeError("EmbeddingBatcher is closed")
+        future = Future()
+        self._queue.put((kind, payload, future))
+        return future
+
+    def encode_text(self, text: str) -> np.ndarray:
+        return self.submit(self.TEXT, text).result()
+
+    def encode_image(self, image) -> np.ndarray:
+        return self.submit(self.IMAGE, image).result()
+
+    def close(self):
+        self._closed = True
+        self._queue.put(None)
+        self._worker.join()
+
+    def _collect(self):
+        item = self._queue.get()
+        if item is None:
+            return None
+        batch = [item]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is None:
+                # close() 之后先处理完已经收集到的请求
+                self._queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            if batch is None:
+                return
+            texts = [(payload, future) for kind, payload, future in batch if kind == self.TEXT]
+            images = [(payload, future) for kind, payload, future in batch if kind == self.IMAGE]
+            if texts:
+                metrics.observe("clip_search_batch_size", len(texts), help="number of items per batch", kind="encode_text")
+                self._encode(texts, self._encode_texts)
+            if images:
+                metrics.observe("clip_search_batch_size", len(images), help="number of items per batch", kind="encode_image")
+                self._encode(images, self._encode_images)
+
+    def _encode_batch(self, payloads, encode_fn):
+        if self.slots is not None:
+            with self.slots.slot():
+                return encode_fn(payloads)
+        return encode_fn(payloads)
+
+    def _encode(self, items, encode_fn):
+        try:
+            results = self._encode_batch([payload for payload, _ in items], encode_fn)
+        except Exception as e:
+            if len(items) == 1:
+                logger.error(f"Error encoding query: {e}")
+                items[0][1].set_exception(e)
+                return
+            # 逐个重新编码, 只让出错的请求失败, 同一批中的其它请求不受影响
+            logger.warning(f"Error encoding query batch of {len(items)}, retrying one by one: {e}")
+            for item in items:
+                self._encode([item], encode_fn)
+            return
+        for (_, future), result in zip(items, results):
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    def _encode_texts(self, texts):
+        feats = self.model.get_text_features(texts)
+        return [feats[i:i + 1] for i in range(len(texts))]
+
+    def _encode_images(self, images):
+        feats, image_sizes = self.model.get_image_features(images)
+        results = []
+        row = 0
+        for image_size in image_sizes:
+            if image_size is None:
+                results.append(ValueError("Invalid image"))
+            else:
+                results.append(feats[row:row + 1])
+                row += 1
+        return results
@@ -1,11 +1,12 @@
 import os
 import json
 import hashlib
+import heapq
 from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 from utils.logger import logger
 import pymongo
 from pymongo.collection import Collection
-import clip
 import numpy as np 
 
 def get_feature_size(model_name):
@@ -19,24 +20,174 @@ def get_feature_size(model_name):
 
 
 def cosine_similarity(query_feature, feature_list):
-    logger.info(f"query_feature: {query_feature.shape}, feature_list: {feature_list.shape}")
-    query_feature = query_feature / np.linalg.norm(query_feature, axis=1, keepdims=True)
+    """
+    query_feature 需要调用方预先归一化, 这里只归一化 feature_list
+    """
+    logger.debug(f"query_feature: {query_feature.shape}, feature_list: {feature_list.shape}")
     feature_list = feature_list / np.linalg.norm(feature_list, axis=1, keepdims=True)
     sim_score = (query_feature @ feature_list.T)
 
     return sim_score[0]
 
 
-def get_file_type(image_path):
-    libmagic_output = os.popen("file '" + image_path + "'").read().strip()
-    libmagic_output = libmagic_output.split(":", 1)[1]
-    if "PNG" in libmagic_output:
+def topk(scores, k):
+    """
+    返回 scores 中最大的 k 个下标 (按分数降序), argpartition 选取为 O(N)
+    """
+    k = min(int(k), len(scores))
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    if k < len(scores):
+        idx = np.argpartition(scores, len(scores) - k)[len(scores) - k:]
+    else:
+        idx = np.arange(len(scores))
+    return idx[np.argsort(scores[idx])[::-1]]
+
+
+def merge_topk(heap, scores, ids, k):
+    """
+    把一个 chunk 的候选合并到大小不超过 k 的最小堆 heap 中, 元素为 (score, id)
+    """
+    for idx in topk(scores, k):
+        item = (float(scores[idx]), ids[idx])
+        if len(heap) < k:
+            heapq.heappush(heap, item)
+        elif item > heap[0]:
+            heapq.heapreplace(heap, item)
+    return heap
+
+
+QUANTIZATION_DTYPES = {
+    "none": np.float32,
+    "float16": np.float16,
+    "int8": np.int8,
+}
+
+
+def quantize(features, mode):
+    """
+    按行量化已经归一化的特征, 返回 (data, scales)
+
+    int8 为逐行缩放: x ≈ data * scale, scale = max|x| / 127; 其它模式 scales 为 None
+    """
+    features = np.asarray(features, dtype=np.float32)
+    if mode == "int8":
+        scales = np.abs(features).max(axis=-1) / 127.0
+        scales[scales == 0] = 1.0
+        data = np.round(features / scales[..., None]).astype(np.int8)
+        return data, scales.astype(np.float32)
+    return features.astype(QUANTIZATION_DTYPES[mode]), None
+
+
+def dequantize(data, scales=None):
+    features = np.asarray(data).astype(np.float32)
+    if scales is not None:
+        features *= np.asarray(scales, dtype=np.float32)[..., None]
+    return features
+
+
+def quantized_dot(data, scales, query, chunk_size=8192):
+    """
+    量化矩阵与 float32 query 的内积
+
+    query 为 (D,) 时返回 (N,), 为 (D, Q) 时一次矩阵乘返回 (N, Q).
+    float16 / int8 没有 BLAS 实现, 按 chunk 转成 float32 后再做矩阵乘,
+    内存带宽只按量化后的大小读取一次.
+    """
+    if data.dtype == np.float32:
+        return data @ query
+    sim_score = np.empty((len(data),) + query.shape[1:], dtype=np.float32)
+    for start in range(0, len(data), chunk_size):
+        sim_score[start:start + chunk_size] = data[start:start + chunk_size].astype(np.float32) @ query
+    if scales is not None:
+        sim_score *= scales.reshape((-1,) + (1,) * (query.ndim - 1))
+    return sim_score
+
+
+def quantized_document_fields(feature, mode):
+    """
+    特征文档中量化数据的字段: feature_q / feature_scale / feature_quantization
+    """
+    feature = np.asarray(feature, dtype=np.float32).reshape(-1)
+    feature = feature / max(float(np.linalg.norm(feature)), 1e-12)
+    data, scale = quantize(feature, mode)
+    fields = {"feature_q": data.tobytes(), "feature_quantization": mode}
+    if scale is not None:
+        fields["feature_scale"] = float(scale)
+    return fields
+
+
+# 常驻 extension 列的编码 (uint8), 0 表示未知
+EXTENSIONS = ("", "png", "jpg", "gif", "bmp", "webp", "tiff")
+_EXTENSION_CODES = {extension: code for code, extension in enumerate(EXTENSIONS)}
+_EXTENSION_ALIASES = {"jpeg": "jpg", "tif": "tiff"}
+_PIL_FORMATS = {"PNG": "png", "JPEG": "jpg", "MPO": "jpg", "GIF": "gif", "BMP": "bmp", "WEBP": "webp", "TIFF": "tiff"}
+
+
+def normalize_extension(extension):
+    """
+    "JPEG" / ".jpeg" / "jpg" 统一为 "jpg"
+    """
+    if not extension:
+        return None
+    extension = str(extension).lower().lstrip(".")
+    return _EXTENSION_ALIASES.get(extension, extension)
+
+
+def extension_code(extension) -> int:
+    return _EXTENSION_CODES.get(normalize_extension(extension), 0)
+
+
+def image_extension(image):
+    """
+    PIL 打开图片时已经解析了文件头, 直接由 image.format 得到扩展名
+    """
+    return _PIL_FORMATS.get(getattr(image, "format", None))
+
+
+# 文件头的 magic bytes, 只需要读取前 12 个字节
+_MAGIC_HEADER_SIZE = 12
+
+
+def detect_image_type(header: bytes):
+    """
+    根据文件头识别图片类型, 返回 EXTENSIONS 中的扩展名, 无法识别时返回 None
+    """
+    if header.startswith(b"\x89PNG\r\n\x1a\n"):
         return "png"
-    if "JPEG" in libmagic_output:
+    if header.startswith(b"\xff\xd8\xff"):
         return "jpg"
-    if "GIF" in libmagic_output:
+    if header[:6] in (b"GIF87a", b"GIF89a"):
         return "gif"
-    if "PC bitmap" in libmagic_output:
+    if header.startswith(b"BM"):
         return "bmp"
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+        return "webp"
+    if header[:4] in (b"II*\x00", b"MM\x00*"):
+        return "tiff"
     return None
 
+
+def get_file_type(image_path):
+    """
+    读取文件头识别图片类型, 文件无法读取或类型未知时返回 None
+    """
+    try:
+        with open(image_path, "rb") as f:
+            return detect_image_type(f.read(_MAGIC_HEADER_SIZE))
+    except OSError as e:
+        logger.error(f"Error reading file header {image_path}: {e}")
+        return None
+
+
+def get_file_types(image_paths, max_workers: int = 0):
+    """
+    批量识别图片类型, 返回与 image_paths 对齐的列表
+
+    每个文件只读取文件头; max_workers > 1 时在线程池中并发读取, 适合网络文件系统.
+    """
+    if max_workers > 1 and len(image_paths) > 1:
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            return list(pool.map(get_file_type, image_paths))
+    return [get_file_type(image_path) for image_path in image_paths]
+
@@ -1,4 +1,4 @@
-from fastapi import FastAPI, HTTPException,Form,APIRouter,UploadFile, File
+from fastapi import FastAPI, HTTPException,Form,APIRouter,UploadFile, File, Request, Query, Depends
 from fastapi.responses import JSONResponse  
 from database.mongodb import MongoDB
 from config.config import settings
@@ -6,23 +6,60 @@ from pydantic import BaseModel
 from PIL import Image
 from utils.logger import logger
 from service.server import SearchServer
-from models.clip_model import get_model
+from service.import_jobs import ImportJobManager
+from models.model_utils import detect_image_type
 from typing import Union, List
 from service.data_workspace_detail_service import find
-from utils.utils import base64_to_image,generate_base64_list_image_data
+from utils.utils import base64_to_image,generate_base64_list_image_data,decode_base64,bytes_to_image
 import ast
 import asyncio
 import os
-from utils.client import MongoDBClient
+from utils.metrics import span
+from utils.admission import admission, Overloaded
 from concurrent.futures import ThreadPoolExecutor
 
 import io 
 
 
 router = APIRouter() 
-collection = MongoDBClient(settings.mongodb_collection)
-model = get_model()
-server = SearchServer(collection, model)
+
+
+def get_services(request: Request):
+    """
+    lifespan 创建的 AppServices; 模型还在加载 / warmup 时返回 503
+    """
+    services = request.app.state.services
+    if not services.ready.is_set():
+        raise HTTPException(status_code=503, detail=f"service is {services.status()}", headers={"Retry-After": "5"})
+    return services
+
+
+def get_server(request: Request) -> SearchServer:
+    return get_services(request).server
+
+
+def get_import_jobs(request: Request) -> ImportJobManager:
+    return get_services(request).import_jobs
+
+
+def admit(name: str):
+    """
+    准入控制依赖: 同类接口的执行数已满时排队, 排队已满返回 429, 排队超时返回 503, 都带 Retry-After
+    """
+    async def dependency():
+        gate = admission.gate(name)
+        try:
+            await gate.acquire()
+        except Overloaded as e:
+            logger.warning(str(e))
+            status_code = 429 if e.reason == "queue_full" else 503
+            raise HTTPException(status_code=status_code, detail=str(e),
+                                headers={"Retry-After": str(settings.admission_retry_after)})
+        try:
+            yield
+        finally:
+            gate.release()
+    return dependency
 
 
 class SearchImageRequest(BaseModel):
@@ -32,6 +69,9 @@ class SearchImageRequest(BaseModel):
     minimum_width: int = 0
     minimum_height: int = 0
     extension_choice: Union[List[str], None] = None
+    # 近似索引的召回/延迟参数, 为空时使用 config.json 中的默认值
+    nprobe: Union[int, None] = None
+    ef: Union[int, None] = None
 
 
 class SearchTextRequest(BaseModel):
@@ -41,6 +81,8 @@ class SearchTextRequest(BaseModel):
     minimum_width: int = 0
     minimum_height: int = 0
     extension_choice: Union[List[str], None] = None
+    nprobe: Union[int, None] = None
+    ef: Union[int, None] = None
     
 class ImportResponse(BaseModel):
     success: bool
@@ -48,14 +90,40 @@ class ImportResponse(BaseModel):
     score: List[float]
 
 
+class BatchQuery(BaseModel):
+    text: Union[str, None] = None
+    base64_str: Union[str, None] = None
+
+
+class SearchBatchRequest(BaseModel):
+    dataset_id: int
+    queries: List[BatchQuery]
+    topn: int = 10
+    minimum_width: int = 0
+    minimum_height: int = 0
+    extension_choice: Union[List[str], None] = None
+    nprobe: Union[int, None] = None
+    ef: Union[int, None] = None
+
+
+class BatchItemResponse(ImportResponse):
+    # success 为 False 时说明该 query 失败的原因
+    error: Union[str, None] = None
+
+
+class SearchBatchResponse(BaseModel):
+    success: bool
+    results: List[BatchItemResponse]
+
+
 class UploadImageRequest(BaseModel):
     base64_str: str
     workspace_file_id: int
 
 
 
-@router.post("/image")
-def search_image(request: SearchImageRequest):
+@router.post("/image", dependencies=[Depends(admit("search"))])
+async def search_image(request: SearchImageRequest, server: SearchServer = Depends(get_server)):
     """
     Search for images based on the image
 
@@ -65,6 +133,8 @@ def search_image(request: SearchImageRequest):
     minimum_width: int: The minimum width of the image
     minimum_height: int: The minimum height of the image
     extension_choice: list of str: The list of extensions to search for 
+    nprobe: int: ivf_flat index only, number of inverted lists to scan
+    ef: int: hnsw index only, size of the dynamic candidate list
 
     return:
     success: bool: True if the search was successful
@@ -76,8 +146,12 @@ def search_image(request: SearchImageRequest):
     try:
         if request.base64_str is None:
             raise HTTPException(status_code=400, detail="Path is required")
-        image = base64_to_image(request.base64_str)
-        file_path_list, score_list = server.search_image(image,  request.dataset_id,topn=request.topn, minimum_width=request.minimum_width, minimum_height=request.minimum_height, extension_choice=request.extension_choice)
+        # base64 / md5 / 图片解码都不在 event loop 上执行, 命中缓存时不解码图片
+        with span("decode"):
+            image_data = await asyncio.get_running_loop().run_in_executor(server.executor, decode_base64, request.base64_str)
+        if image_data is None:
+            raise ValueError("Invalid base64 image")
+        file_path_list, score_list = await server.search_image_async(image_data,  request.dataset_id,topn=request.topn, minimum_width=request.minimum_width, minimum_height=request.minimum_height, extension_choice=request.extension_choice, search_params={"nprobe": request.nprobe, "ef": request.ef})
         # base64_str_list = generate_base64_list_image_data(file_path_list)
         return ImportResponse(success=True,data=file_path_list,score=score_list )
     except Exception as e:
@@ -87,40 +161,96 @@ def search_image(request: SearchImageRequest):
 
 
 
-@router.post("/import/{workspace_id}")
-async def upload_data(workspace_id: int):
+async def _read_image_bytes(request: Request) -> bytes:
+    """
+    读取二进制上传的图片: multipart/form-data 取 file 字段, 其它 Content-Type 直接使用请求体
+    """
+    if request.headers.get("content-type", "").startswith("multipart/form-data"):
+        form = await request.form()
+        upload = form.get("file")
+        if upload is None or isinstance(upload, str):
+            raise HTTPException(status_code=400, detail="file is required")
+        image_data = await upload.read()
+    else:
+        image_data = await request.body()
+    if len(image_data) == 0:
+        raise HTTPException(status_code=400, detail="image is required")
+    return image_data
+
+
+@router.post("/image/binary", dependencies=[Depends(admit("search"))])
+async def search_image_binary(request: Request, dataset_id: int, topn: int = 10, minimum_width: int = 0, minimum_height: int = 0,
+                              extension_choice: Union[List[str], None] = Query(default=None),
+                              nprobe: Union[int, None] = None, ef: Union[int, None] = None,
+                              server: SearchServer = Depends(get_server)):
+    """
+    Search for images based on the image, the image is sent as raw bytes or as the
+    `file` field of a multipart form instead of base64 JSON
+
+    args: same as /image, passed as query parameters
+
+    return: same as /image
+    """
+    image_data = await _read_image_bytes(request)
+    try:
+        file_path_list, score_list = await server.search_image_async(image_data, dataset_id, topn=topn, minimum_width=minimum_width, minimum_height=minimum_height, extension_choice=extension_choice, search_params={"nprobe": nprobe, "ef": ef})
+        return ImportResponse(success=True,data=file_path_list,score=score_list )
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.post("/import/{workspace_id}", dependencies=[Depends(admit("import"))])
+def upload_data(workspace_id: int, import_jobs: ImportJobManager = Depends(get_import_jobs)):
     """
-    import data from workspace to database
+    import data from workspace to database in a background job
+    images which already have a feature are skipped, an unfinished job of
+    the same workspace is resumed from its checkpoint
     args:
 
     workspace_id: 
 
     return:
-    success: bool: True if the data was uploaded successfully
-    data: list of str: The list of inserted_id of the images
+    success: bool: True if the job was submitted successfully
+    job: dict: status of the import job, see /import/jobs/{job_id}
     """
     workspace_id = workspace_id
     if workspace_id is None:
         raise HTTPException(status_code=400, detail="Workspace ID is required") 
     try:
-        id_list, file_path_list = find(workspace_id)
-        results = await server.import_image_dir(id_list, file_path_list, model, copy=False)
-        return results
+        job = import_jobs.submit(workspace_id)
+        return {"success": True, "job": job}
                 
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.get("/import/jobs/{job_id}")
+def import_job_status(job_id: str, import_jobs: ImportJobManager = Depends(get_import_jobs)):
+    """
+    status of an import job
+
+    return:
+    status: str: pending / running / done / failed
+    total, processed, done, skipped, failed: int: image counters
+    images_per_sec: float: import throughput of the current run
+    eta: float: estimated seconds left
+    """
+    job = import_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
     
 
 
-@router.post("/text")
-def search_text_by_id(request: SearchTextRequest):
+@router.post("/text", dependencies=[Depends(admit("search"))])
+async def search_text_by_id(request: SearchTextRequest, server: SearchServer = Depends(get_server)):
     """
     Search for images based on the text
 
     """
     try:
         logger.info(f"search_text_by_id: {request.dataset_id}")
-        file_path_list, score_list =  server.search_image(request.text, request.dataset_id, topn=request.topn, minimum_width=request.minimum_width, minimum_height=request.minimum_height, extension_choice=request.extension_choice)
+        file_path_list, score_list = await server.search_image_async(request.text, request.dataset_id, topn=request.topn, minimum_width=request.minimum_width, minimum_height=request.minimum_height, extension_choice=request.extension_choice, search_params={"nprobe": request.nprobe, "ef": request.ef})
         return ImportResponse(success=True,data=file_path_list,score=score_list )
 
     except Exception as e:
@@ -128,17 +258,102 @@ def search_text_by_id(request: SearchTextRequest):
 
 
 
-@router.post("/upload")
-def upload_single_image(request: UploadImageRequest):
+@router.post("/batch", dependencies=[Depends(admit("search"))])
+async def search_batch(request: SearchBatchRequest, server: SearchServer = Depends(get_server)):
+    """
+    Search for images based on a list of text and/or image queries against one dataset
+
+    the queries are encoded in one batch and scored with a single
+    matrix-matrix product, instead of one dataset scan per query
+
+    args:
+    queries: list of {text} or {base64_str}
+    dataset_id, topn, minimum_width, minimum_height, extension_choice, nprobe, ef: shared by all queries
+
+    return:
+    success: bool: True if the search was successful
+    results: list of {success, data, score, error}, aligned with queries;
+        success is False and error is set for a query which is empty or could not be
+        decoded or encoded, the other queries are still searched
+    """
+    if len(request.queries) == 0:
+        raise HTTPException(status_code=400, detail="queries is required")
+    if len(request.queries) > settings.batch_max_queries:
+        raise HTTPException(status_code=400, detail=f"at most {settings.batch_max_queries} queries per batch")
+    try:
+        # 图片在 search_batch_async 中按 md5 查缓存, 未命中的才在线程池中解码
+        with span("decode"):
+            image_data_list = await asyncio.get_running_loop().run_in_executor(
+                server.executor, lambda: [decode_base64(query.base64_str) if query.text is None and query.base64_str is not None else None
+                                          for query in request.queries])
+        queries = []
+        errors = []
+        for query, image_data in zip(request.queries, image_data_list):
+            # 每个 query 单独校验, 出错的 query 记下原因后跳过, 不影响同一批中的其它 query
+            if query.text is not None:
+                queries.append(query.text if query.text.strip() else None)
+                errors.append("query could not be encoded" if query.text.strip() else "text is empty")
+            elif query.base64_str is not None:
+                queries.append(image_data)
+                errors.append("invalid image" if image_data is not None else "invalid base64 image")
+            else:
+                queries.append(None)
+                errors.append("text or base64_str is required")
+        results = await server.search_batch_async(queries, request.dataset_id, topn=request.topn, minimum_width=request.minimum_width, minimum_height=request.minimum_height, extension_choice=request.extension_choice, search_params={"nprobe": request.nprobe, "ef": request.ef})
+        return SearchBatchResponse(success=True, results=[
+            BatchItemResponse(success=True, data=result[0], score=result[1]) if result is not None
+            else BatchItemResponse(success=False, data=[], score=[], error=error)
+            for result, error in zip(results, errors)
+        ])
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.post("/upload", dependencies=[Depends(admit("import"))])
+def upload_single_image(request: UploadImageRequest, server: SearchServer = Depends(get_server)):
     """
     Upload a single image to the database
 
     """
     try:        
-        image = base64_to_image(request.base64_str)
-        result = server.import_image_dir_sync(request.workspace_file_id, image, model, copy=False)
+        image_data = decode_base64(request.base64_str)
+        if image_data is None:
+            raise HTTPException(status_code=400, detail="Invalid base64 image")
+        image = bytes_to_image(image_data)
+        result = server.import_image_dir_sync(request.workspace_file_id, image, server.model, copy=False, extension=detect_image_type(image_data[:12]))
+        if result is None:
+            raise HTTPException(status_code=500, detail="Error uploading image")
+        return {"success": True}
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.post("/upload/binary", dependencies=[Depends(admit("import"))])
+async def upload_single_image_binary(request: Request, workspace_file_id: int, server: SearchServer = Depends(get_server)):
+    """
+    Upload a single image to the database, the image is sent as raw bytes or as
+    the `file` field of a multipart form instead of base64 JSON
+
+    """
+    image_data = await _read_image_bytes(request)
+    try:
+        image = bytes_to_image(image_data)
+        result = await asyncio.get_running_loop().run_in_executor(
+            server.executor, lambda: server.import_image_dir_sync(workspace_file_id, image, server.model, copy=False, extension=detect_image_type(image_data[:12])))
         if result is None:
             raise HTTPException(status_code=500, detail="Error uploading image")
         return {"success": True}
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.get("/cache")
+def cache_stats(server: SearchServer = Depends(get_server)):
+    """
+    hit/miss statistics of the query embedding cache and search result cache
+    """
+    return {"embedding": server.embedding_cache.stats(), "result": server.result_cache.stats()}
@@ -26,8 +26,45 @@ def find(workspace_id: int):
     except Exception as e:
         logger.error(f"Error finding image_list: {e}")
         return None
-    
 
-    
-        
-        
\ No newline at end of file
+
+def count(workspace_id: int):
+    """
+    count images of workspace_id
+
+    """
+    try:
+        collection = data_workspace_detail.get_collection()
+        return collection.count_documents({"workspace_id": int(workspace_id)})
+    except Exception as e:
+        logger.error(f"Error counting image_list: {e}")
+        return None
+
+
+def find_page(workspace_id: int, after_id=None, limit: int = 1000):
+    """
+    按 _id 顺序分页读取 workspace 的图片, after_id 为上一页最后一条的 _id
+
+    返回 (_id, id, file_path) 列表
+    """
+    collection = data_workspace_detail.get_collection()
+    query = {}
+    query["workspace_id"] = int(workspace_id)
+    if after_id is not None:
+        query["_id"] = {"$gt": after_id}
+    cursor = collection.find(query, {"id": 1, "file_path": 1}).sort("_id", 1).limit(limit)
+    return [(doc["_id"], doc["id"], doc["file_path"]) for doc in cursor]
+
+
+def find_path_map(id_list: list):
+    """
+    id (workspace_file_id) 到 file_path 的映射
+
+    """
+    try:
+        collection = data_workspace_detail.get_collection()
+        cursor = collection.find({"id": {"$in": id_list}}, {"id": 1, "file_path": 1})
+        return {doc["id"]: doc["file_path"] for doc in cursor}
+    except Exception as e:
+        logger.error(f"Error finding file_path: {e}")
+        return None
@@ -1,10 +1,13 @@
 from database.mongodb import MongoDB
 from config.config import settings
 from utils.logger import logger
-from utils.client import MongoDBClient
+from utils.client import MongoDBClient, AsyncMongoDBClient
 
 
 data_workspace_detail = MongoDBClient("dataset_files")
+async_dataset_files = AsyncMongoDBClient("dataset_files")
+# status 为 1 或缺失的归属关系有效, 其它值表示已经移出 dataset (与增量同步的判断一致)
+ACTIVE_STATUS = [1, None]
 
 def find(dataset_id: int):
     """
@@ -15,6 +18,7 @@ def find(dataset_id: int):
         collection = data_workspace_detail.get_collection()
         query = {}
         query["dataset_id"] = int(dataset_id)
+        query["status"] = {"$in": ACTIVE_STATUS}
         cursor = collection.find(query)
         id_list = []
         for doc in cursor:
@@ -41,4 +45,77 @@ def find_path_list(workspace_file_id_list: list):
         logger.error(f"Error finding file_path_list: {e}")
         return None
 
-        
\ No newline at end of file
+
+def find_dataset_membership(workspace_file_id_list: list):
+    """
+    find dataset_id list of each workspace_file_id
+
+    返回 {workspace_file_id: [dataset_id, ...]}, 不属于任何 dataset 的 id 不出现在结果中
+    """
+    try:
+        collection = data_workspace_detail.get_collection()
+        query = {}
+        query["workspace_file_id"] = {"$in": workspace_file_id_list}
+        query["status"] = {"$in": ACTIVE_STATUS}
+        cursor = collection.find(query, {"workspace_file_id": 1, "dataset_id": 1})
+        membership = {}
+        for doc in cursor:
+            membership.setdefault(doc["workspace_file_id"], []).append(doc["dataset_id"])
+        return membership
+    except Exception as e:
+        logger.error(f"Error finding dataset_id list: {e}")
+        return None
+
+
+def iter_dataset_membership():
+    """
+    遍历全部有效的 dataset_files, 按 workspace_file_id 聚合出 (workspace_file_id, [dataset_id, ...])
+    """
+    collection = data_workspace_detail.get_collection()
+    pipeline = [{"$match": {"status": {"$in": ACTIVE_STATUS}}},
+                {"$group": {"_id": "$workspace_file_id", "dataset_ids": {"$addToSet": "$dataset_id"}}}]
+    for doc in collection.aggregate(pipeline, allowDiskUse=True):
+        yield doc["_id"], doc["dataset_ids"]
+
+
+async def find_async(dataset_id: int):
+    """
+    find 的 async 版本
+
+    """
+    try:
+        collection = async_dataset_files.get_collection()
+        query = {}
+        query["dataset_id"] = int(dataset_id)
+        query["status"] = {"$in": ACTIVE_STATUS}
+        cursor = collection.find(query, {"workspace_file_id": 1})
+        return [doc["workspace_file_id"] async for doc in cursor]
+
+    except Exception as e:
+        logger.error(f"Error finding image_list: {e}")
+        return None
+
+
+async def find_path_list_async(workspace_file_id_list: list):
+    """
+    find_path_list 的 async 版本
+
+    """
+    try:
+        collection = async_dataset_files.get_collection()
+        query = {}
+        query["workspace_file_id"] = {"$in": workspace_file_id_list}
+        cursor = collection.find(query, {"file_path": 1})
+        return [doc["file_path"] async for doc in cursor]
+    except Exception as e:
+        logger.error(f"Error finding file_path_list: {e}")
+        return None
+
+
+def find_all_dataset_ids():
+    """
+    find all dataset_id
+
+    """
+    collection = data_workspace_detail.get_collection()
+    return collection.distinct("dataset_id", {"status": {"$in": ACTIVE_STATUS}})
@@ -0,0 +1,475 @@
+import time
+import asyncio
+import tempfile
+import threading
+from collections import OrderedDict
+import numpy as np
+from utils.logger import logger
+from models.model_utils import QUANTIZATION_DTYPES, quantize, dequantize, quantized_dot, extension_code
+
+
+def normalize_rows(features: np.ndarray) -> np.ndarray:
+    """
+    按行做 L2 归一化, 全零行保持为 0
+    """
+    features = np.asarray(features, dtype=np.float32)
+    norm = np.linalg.norm(features, axis=-1, keepdims=True)
+    norm[norm == 0] = 1.0
+    return features / norm
+
+
+class DatasetFeatures:
+    """
+    单个 dataset 的常驻特征矩阵
+
+    features 是连续的、已经归一化的矩阵 (按 quantization 存为 float32 / float16 /
+    逐行缩放的 int8), 第 i 行对应 ids[i] / widths[i] / heights[i] / extensions[i]. 宽高为 uint16,
+    extension 为 EXTENSIONS 中的 uint8 编码, 过滤条件直接在这些列上生成掩码. members 为 dataset_files 中该 dataset
+    的 workspace_file_id 集合, None 表示不限制 (与 search_nearest_clip_feature
+    在 dataset 为空时扫描整个集合的行为一致). 被删除的行只记为墓碑, 检索时由 get_mask 过滤,
+    行号不变, 重新加载 dataset 后才真正去掉.
+
+    量化时传入 exact_dir 会同时保存归一化后的 float32 特征用于精排, 存放在 exact_dir 下一个已经
+    unlink 的临时文件中 (np.memmap), 只占用 page cache, 不计入 feature cache 的内存预算.
+    """
+
+    def __init__(self, dataset_id, feat_dim: int, members=None, capacity: int = 0, quantization: str = "none", exact_dir=None):
+        self.dataset_id = dataset_id
+        self.feat_dim = feat_dim
+        self.members = set(members) if members is not None else None
+        self.quantization = quantization
+        # 共享特征存储发布的版本号, 其它来源为 None
+        self.version = None
+        # 开始从 mongo / 分片加载的时间, 增量同步从这里补上加载期间写入的变更
+        self.loaded_at = None
+        capacity = max(int(capacity), 16)
+        self._features = np.empty((capacity, feat_dim), dtype=QUANTIZATION_DTYPES[quantization])
+        self._scales = np.empty(capacity, dtype=np.float32) if quantization == "int8" else None
+        self._ids = np.empty(capacity, dtype=np.int64)
+        self._widths = np.empty(capacity, dtype=np.uint16)
+        self._heights = np.empty(capacity, dtype=np.uint16)
+        self._extensions = np.empty(capacity, dtype=np.uint8)
+        self._exact_file = None
+        self._exact = None
+        if exact_dir is not None and quantization != "none":
+            self._exact_file = tempfile.TemporaryFile(dir=exact_dir)
+            self._exact = self._map_exact(capacity)
+        self._rows = {}
+        self._size = 0
+        self._tombstones = set()
+        self._alive = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_arrays(cls, dataset_id, features, ids, widths, heights, extensions=None, scales=None, members=None, quantization="none", exact=None):
+        """
+        直接使用已有的数组 (例如 np.memmap) 作为存储, 不复制数据; 之后追加新行时才会复制到内存.
+        exact 为精排用的 float32 特征, 没有时量化的 dataset 不做精排
+        """
+        dataset = cls(dataset_id, features.shape[1], members=members, capacity=0, quantization=quantization)
+        dataset._features = features
+        dataset._scales = scales
+        dataset._ids = ids
+        dataset._widths = widths
+        dataset._heights = heights
+        dataset._extensions = extensions if extensions is not None else np.zeros(len(ids), dtype=np.uint8)
+        dataset._exact = exact if quantization != "none" else None
+        dataset._size = len(ids)
+        # 行号映射在第一次写入 / 查找时才建立, 只读检索 (例如多个 worker 共享的矩阵) 不需要
+        dataset._rows = None
+        if dataset.members is not None:
+            dataset.members.update(ids.tolist())
+        return dataset
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def features(self) -> np.ndarray:
+        """
+        原始存储的特征矩阵, quantization 不为 none 时是量化后的数据
+        """
+        return self._features[:self._size]
+
+    def _map_exact(self, capacity):
+        self._exact_file.truncate(capacity * self.feat_dim * np.dtype(np.float32).itemsize)
+        return np.memmap(self._exact_file, dtype=np.float32, mode="r+", shape=(capacity, self.feat_dim))
+
+    @property
+    def has_exact(self) -> bool:
+        """
+        是否有 float32 特征可以精排
+        """
+        return self.quantization == "none" or self._exact is not None
+
+    @property
+    def exact(self):
+        return self._exact[:self._size] if self._exact is not None else None
+
+    def exact_vectors(self, rows) -> np.ndarray:
+        """
+        指定行的 float32 特征, 没有时返回 None
+        """
+        if self.quantization == "none":
+            return self.features[rows]
+        if self._exact is None:
+            return None
+        return np.asarray(self._exact[rows])
+
+    @property
+    def scales(self):
+        return self._scales[:self._size] if self._scales is not None else None
+
+    def vectors(self, rows=None) -> np.ndarray:
+        """
+        反量化为 float32 向量, rows 为空时返回全部行
+        """
+        if self.quantization == "none":
+            return self.features if rows is None else self.features[rows]
+        scales = self.scales
+        if rows is None:
+            return dequantize(self.features, scales)
+        return dequantize(self.features[rows], scales[rows] if scales is not None else None)
+
+    def score(self, query, rows=None) -> np.ndarray:
+        """
+        query 与指定行 (默认全部行) 的内积, 直接在量化矩阵上计算; query 为 (D, Q) 时返回 (N, Q)
+        """
+        features, scales = self.features, self.scales
+        if rows is not None:
+            features = features[rows]
+            scales = scales[rows] if scales is not None else None
+        return quantized_dot(features, scales, query)
+
+    @property
+    def ids(self) -> np.ndarray:
+        return self._ids[:self._size]
+
+    @property
+    def widths(self) -> np.ndarray:
+        return self._widths[:self._size]
+
+    @property
+    def heights(self) -> np.ndarray:
+        return self._heights[:self._size]
+
+    @property
+    def extensions(self) -> np.ndarray:
+        return self._extensions[:self._size]
+
+    @property
+    def tombstones(self) -> int:
+        return len(self._tombstones)
+
+    @property
+    def nbytes(self) -> int:
+        """
+        占用的内存; memmap 的特征矩阵在 page cache 中, 不计入 feature cache 预算
+        """
+        features_nbytes = 0 if getattr(self._features, "_mmap", None) is not None else self._features.nbytes
+        return (features_nbytes + self._ids.nbytes
+                + self._widths.nbytes + self._heights.nbytes + self._extensions.nbytes
+                + (self._scales.nbytes if self._scales is not None else 0))
+
+    def _row_map(self) -> dict:
+        if self._rows is None:
+            with self._lock:
+                if self._rows is None:
+                    self._rows = dict(zip(self.ids.tolist(), range(self._size)))
+        return self._rows
+
+    def row_of(self, workspace_file_id):
+        return self._row_map().get(workspace_file_id)
+
+    def rows_of(self, workspace_file_ids) -> np.ndarray:
+        """
+        workspace_file_id 列表映射为行号, 不在矩阵中的记为 -1
+        """
+        rows = self._row_map()
+        return np.fromiter((rows.get(int(i), -1) for i in workspace_file_ids), dtype=np.int64, count=len(workspace_file_ids))
+
+    def accepts(self, workspace_file_id, dataset_ids=None) -> bool:
+        """
+        新写入的特征是否属于该 dataset, dataset_ids 为特征文档上的 dataset_ids 字段
+        """
+        if self.members is None:
+            return True
+        if dataset_ids is not None:
+            return self.dataset_id in dataset_ids
+        return workspace_file_id in self.members
+
+    def _grow(self):
+        # from_arrays 打开的空 dataset (例如所有行都已删除的分片) 容量为 0
+        capacity = max(self._features.shape[0] * 2, 16)
+        # 重新分配而不是原地 resize, 正在检索的线程持有的旧视图仍然有效
+        for name in ("_features", "_scales", "_ids", "_widths", "_heights", "_extensions", "_exact"):
+            old = getattr(self, name)
+            if old is None:
+                continue
+            if name == "_exact" and self._exact_file is not None:
+                # 文件只增长, 旧的 memmap 仍然有效
+                self._exact = self._map_exact(capacity)
+                continue
+            new = np.empty((capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:self._size] = old[:self._size]
+            setattr(self, name, new)
+
+    def upsert(self, workspace_file_id, feature, width, height, extension=None):
+        """
+        写入一行特征, workspace_file_id 已存在时覆盖原来的行
+        """
+        vector = normalize_rows(np.asarray(feature, dtype=np.float32).reshape(-1))
+        feature, scale = quantize(vector, self.quantization)
+        rows = self._row_map()
+        with self._lock:
+            row = rows.get(workspace_file_id)
+            append = row is None
+            if append:
+                if self._size >= self._features.shape[0]:
+                    self._grow()
+                row = self._size
+            self._features[row] = feature
+            if self._scales is not None:
+                self._scales[row] = scale
+            if self._exact is not None:
+                self._exact[row] = vector
+            self._ids[row] = workspace_file_id
+            self._widths[row] = min(int(width or 0), 65535)
+            self._heights[row] = min(int(height or 0), 65535)
+            self._extensions[row] = extension_code(extension)
+            if append:
+                # 整行写完后才计入 _size, 并发检索读到的行都是完整的
+                rows[workspace_file_id] = row
+                self._size += 1
+                if self.members is not None:
+                    self.members.add(workspace_file_id)
+            if row in self._tombstones:
+                self._tombstones.discard(row)
+                self._alive = None
+
+    def append_rows(self, source: "DatasetFeatures", rows):
+        """
+        按行号从 source (相同 quantization) 复制已经归一化 / 量化的行, 不重新量化;
+        有 float32 特征时 source 也必须有 (has_exact)
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        ids = source.ids[rows]
+        row_map = self._row_map()
+        with self._lock:
+            while self._size + len(rows) > self._features.shape[0]:
+                self._grow()
+            start, end = self._size, self._size + len(rows)
+            self._features[start:end] = source.features[rows]
+            if self._scales is not None:
+                self._scales[start:end] = source.scales[rows]
+            if self._exact is not None:
+                self._exact[start:end] = source.exact_vectors(rows)
+            self._ids[start:end] = ids
+            self._widths[start:end] = source.widths[rows]
+            self._heights[start:end] = source.heights[rows]
+            self._extensions[start:end] = source.extensions[rows]
+            row_map.update(zip(ids.tolist(), range(start, end)))
+            if self.members is not None:
+                self.members.update(ids.tolist())
+            self._size = end
+
+    def delete(self, workspace_file_id, remove_member: bool = False) -> bool:
+        """
+        把 workspace_file_id 所在的行记为墓碑, 再次 upsert 时恢复; remove_member 时同时移出 members
+        """
+        row = self.row_of(workspace_file_id)
+        with self._lock:
+            if remove_member and self.members is not None:
+                self.members.discard(workspace_file_id)
+            if row is None or row in self._tombstones:
+                return False
+            self._tombstones.add(row)
+            self._alive = None
+        return True
+
+    def _alive_mask(self):
+        """
+        没有墓碑时返回 None, 否则返回未删除行的掩码 (墓碑变化前复用)
+        """
+        with self._lock:
+            if not self._tombstones:
+                return None
+            if self._alive is None or len(self._alive) != self._size:
+                alive = np.ones(self._size, dtype=bool)
+                alive[np.fromiter(self._tombstones, dtype=np.int64, count=len(self._tombstones))] = False
+                self._alive = alive
+            return self._alive
+
+    def get_mask(self, search_filter_options: dict):
+        """
+        根据 minimum_width / minimum_height / extension_choice 与墓碑生成行过滤掩码, 都没有时返回 None
+        """
+        mask = None
+        minimum_width = search_filter_options.get("minimum_width")
+        minimum_height = search_filter_options.get("minimum_height")
+        extension_choice = search_filter_options.get("extension_choice")
+        if minimum_width:
+            mask = self.widths >= min(int(minimum_width), 65535)
+        if minimum_height:
+            height_mask = self.heights >= min(int(minimum_height), 65535)
+            mask = height_mask if mask is None else mask & height_mask
+        if extension_choice:
+            codes = [code for code in {extension_code(extension) for extension in extension_choice} if code > 0]
+            extension_mask = np.isin(self.extensions, np.asarray(codes, dtype=np.uint8))
+            mask = extension_mask if mask is None else mask & extension_mask
+        alive = self._alive_mask()
+        if alive is not None:
+            # 两次读取之间可能有新追加的行, 按较短的长度对齐; 之后追加的行不参与本次检索
+            size = len(alive) if mask is None else min(len(mask), len(alive))
+            mask = alive[:size] if mask is None else mask[:size] & alive[:size]
+        return mask
+
+
+class FeatureCache:
+    """
+    按 dataset 常驻内存的特征矩阵缓存, 超出内存预算时按 LRU 淘汰
+
+    loader(dataset_id) 返回 DatasetFeatures, 若 dataset 超出预算无法常驻则返回 None.
+    is_stale(entry) 为 True 的缓存项 (例如共享存储已经发布了新版本) 在下一次访问时重新加载.
+    loader 返回 None 的 dataset 在 negative_ttl 秒内直接返回 None, 不再每次检索都重新加载.
+    """
+
+    def __init__(self, loader, max_bytes: int, on_evict=None, async_loader=None, is_stale=None, negative_ttl: float = 0):
+        self._loader = loader
+        self._async_loader = async_loader
+        self._on_evict = on_evict
+        self._is_stale = is_stale
+        self.max_bytes = int(max_bytes)
+        self._entries = OrderedDict()
+        self.negative_ttl = negative_ttl
+        self._negative = {}
+        self._lock = threading.RLock()
+        self._load_locks = {}
+        self._async_load_locks = {}
+
+    @property
+    def nbytes(self) -> int:
+        with self._lock:
+            return sum(entry.nbytes for entry in self._entries.values())
+
+    def _lookup(self, dataset_id):
+        entry = self._entries.get(dataset_id)
+        if entry is not None and self._is_stale is not None and self._is_stale(entry):
+            del self._entries[dataset_id]
+            logger.info(f"dataset {dataset_id} in feature cache is stale, reloading")
+            if self._on_evict is not None:
+                self._on_evict(dataset_id)
+            return None
+        if entry is not None:
+            self._entries.move_to_end(dataset_id)
+        return entry
+
+    def _is_negative(self, dataset_id) -> bool:
+        expires = self._negative.get(dataset_id)
+        if expires is None:
+            return False
+        if time.monotonic() < expires:
+            return True
+        del self._negative[dataset_id]
+        return False
+
+    def _set_negative(self, dataset_id):
+        if self.negative_ttl > 0:
+            with self._lock:
+                self._negative[dataset_id] = time.monotonic() + self.negative_ttl
+
+    def get(self, dataset_id):
+        with self._lock:
+            entry = self._lookup(dataset_id)
+            if entry is not None or self._is_negative(dataset_id):
+                return entry
+            load_lock = self._load_locks.setdefault(dataset_id, threading.Lock())
+
+        # 同一个 dataset 只加载一次, 其它并发请求等待加载结果
+        with load_lock:
+            with self._lock:
+                entry = self._lookup(dataset_id)
+                if entry is not None or self._is_negative(dataset_id):
+                    return entry
+            entry = self._loader(dataset_id)
+            if entry is None:
+                self._set_negative(dataset_id)
+                return None
+            with self._lock:
+                self._entries[dataset_id] = entry
+                self._evict()
+                self._load_locks.pop(dataset_id, None)
+            logger.info(f"dataset {dataset_id} loaded into feature cache: {len(entry)} vectors, {entry.nbytes} bytes")
+            return entry
+
+    async def get_async(self, dataset_id):
+        """
+        get 的 async 版本, 使用 async_loader 加载, 没有 async_loader 时退回到 get
+        """
+        if self._async_loader is None:
+            return self.get(dataset_id)
+        with self._lock:
+            entry = self._lookup(dataset_id)
+            if entry is not None or self._is_negative(dataset_id):
+                return entry
+            load_lock = self._async_load_locks.setdefault(dataset_id, asyncio.Lock())
+
+        async with load_lock:
+            with self._lock:
+                entry = self._lookup(dataset_id)
+                if entry is not None or self._is_negative(dataset_id):
+                    return entry
+            entry = await self._async_loader(dataset_id)
+            if entry is None:
+                self._set_negative(dataset_id)
+                return None
+            with self._lock:
+                self._entries[dataset_id] = entry
+                self._evict()
+                self._async_load_locks.pop(dataset_id, None)
+            logger.info(f"dataset {dataset_id} loaded into feature cache: {len(entry)} vectors, {entry.nbytes} bytes")
+            return entry
+
+    def _evict(self):
+        total = sum(entry.nbytes for entry in self._entries.values())
+        # 至少保留最近使用的一个 dataset
+        while total > self.max_bytes and len(self._entries) > 1:
+            dataset_id, entry = self._entries.popitem(last=False)
+            total -= entry.nbytes
+            logger.info(f"dataset {dataset_id} evicted from feature cache")
+            if self._on_evict is not None:
+                self._on_evict(dataset_id)
+
+    def datasets(self):
+        with self._lock:
+            return list(self._entries.values())
+
+    def add_feature(self, workspace_file_id, feature, width, height, dataset_ids=None, extension=None):
+        """
+        把新写入的特征同步到所有包含该 workspace_file_id 的常驻 dataset
+        """
+        for entry in self.datasets():
+            if entry.accepts(workspace_file_id, dataset_ids):
+                entry.upsert(workspace_file_id, feature, width, height, extension)
+        with self._lock:
+            self._evict()
+
+    def remove_feature(self, workspace_file_id, dataset_ids=None):
+        """
+        在所有包含该 workspace_file_id 的常驻 dataset 中记录墓碑, 返回受影响的 dataset_id
+        """
+        return [entry.dataset_id for entry in self.datasets()
+                if entry.accepts(workspace_file_id, dataset_ids) and entry.delete(workspace_file_id)]
+
+    def invalidate(self, dataset_id=None):
+        with self._lock:
+            if dataset_id is None:
+                dataset_ids = list(self._entries)
+                self._entries.clear()
+                self._negative.clear()
+            else:
+                self._negative.pop(dataset_id, None)
+                dataset_ids = [dataset_id] if self._entries.pop(dataset_id, None) is not None else []
+        if self._on_evict is not None:
+            for evicted in dataset_ids:
+                self._on_evict(evicted)
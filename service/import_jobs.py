@@ -0,0 +1,182 @@
+import os
+import time
+import uuid
+import socket
+import threading
+from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from utils.logger import logger
+from utils.client import MongoDBClient
+from config.config import settings
+from service import data_workspace_detail_service
+from service.import_pipeline import ImportPipeline
+
+
+class LeaseLost(Exception):
+    pass
+
+
+class ImportJobManager:
+    """
+    后台执行 workspace 导入任务
+
+    任务状态与断点 (上一页最后一条 data_workspace_detail 的 _id) 保存在
+    import_jobs 集合中, 服务重启后未完成的任务从断点继续. 已经有特征的
+    workspace_file_id 会被跳过, 重复导入只处理新增图片. 导入本身由 ImportPipeline
+    流式执行, 各阶段的吞吐保存在任务的 stages 字段中.
+
+    多个 worker 进程共享 import_jobs: 执行任务前用 find_one_and_update 领取租约 (owner / lease_until),
+    执行期间后台线程续租, 同一个任务只在一个进程中执行. 持有租约的进程退出后, 其它进程在租约过期后
+    由定期的 resume 接管.
+    """
+
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+
+    def __init__(self, server, model, collection: MongoDBClient = None):
+        self.server = server
+        self.model = model
+        self.jobs = (collection or MongoDBClient("import_jobs")).get_collection()
+        self.page_size = settings.import_page_size
+        self._pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="import-job")
+        self._running = set()
+        self._lock = threading.Lock()
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.lease = timedelta(seconds=settings.import_job_lease)
+        self._stop = threading.Event()
+        self._heartbeat = threading.Thread(target=self._heartbeat_loop, name="import-job-lease", daemon=True)
+        self._heartbeat.start()
+
+    def submit(self, workspace_id: int) -> dict:
+        """
+        提交 workspace 导入任务, 该 workspace 有未完成的任务时直接复用
+        """
+        job = self.jobs.find_one({"workspace_id": int(workspace_id), "status": {"$in": [self.PENDING, self.RUNNING]}})
+        if job is None:
+            job = {
+                "job_id": uuid.uuid4().hex,
+                "workspace_id": int(workspace_id),
+                "status": self.PENDING,
+                "total": data_workspace_detail_service.count(workspace_id),
+                "processed": 0,
+                "done": 0,
+                "skipped": 0,
+                "failed": 0,
+                "checkpoint": None,
+                "owner": None,
+                "lease_until": None,
+                "images_per_sec": 0.0,
+                "eta": None,
+                "error": None,
+                "created_time": datetime.now(),
+                "updated_time": datetime.now(),
+            }
+            self.jobs.insert_one(job)
+        self._start(job["job_id"])
+        return self.get(job["job_id"])
+
+    def get(self, job_id: str):
+        return self.jobs.find_one({"job_id": job_id}, {"_id": 0, "checkpoint": 0})
+
+    def resume(self):
+        """
+        继续执行未完成且没有被其它进程持有租约的任务; 服务启动时与之后每个租约周期调用一次
+        """
+        query = {"status": {"$in": [self.PENDING, self.RUNNING]},
+                 "$or": [{"lease_until": None}, {"lease_until": {"$lt": datetime.now()}}]}
+        for job in self.jobs.find(query, {"job_id": 1}):
+            logger.info(f"resume import job {job['job_id']}")
+            self._start(job["job_id"])
+
+    def close(self):
+        self._stop.set()
+        self._pool.shutdown(wait=False)
+        # 交还租约, 其它进程不需要等待过期
+        self.jobs.update_many({"owner": self.owner, "status": {"$in": [self.PENDING, self.RUNNING]}},
+                              {"$set": {"owner": None, "lease_until": None}})
+
+    def _claim(self, job_id):
+        """
+        领取任务的租约, 已经被其它进程持有且没有过期时返回 None
+        """
+        now = datetime.now()
+        return self.jobs.find_one_and_update(
+            {"job_id": job_id, "status": {"$in": [self.PENDING, self.RUNNING]},
+             "$or": [{"owner": None}, {"owner": self.owner}, {"lease_until": None}, {"lease_until": {"$lt": now}}]},
+            {"$set": {"owner": self.owner, "lease_until": now + self.lease}})
+
+    def _heartbeat_loop(self):
+        while not self._stop.wait(self.lease.total_seconds() / 3):
+            try:
+                with self._lock:
+                    running = list(self._running)
+                if running:
+                    self.jobs.update_many({"job_id": {"$in": running}, "owner": self.owner},
+                                          {"$set": {"lease_until": datetime.now() + self.lease}})
+                self.resume()
+            except Exception as e:
+                logger.error(f"Error renewing import job leases: {e}")
+
+    def _start(self, job_id):
+        with self._lock:
+            if job_id in self._running:
+                return
+            self._running.add(job_id)
+        self._pool.submit(self._run, job_id)
+
+    def _update(self, job_id, **fields):
+        """
+        只更新本进程持有租约的任务, 租约已经被其它进程接管时抛出 LeaseLost
+        """
+        fields["updated_time"] = datetime.now()
+        if self.jobs.update_one({"job_id": job_id, "owner": self.owner}, {"$set": fields}).matched_count == 0:
+            raise LeaseLost(f"import job {job_id} is no longer owned by {self.owner}")
+
+    def _run(self, job_id):
+        try:
+            job = self._claim(job_id)
+            if job is None:
+                logger.info(f"import job {job_id} is owned by another worker")
+                return
+            self._run_job(job)
+        except LeaseLost as e:
+            logger.warning(str(e))
+        except Exception as e:
+            logger.error(f"import job {job_id} failed: {e}")
+            try:
+                self._update(job_id, status=self.FAILED, error=str(e))
+            except LeaseLost as lost:
+                logger.warning(str(lost))
+        finally:
+            with self._lock:
+                self._running.discard(job_id)
+
+    def _run_job(self, job):
+        job_id = job["job_id"]
+        workspace_id = job["workspace_id"]
+        counters = {key: job[key] for key in ("processed", "done", "skipped", "failed")}
+        self._update(job_id, status=self.RUNNING, error=None)
+
+        _time_start = time.time()
+        progress = {"imported": 0, "processed": 0}
+        pipeline = ImportPipeline(self.server, self.model, page_size=self.page_size)
+
+        def on_page(checkpoint, page_counters):
+            for key, value in page_counters.items():
+                counters[key] += value
+            progress["imported"] += page_counters["done"]
+            progress["processed"] += page_counters["processed"]
+            elapsed = time.time() - _time_start
+            images_per_sec = progress["imported"] / elapsed if elapsed > 0 else 0.0
+            page_rate = progress["processed"] / elapsed if elapsed > 0 else 0.0
+            remaining = max((job["total"] or 0) - counters["processed"], 0)
+            self._update(job_id, checkpoint=checkpoint, images_per_sec=images_per_sec,
+                         eta=remaining / page_rate if page_rate > 0 else None,
+                         stages=pipeline.stage_stats(), **counters)
+
+        pipeline.run(workspace_id, after_id=job["checkpoint"], on_page=on_page)
+        self._update(job_id, status=self.DONE, eta=0, stages=pipeline.stage_stats())
+        logger.info(f"import job {job_id} done: {counters}")
@@ -0,0 +1,209 @@
+import time
+import queue
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from utils.logger import logger
+from utils.image_decode import read_and_decode
+from utils.metrics import observe_stage
+from utils.admission import BULK
+from config.config import settings
+from models.model_utils import detect_image_type
+from service import data_workspace_detail_service
+
+
+_DONE = object()
+
+
+class StageStats:
+    """
+    流水线单个阶段的吞吐统计
+
+    busy 为阶段实际工作的时间, wait 为等待上游数据的时间; parallelism 个 worker
+    并行时 images_per_sec 为整个阶段的处理能力. 瓶颈阶段的 wait 接近 0,
+    下游阶段的 wait 较大.
+    """
+
+    def __init__(self, name: str, parallelism: int = 1):
+        self.name = name
+        self.parallelism = parallelism
+        self.images = 0
+        self.busy = 0.0
+        self.wait = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, images: int, busy: float, wait: float = 0.0):
+        with self._lock:
+            self.images += images
+            self.busy += busy
+            self.wait += wait
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            return {
+                "images": self.images,
+                "busy_sec": round(self.busy, 3),
+                "wait_sec": round(self.wait, 3),
+                "images_per_sec": round(self.images / self.busy * self.parallelism, 2) if self.busy > 0 else 0.0,
+            }
+
+
+class ImportPipeline:
+    """
+    workspace 的流式导入流水线
+
+        page   分页读取 data_workspace_detail, 跳过已经有特征的图片, 把 batch 提交到进程池
+        decode 进程池中读取 root_path 下的文件, 解码并缩放到模型输入分辨率
+        encode 批量提取 CLIP 特征
+        write  批量写入 mongo, 同步 feature cache / 索引
+
+    阶段之间是容量为 queue_size 个 batch 的有界队列, 下游变慢时上游阻塞, 同时在内存中的
+    图片数约为 (2 * queue_size + 3) * batch_size, 与 workspace 的大小无关.
+    一页的所有 batch 写入后才回调 on_page, 断点只会落在已经完整写入的页上.
+    """
+
+    def __init__(self, server, model, batch_size: int = None, decode_workers: int = None,
+                 queue_size: int = None, page_size: int = None):
+        self.server = server
+        self.model = model
+        self.batch_size = batch_size or settings.image_batch_size
+        self.decode_workers = max(decode_workers or settings.import_decode_workers, 1)
+        self.queue_size = max(queue_size or settings.import_queue_size, 1)
+        self.page_size = page_size or settings.import_page_size
+        self.n_px = getattr(model, "input_resolution", 224)
+        self.stats = {
+            "page": StageStats("page"),
+            "decode": StageStats("decode", self.decode_workers),
+            "encode": StageStats("encode"),
+            "write": StageStats("write"),
+        }
+        self._stop = threading.Event()
+        self._error = None
+
+    def stage_stats(self) -> dict:
+        return {name: stats.to_dict() for name, stats in self.stats.items()}
+
+    def run(self, workspace_id: int, after_id=None, on_page=None):
+        """
+        从 after_id (上一页最后一条 data_workspace_detail 的 _id) 之后开始导入
+
+        on_page(checkpoint, counters) 在一页全部写入后调用, counters 为该页的
+        processed / done / skipped / failed 计数
+        """
+        decode_queue = queue.Queue(maxsize=self.queue_size)
+        write_queue = queue.Queue(maxsize=self.queue_size)
+        # spawn 启动的子进程不继承父进程中的 torch 线程与 mongo 连接
+        with ProcessPoolExecutor(max_workers=self.decode_workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+            threads = [
+                threading.Thread(target=self._guard, args=(self._read, pool, workspace_id, after_id, decode_queue),
+                                 name="import-page", daemon=True),
+                threading.Thread(target=self._guard, args=(self._encode, decode_queue, write_queue),
+                                 name="import-encode", daemon=True),
+            ]
+            for thread in threads:
+                thread.start()
+            self._guard(self._write, write_queue, on_page)
+            for thread in threads:
+                thread.join()
+        if self._error is not None:
+            raise self._error
+        logger.info(f"import pipeline for workspace {workspace_id} done: {self.stage_stats()}")
+
+    def _guard(self, stage, *args):
+        try:
+            stage(*args)
+        except Exception as e:
+            logger.error(f"import pipeline stage {stage.__name__} failed: {e}")
+            if self._error is None:
+                self._error = e
+            self._stop.set()
+
+    def _put(self, q, item) -> bool:
+        while not self._stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get(self, q):
+        while True:
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                if self._stop.is_set():
+                    return _DONE
+
+    def _read(self, pool, workspace_id, after_id, out):
+        checkpoint = after_id
+        while not self._stop.is_set():
+            _time_start = time.time()
+            page = data_workspace_detail_service.find_page(workspace_id, after_id=checkpoint, limit=self.page_size)
+            if len(page) == 0:
+                break
+            imported = self.server.find_imported_ids([id for _, id, _ in page])
+            pending = [(id, file_path) for _, id, file_path in page if id not in imported]
+            self.stats["page"].record(len(page), time.time() - _time_start)
+            for start in range(0, len(pending), self.batch_size):
+                batch = pending[start:start + self.batch_size]
+                future = pool.submit(read_and_decode, settings.root_path, [file_path for _, file_path in batch], self.n_px)
+                if not self._put(out, ("batch", [id for id, _ in batch], future)):
+                    return
+            checkpoint = page[-1][0]
+            if not self._put(out, ("page", checkpoint, len(page), len(page) - len(pending))):
+                return
+        self._put(out, _DONE)
+
+    def _encode(self, inp, out):
+        while True:
+            _time_start = time.time()
+            item = self._get(inp)
+            if item is _DONE:
+                self._put(out, _DONE)
+                return
+            if item[0] == "page":
+                self._put(out, item)
+                continue
+            _, id_list, future = item
+            pixels, results, decode_elapsed = future.result()
+            wait = time.time() - _time_start
+            self.stats["decode"].record(len(id_list), decode_elapsed)
+            observe_stage("import_decode", decode_elapsed)
+
+            _time_start = time.time()
+            with self.server.encode_slots.slot(BULK):
+                image_features = self.model.get_pixel_features(pixels)
+            self.stats["encode"].record(len(pixels), time.time() - _time_start, wait)
+            observe_stage("import_encode", time.time() - _time_start)
+            if not self._put(out, ("batch", id_list, image_features, results)):
+                return
+
+    def _write(self, inp, on_page):
+        page_done = 0
+        page_failed = 0
+        while True:
+            _time_start = time.time()
+            item = self._get(inp)
+            if item is _DONE:
+                return
+            wait = time.time() - _time_start
+            if item[0] == "page":
+                _, checkpoint, processed, skipped = item
+                if on_page is not None:
+                    on_page(checkpoint, {"processed": processed, "done": page_done, "skipped": skipped, "failed": page_failed})
+                page_done = 0
+                page_failed = 0
+                continue
+
+            _time_start = time.time()
+            _, id_list, image_features, results = item
+            decoded = [(id, result) for id, result in zip(id_list, results) if result is not None]
+            imported = []
+            if decoded:
+                imported = self.server.write_image_features([id for id, _ in decoded], image_features,
+                                                            [image_size for _, (image_size, _) in decoded],
+                                                            [detect_image_type(header) for _, (_, header) in decoded])
+            page_done += len(imported)
+            page_failed += len(id_list) - len(imported)
+            self.stats["write"].record(len(imported), time.time() - _time_start, wait)
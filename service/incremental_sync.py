@@ -0,0 +1,159 @@
+import time
+import weakref
+import threading
+from datetime import datetime, timedelta
+from utils.logger import logger
+from utils.client import MongoDBClient
+from utils.metrics import metrics
+from config.config import settings
+
+
+# 集合为空时的初始水位
+_EPOCH = datetime(1970, 1, 1)
+# 判断是否新变更只需要这些字段, 特征只对没有处理过的文档读取
+_CHANGE_PROJECTION = {"created_time": 1, "updated_time": 1}
+_MEMBERSHIP_PROJECTION = {"workspace_file_id": 1, "dataset_id": 1, "status": 1}
+
+
+class IncrementalSync:
+    """
+    按 created_time / updated_time 水位增量同步 mongo 中的变更到常驻 dataset
+
+    后台线程每 incremental-sync-interval 秒按 (时间字段, _id) 顺序分页读取 search_datas 与
+    dataset_files 中比水位新的文档, 交给 SearchServer.apply_changes / apply_membership_changes:
+    新特征追加到常驻矩阵与已加载的索引, status 不为 1 的文档 / 归属关系记为墓碑. 其它实例或外部任务
+    写入的特征因此在几秒内可以被检索到, 不需要重新加载整个 dataset.
+
+    水位只保存在进程内: 启动时取集合中最新的时间, 之前的数据由 dataset 首次加载时读入. 每轮从
+    水位之前 incremental-sync-lookback 秒开始读取, 容忍写入方之间的时钟偏差与 created_time
+    早于提交时间的写入; 窗口内已经处理过的文档按 (_id, 时间) 跳过. 加载期间写入的变更在 dataset
+    进入 feature cache 后从 loaded_at 补上一次.
+    """
+
+    def __init__(self, server, features: MongoDBClient = None, dataset_files: MongoDBClient = None):
+        self.server = server
+        self.features = (features or MongoDBClient(settings.mongodb_collection)).get_collection()
+        self.dataset_files = (dataset_files or MongoDBClient("dataset_files")).get_collection()
+        self.interval = settings.incremental_sync_interval
+        self.lookback = timedelta(seconds=settings.incremental_sync_lookback)
+        self.batch_size = settings.incremental_sync_batch_size
+        self._watermarks = {}
+        self._seen = {}
+        self._caught_up = weakref.WeakSet()
+        self._last_success = time.monotonic()
+        self._stop = threading.Event()
+        self._thread = None
+        metrics.register_collector("clip_search_sync_age_seconds", "gauge",
+                                   lambda: [({}, time.monotonic() - self._last_success)],
+                                   help="seconds since the last successful incremental sync")
+
+    def start(self):
+        for collection in (self.features, self.dataset_files):
+            for field in _CHANGE_PROJECTION:
+                self._watermarks[(collection.name, field)] = self._latest(collection, field)
+        self._thread = threading.Thread(target=self._run, name="incremental-sync", daemon=True)
+        self._thread.start()
+        logger.info(f"incremental sync started, interval {self.interval}s")
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.interval + 5)
+
+    @staticmethod
+    def _latest(collection, field):
+        doc = collection.find_one({field: {"$exists": True}}, {field: 1}, sort=[(field, -1)])
+        return doc[field] if doc is not None else _EPOCH
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.sync_once()
+                self._last_success = time.monotonic()
+            except Exception as e:
+                logger.error(f"Error in incremental sync: {e}")
+
+    def sync_once(self):
+        """
+        执行一轮同步, 返回 (特征文档数, 归属关系文档数)
+        """
+        if self.server.use_shared and not self.server.shared_store.is_loader:
+            # shared 模式下由 loader 标记 dirty 并重新发布, 其它 worker 切换到新版本
+            return 0, 0
+        self._catch_up()
+        synced = 0
+        for docs in self._changes(self.features):
+            full_docs = list(self.features.find({"_id": {"$in": [doc["_id"] for doc in docs]}}, self._feature_doc_projection()))
+            synced += self.server.apply_changes(full_docs)
+        synced_membership = 0
+        for docs in self._changes(self.dataset_files, _MEMBERSHIP_PROJECTION):
+            synced_membership += self.server.apply_membership_changes(docs)
+        if synced:
+            metrics.inc("clip_search_sync_changes_total", synced, help="changes applied by incremental sync", collection="features")
+        if synced_membership:
+            metrics.inc("clip_search_sync_changes_total", synced_membership, help="changes applied by incremental sync", collection="dataset_files")
+        if synced or synced_membership:
+            logger.info(f"incremental sync: {synced} feature documents, {synced_membership} membership documents")
+        return synced, synced_membership
+
+    def _catch_up(self):
+        """
+        新进入 feature cache 的 dataset 从开始加载的时间补上一次变更, 加载期间提交的写入不会遗漏
+        """
+        datasets = [dataset for dataset in self.server.feature_cache.datasets()
+                    if dataset.loaded_at is not None and dataset not in self._caught_up]
+        if not datasets:
+            return
+        since = min(dataset.loaded_at for dataset in datasets) - self.lookback
+        projection = dict(self._feature_doc_projection(), **_CHANGE_PROJECTION)
+        applied = set()
+        for field in _CHANGE_PROJECTION:
+            for docs in self._pages(self.features, field, since, projection):
+                # 同时有新 created_time / updated_time 的文档只处理一次
+                docs = [doc for doc in docs if doc["_id"] not in applied]
+                applied.update(doc["_id"] for doc in docs)
+                self.server.apply_changes(docs)
+        for dataset in datasets:
+            self._caught_up.add(dataset)
+
+    def _feature_doc_projection(self):
+        # 特征字段与加载时一致, 只读取当前量化模式需要的字段
+        return self.server.feature_projection(status=1, dataset_ids=1)
+
+    def _changes(self, collection, projection=None):
+        """
+        按 created_time / updated_time 分别分页读取比水位新的文档, 每次 yield 一页中没有处理过的文档
+        """
+        projection = dict(projection or {}, **_CHANGE_PROJECTION)
+        seen_by_field = [self._seen.setdefault((collection.name, field), {}) for field in _CHANGE_PROJECTION]
+        for field, seen in zip(_CHANGE_PROJECTION, seen_by_field):
+            key = (collection.name, field)
+            for docs in self._pages(collection, field, max(self._watermarks[key] - self.lookback, _EPOCH), projection):
+                changed = []
+                for doc in docs:
+                    changed_time = max(doc.get(name) or _EPOCH for name in _CHANGE_PROJECTION)
+                    if all(field_seen.get(doc["_id"], _EPOCH) < changed_time for field_seen in seen_by_field):
+                        seen[doc["_id"]] = changed_time
+                        changed.append(doc)
+                if changed:
+                    yield changed
+                self._watermarks[key] = max(self._watermarks[key], docs[-1][field])
+            # 只需要记住回看窗口内处理过的文档
+            horizon = self._watermarks[key] - self.lookback
+            for _id in [_id for _id, changed_time in seen.items() if changed_time < horizon]:
+                del seen[_id]
+
+    def _pages(self, collection, field, since, projection):
+        """
+        按 (field, _id) 顺序每次读取 batch_size 个 field 比 since 新的文档, 走 create_sync_indexes 建立的索引
+        """
+        query = {field: {"$gt": since}}
+        while True:
+            docs = list(collection.find(query, projection).sort([(field, 1), ("_id", 1)]).limit(self.batch_size))
+            if not docs:
+                return
+            yield docs
+            if len(docs) < self.batch_size:
+                return
+            last = docs[-1]
+            query = {"$or": [{field: {"$gt": last[field]}}, {field: last[field], "_id": {"$gt": last["_id"]}}]}
@@ -0,0 +1,91 @@
+import time
+import threading
+from PIL import Image
+from utils.logger import logger
+from utils.client import MongoDBClient, AsyncMongoDBClient
+from config.config import settings
+from service.server import SearchServer
+from service.import_jobs import ImportJobManager
+from service.incremental_sync import IncrementalSync
+from service.migrations import ensure_indexes
+
+
+def _load_clip_model():
+    # torch / clip 在这里才导入, import app 时不加载
+    from models.clip_model import get_model
+    return get_model()
+
+
+class AppServices:
+    """
+    进程内唯一的模型 / mongo 连接 / SearchServer / ImportJobManager, 由 main.lifespan 创建与关闭
+
+    start() 在后台线程中加载模型并做一次 warmup (编码一条文本和一张空白图片), 完成后 ready 置位;
+    在此之前 /health 可以正常返回, 依赖模型的接口返回 503. incremental-sync-interval 大于 0 时
+    同时启动 IncrementalSync. model_factory 与 async_mongo 用于替换模型 / 不使用 motor (例如 benchmarks).
+    """
+
+    def __init__(self, model_factory=None, async_mongo: bool = True):
+        self.model_factory = model_factory or _load_clip_model
+        self.async_mongo = async_mongo
+        self.model = None
+        self.server = None
+        self.import_jobs = None
+        self.sync = None
+        self.ready = threading.Event()
+        self.error = None
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._load, name="model-loader", daemon=True)
+        self._thread.start()
+
+    def wait(self, timeout=None) -> bool:
+        return self.ready.wait(timeout)
+
+    def status(self) -> str:
+        if self.ready.is_set():
+            return "ready"
+        return "failed" if self.error is not None else "loading"
+
+    def _load(self):
+        try:
+            _time_start = time.time()
+            MongoDBClient.get_mongodb()
+            ensure_indexes()
+            model = self.model_factory()
+            server = SearchServer(MongoDBClient(settings.mongodb_collection), model,
+                                  AsyncMongoDBClient(settings.mongodb_collection) if self.async_mongo else None)
+            import_jobs = ImportJobManager(server, model)
+            self._warmup(model)
+            self.model, self.server, self.import_jobs = model, server, import_jobs
+            import_jobs.resume()
+            if settings.incremental_sync_interval > 0:
+                self.sync = IncrementalSync(server)
+                self.sync.start()
+            self.ready.set()
+            logger.info(f"services ready in {time.time() - _time_start:.2f} seconds")
+        except Exception as e:
+            logger.error(f"Error loading services: {e}")
+            self.error = e
+
+    @staticmethod
+    def _warmup(model):
+        """
+        第一次 encode 会初始化线程池 / 分配内存 (onnxruntime / TorchScript 还会做图优化), 放在 ready 之前
+        """
+        _time_start = time.time()
+        n_px = getattr(model, "input_resolution", 224)
+        model.get_text_features(["warmup"])
+        model.get_image_features([Image.new("RGB", (n_px, n_px))])
+        logger.info(f"model warmup done in {time.time() - _time_start:.2f} seconds")
+
+    def close(self):
+        if self.sync is not None:
+            self.sync.close()
+        if self.import_jobs is not None:
+            self.import_jobs.close()
+        if self.server is not None:
+            self.server.close()
+        AsyncMongoDBClient.close()
+        MongoDBClient.close()
@@ -0,0 +1,125 @@
+from pymongo import UpdateMany, UpdateOne
+from pymongo.errors import DuplicateKeyError, OperationFailure
+import numpy as np
+from utils.logger import logger
+from utils.client import MongoDBClient
+from config.config import settings
+import os
+from models.model_utils import quantized_document_fields, get_file_types
+from service import dataset_files_service, data_workspace_detail_service
+
+
+def ensure_indexes():
+    """
+    服务启动时建立导入 / 检索依赖的索引, 已经存在时不做任何事
+
+    search_datas.workspace_file_id 唯一: 导入时的 upsert 与 find_imported_ids 走索引, 并发 upsert
+    不会插入重复文档. 已有重复文档时退回到普通索引并记录错误, 需要先清理重复文档.
+    开启增量同步 (incremental-sync-interval 大于 0) 时同时建立 create_sync_indexes 的索引.
+    """
+    features = MongoDBClient(settings.mongodb_collection).get_collection()
+    try:
+        features.create_index([("workspace_file_id", 1)], unique=True, background=True)
+    except (DuplicateKeyError, OperationFailure) as e:
+        logger.error(f"unique index on {settings.mongodb_collection}.workspace_file_id not created, remove duplicated documents first: {e}")
+        features.create_index([("workspace_file_id", 1)], background=True)
+    jobs = MongoDBClient("import_jobs").get_collection()
+    jobs.create_index([("job_id", 1)], unique=True, background=True)
+    jobs.create_index([("status", 1)], background=True)
+    if settings.incremental_sync_interval > 0:
+        create_sync_indexes()
+
+
+def backfill_dataset_ids(batch_size: int = 1000):
+    """
+    把 dataset_files 中的归属关系冗余到特征文档的 dataset_ids 字段, 并建立
+    (dataset_ids, width, height) 复合索引
+
+    使用 $addToSet, 可以在服务运行时执行, 重复执行也是安全的.
+    """
+    features = MongoDBClient(settings.mongodb_collection).get_collection()
+    features.create_index([("dataset_ids", 1), ("width", 1), ("height", 1)], background=True)
+    logger.info("index (dataset_ids, width, height) created")
+
+    requests = []
+    updated = 0
+    for workspace_file_id, dataset_ids in dataset_files_service.iter_dataset_membership():
+        requests.append(UpdateMany({"workspace_file_id": workspace_file_id},
+                                   {"$addToSet": {"dataset_ids": {"$each": dataset_ids}}}))
+        if len(requests) >= batch_size:
+            updated += features.bulk_write(requests, ordered=False).modified_count
+            requests = []
+            logger.info(f"backfill dataset_ids: {updated} documents updated")
+    if requests:
+        updated += features.bulk_write(requests, ordered=False).modified_count
+    logger.info(f"backfill dataset_ids done: {updated} documents updated")
+    return updated
+
+
+def create_sync_indexes():
+    """
+    为 IncrementalSync 按 (created_time, _id) / (updated_time, _id) 分页读取变更建立索引
+    """
+    for collection in (MongoDBClient(settings.mongodb_collection).get_collection(), MongoDBClient("dataset_files").get_collection()):
+        for field in ("created_time", "updated_time"):
+            collection.create_index([(field, 1), ("_id", 1)], background=True)
+            logger.info(f"index ({field}, _id) created on {collection.name}")
+
+
+def quantize_features(mode: str, drop_float32: bool = False, batch_size: int = 1000):
+    """
+    为已有特征文档写入 feature_q / feature_scale / feature_quantization
+
+    只在 rerank-factor 为 1 (加载时直接读取量化数据) 时需要; drop_float32 为 True 时同时删除
+    float32 的 feature 字段, 之后检索无法再做精排.
+    """
+    features = MongoDBClient(settings.mongodb_collection).get_collection()
+    query = {"feature_quantization": {"$ne": mode}, "feature": {"$exists": True}}
+    requests = []
+    updated = 0
+    for doc in features.find(query, {"feature": 1}):
+        update = {"$set": quantized_document_fields(np.frombuffer(doc["feature"], settings.storage_type), mode)}
+        if drop_float32:
+            update["$unset"] = {"feature": ""}
+        requests.append(UpdateOne({"_id": doc["_id"]}, update))
+        if len(requests) >= batch_size:
+            updated += features.bulk_write(requests, ordered=False).modified_count
+            requests = []
+            logger.info(f"quantize features: {updated} documents updated")
+    if requests:
+        updated += features.bulk_write(requests, ordered=False).modified_count
+    logger.info(f"quantize features done: {updated} documents converted to {mode}")
+    return updated
+
+
+def backfill_extensions(batch_size: int = 1000):
+    """
+    为没有 extension 字段的特征文档读取文件头识别图片类型并写入 extension
+
+    文件路径取自 data_workspace_detail, 找不到文件或无法识别的文档保持不变.
+    """
+    features = MongoDBClient(settings.mongodb_collection).get_collection()
+    cursor = features.find({"extension": {"$exists": False}}, {"workspace_file_id": 1})
+    updated = 0
+    batch = []
+    for doc in cursor:
+        batch.append(doc["workspace_file_id"])
+        if len(batch) >= batch_size:
+            updated += _backfill_extension_batch(features, batch)
+            batch = []
+            logger.info(f"backfill extensions: {updated} documents updated")
+    if batch:
+        updated += _backfill_extension_batch(features, batch)
+    logger.info(f"backfill extensions done: {updated} documents updated")
+    return updated
+
+
+def _backfill_extension_batch(features, id_list):
+    path_map = data_workspace_detail_service.find_path_map(list(set(id_list))) or {}
+    ids = [id for id in path_map]
+    extensions = get_file_types([os.path.join(settings.root_path, path_map[id]) for id in ids], max_workers=settings.import_workers)
+    requests = [UpdateMany({"workspace_file_id": id}, {"$set": {"extension": extension}})
+                for id, extension in zip(ids, extensions) if extension is not None]
+    if not requests:
+        return 0
+    return features.bulk_write(requests, ordered=False).modified_count
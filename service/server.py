@@ -1,28 +1,146 @@
 import os 
+import time
+import threading
 import numpy as np 
-from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future
 import asyncio
-import torch 
+import functools
+import contextvars
+from typing import TYPE_CHECKING
 import shutil 
 from datetime import datetime 
 from PIL import Image 
+from pymongo import UpdateOne, UpdateMany
+from pymongo.errors import BulkWriteError
 from utils.logger import logger
 from config.config import settings
-from models.model_utils import get_feature_size, cosine_similarity, get_file_type
-from models.clip_model import get_model, CLIPModel
-from utils.utils import calc_md5, get_full_path
+from models.model_utils import get_feature_size, cosine_similarity, normalize_extension, image_extension, topk, merge_topk, QUANTIZATION_DTYPES, dequantize, quantized_document_fields
+from models.embedding_batcher import EmbeddingBatcher
+from utils.utils import calc_md5, calc_bytes_md5, decode_image, get_full_path
+from utils.cache import LRUCache
+from utils.metrics import metrics, span, timed_iter
+from utils.admission import PrioritySlots, INTERACTIVE, BULK
 from service import dataset_files_service 
+from service.feature_cache import FeatureCache, DatasetFeatures, normalize_rows
+from service.vector_index import IndexManager, get_scorer
+from service.shard_store import ShardStore
+from service.shared_store import SharedFeatureStore
 
+if TYPE_CHECKING:
+    # torch / clip 只在加载模型时导入
+    from models.clip_model import CLIPModel
+
+
+def _reads_quantized():
+    """
+    是否直接读取特征文档中的量化数据: 量化且不精排时只需要量化数据, 其它情况读取 float32 后在本地量化
+    """
+    return settings.feature_quantization != "none" and settings.rerank_factor <= 1
+
+
+def _feature_projection(**extra):
+    """
+    特征文档的投影, 只读取当前模式需要的特征字段
+    """
+    projection = {"workspace_file_id": 1, "width": 1, "height": 1, "extension": 1}
+    if _reads_quantized():
+        projection.update({"feature_q": 1, "feature_scale": 1, "feature_quantization": 1})
+    else:
+        projection["feature"] = 1
+    projection.update(extra)
+    return projection
+
+
+# status 不为 1 的特征文档视为已删除; 没有 status 字段的文档 (外部写入) 视为有效, dataset_files 的判断相同
+_ACTIVE_STATUS = dataset_files_service.ACTIVE_STATUS
+# 常驻 dataset 中墓碑超过该比例时重新加载, 去掉被删除的行
+_TOMBSTONE_RELOAD_RATIO = 0.25
+
+
+def _is_active(doc):
+    return doc.get("status") in _ACTIVE_STATUS
+
+
+def _doc_feature(doc):
+    """
+    特征文档中的 float32 特征; 与当前 feature-quantization 一致的量化数据优先, 否则使用 feature.
+    旧版本写入分片后去掉了特征的文档返回 None
+    """
+    quantization = doc.get("feature_quantization")
+    if "feature_q" in doc and (quantization == settings.feature_quantization or "feature" not in doc):
+        return dequantize(np.frombuffer(doc["feature_q"], QUANTIZATION_DTYPES[quantization]), doc.get("feature_scale"))
+    if "feature" not in doc:
+        return None
+    return np.frombuffer(doc["feature"], settings.storage_type)
 
 
 class SearchServer:
-    def __init__(self, mongo_collection, model: CLIPModel):
+    def __init__(self, mongo_collection, model: "CLIPModel", async_mongo_collection=None):
         self.device = settings.device
         self.feat_dim = get_feature_size(settings.clip_model)
         self.mongo_collection = mongo_collection.get_collection()
+        # motor client 在第一次使用时才创建, 保证绑定到 uvicorn 的 event loop
+        self._async_mongo_client = async_mongo_collection
+        # async 接口中 CPU 密集的编码/打分放到线程池执行, 不阻塞 event loop
+        self.executor = ThreadPoolExecutor(max_workers=settings.search_workers, thread_name_prefix="search")
         
         self.model = model
+        # 限制同时执行的 encode / 打分, 交互检索优先于批量导入
+        self.encode_slots = PrioritySlots("encode", settings.encode_concurrency)
+        self.score_slots = PrioritySlots("score", settings.score_concurrency)
+        self.batcher = None
+        if model is not None and settings.encode_batch_max_size > 1:
+            self.batcher = EmbeddingBatcher(model, settings.encode_batch_max_wait_ms, settings.encode_batch_max_size, slots=self.encode_slots)
+        self.embedding_cache = LRUCache(settings.embedding_cache_size, settings.embedding_cache_ttl)
+        self.result_cache = LRUCache(settings.result_cache_size, settings.result_cache_ttl)
+        # dataset 每次有新特征写入时版本号加一, 旧版本的检索结果不会再被命中
+        self._dataset_versions = {}
+        self._versions_lock = threading.Lock()
         self._MAX_SPLIT_SIZE = 8192
+        self.shard_store = ShardStore(os.path.join(settings.root_path, "feature_shards"), self.feat_dim,
+                                      quantization=settings.feature_quantization, shard_rows=settings.shard_rows)
+        self.shared_store = None
+        self._shared_stop = threading.Event()
+        self._shared_publish_lock = threading.Lock()
+        if self.use_shared:
+            self.shared_store = SharedFeatureStore(os.path.join(settings.root_path, "shared_features"), self.feat_dim,
+                                                   quantization=settings.feature_quantization,
+                                                   check_interval=settings.shared_store_poll_interval)
+            self.shared_store.try_acquire_loader()
+        # shared 模式下索引只由 loader 构建并保存, 其它 worker 加载保存的索引文件
+        self.index_manager = IndexManager(
+            settings.index_type,
+            self.feat_dim,
+            os.path.join(settings.root_path, "indexes"),
+            min_size=settings.index_min_size,
+            save_interval=settings.index_save_interval,
+            can_build=(lambda: self.shared_store.is_loader) if self.use_shared else None,
+        )
+        if self.use_shared:
+            threading.Thread(target=self._shared_loader_loop, name="shared-store-loader", daemon=True).start()
+        self.feature_cache = FeatureCache(
+            self._load_dataset_features,
+            settings.feature_cache_mb * 1024 * 1024,
+            on_evict=self.index_manager.drop,
+            async_loader=self._load_dataset_features_async if async_mongo_collection is not None else None,
+            is_stale=self._is_shared_stale if self.use_shared else None,
+            # shared 模式下 worker 等待 loader 发布, 按检查新版本的间隔重试
+            negative_ttl=min(settings.feature_cache_negative_ttl, settings.shared_store_poll_interval) if self.use_shared else settings.feature_cache_negative_ttl,
+        )
+        self._register_metrics()
+
+    @property
+    def async_mongo_collection(self):
+        return self._async_mongo_client.get_collection()
+
+    @property
+    def use_shards(self):
+        return settings.feature_store == "shard"
+
+    @property
+    def use_shared(self):
+        return settings.feature_store == "shared"
 
     def _get_search_filter(self, args):
         ret = {}
@@ -31,99 +149,975 @@ class SearchServer:
             ret['width'] = {'$gte': int(args['minimum_width'])}
         if 'minimum_height' in args:
             ret['height'] = {'$gte': int(args['minimum_height'])}
-        # if 'extension_choice' in args and len(args['extension_choice']) > 0:
-        #     ret['extension'] = {'$in': args['extension_choice']}
+        if args.get('extension_choice'):
+            ret['extension'] = {'$in': sorted({normalize_extension(extension) for extension in args['extension_choice']})}
         return ret
     
-    def search_nearest_clip_feature(self, query_feature, dataset_id, topn=20, search_filter_options={}):
-        logger.info(f"search_filter_options: {search_filter_options}")
-        mongo_query_dict = self._get_search_filter(search_filter_options)
-        id_list = dataset_files_service.find(dataset_id)
-        if id_list:
+    @property
+    def denormalized_membership(self):
+        return settings.dataset_membership == "denormalized"
+
+    def _dataset_members(self, dataset_id):
+        """
+        dataset 的 workspace_file_id 列表; 特征文档上已有 dataset_ids 时不需要查询 dataset_files.
+        查询 dataset_files 失败时抛出异常, 不能当作不限制 dataset 去扫描整个集合
+        """
+        if self.denormalized_membership:
+            return None
+        with span("dataset_files"):
+            id_list = dataset_files_service.find(dataset_id)
+        if id_list is None:
+            raise RuntimeError(f"Failed to find members of dataset {dataset_id}")
+        return id_list
+
+    async def _dataset_members_async(self, dataset_id):
+        if self.denormalized_membership:
+            return None
+        with span("dataset_files"):
+            id_list = await dataset_files_service.find_async(dataset_id)
+        if id_list is None:
+            raise RuntimeError(f"Failed to find members of dataset {dataset_id}")
+        return id_list
+
+    def _dataset_query(self, dataset_id, id_list, search_filter_options=None):
+        mongo_query_dict = {"status": {"$in": _ACTIVE_STATUS}}
+        if self.denormalized_membership:
+            # 走 (dataset_ids, width, height) 复合索引
+            mongo_query_dict["dataset_ids"] = dataset_id
+        elif id_list:
             mongo_query_dict["workspace_file_id"] = {"$in": id_list}
-        cursor = self.mongo_collection.find(mongo_query_dict)
-        filename_list = []
-        feature_list = []
-        sim_score_list = [] 
+        mongo_query_dict.update(self._get_search_filter(search_filter_options or {}))
+        return mongo_query_dict
+
+    def _new_dataset_features(self, dataset_id, id_list, count):
+        itemsize = np.dtype(QUANTIZATION_DTYPES[settings.feature_quantization]).itemsize
+        if count * self.feat_dim * itemsize > self.feature_cache.max_bytes:
+            logger.info(f"dataset {dataset_id} has {count} vectors, exceeds feature cache budget")
+            return None
+        return DatasetFeatures(dataset_id, self.feat_dim, members=self._members(id_list), capacity=count,
+                               quantization=settings.feature_quantization, exact_dir=self._exact_dir())
+
+    def _exact_dir(self):
+        """
+        量化且精排时, 常驻 dataset 的 float32 特征保存在 root_path/rerank 下 (临时文件, 进程退出后删除)
+        """
+        if settings.feature_quantization == "none" or settings.rerank_factor <= 1:
+            return None
+        path = os.path.join(settings.root_path, "rerank")
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    @property
+    def reads_quantized_features(self):
+        return _reads_quantized()
+
+    @staticmethod
+    def feature_projection(**extra):
+        return _feature_projection(**extra)
+
+    def _features_of(self, docs):
+        """
+        与 docs 对齐的 float32 特征, 没有特征的文档为 None. 投影中的特征字段缺失的文档 (例如只读取量化数据时
+        quantize-features 之前写入的文档, 或 --drop-float32 之后的文档) 再按另一种字段补读一次
+        """
+        features = [_doc_feature(doc) for doc in docs]
+        missing = [doc["workspace_file_id"] for doc, feature in zip(docs, features) if feature is None]
+        if missing:
+            cursor = self.mongo_collection.find({"workspace_file_id": {"$in": missing}},
+                                                {"workspace_file_id": 1, "feature": 1, "feature_q": 1, "feature_scale": 1, "feature_quantization": 1})
+            found = {doc["workspace_file_id"]: _doc_feature(doc) for doc in cursor}
+            features = [feature if feature is not None else found.get(doc["workspace_file_id"]) for doc, feature in zip(docs, features)]
+        return features
+
+    def _with_features(self, docs):
+        """
+        (docs, features), 跳过没有特征的文档
+        """
+        pairs = [(doc, feature) for doc, feature in zip(docs, self._features_of(docs)) if feature is not None]
+        return [doc for doc, _ in pairs], [feature for _, feature in pairs]
+
+    def _members(self, id_list):
+        return set() if self.denormalized_membership else (id_list or None)
+
+    def _append_docs(self, dataset: DatasetFeatures, docs):
+        for doc, feature in zip(*self._with_features(docs)):
+            dataset.upsert(doc["workspace_file_id"], feature, doc.get("width", 0), doc.get("height", 0), doc.get("extension"))
+
+    def _load_dataset_features(self, dataset_id):
+        """
+        从 mongo 加载 dataset 的全部特征, 超出 feature cache 内存预算时返回 None
+        """
+        loaded_at = datetime.now()
+        id_list = self._dataset_members(dataset_id)
+        if self.use_shared:
+            return self._attach_shared(dataset_id, id_list)
+        dataset = self._build_dataset_features(dataset_id, id_list)
+        if dataset is not None:
+            dataset.loaded_at = loaded_at
+        return dataset
+
+    def _build_dataset_features(self, dataset_id, id_list):
+        if self.use_shards:
+            dataset = self.shard_store.open(dataset_id, members=self._members(id_list))
+            if dataset is not None:
+                return dataset
+        mongo_query_dict = self._dataset_query(dataset_id, id_list)
+        dataset = self._new_dataset_features(dataset_id, id_list, self.mongo_collection.count_documents(mongo_query_dict))
+        if dataset is None:
+            return None
+        cursor = self.mongo_collection.find(mongo_query_dict, _feature_projection())
+        self._append_docs(dataset, cursor)
+        return dataset
+
+    async def _load_dataset_features_async(self, dataset_id):
+        """
+        _load_dataset_features 的 async 版本, 按 chunk 读取 cursor, 解析放到线程池
+        """
+        loaded_at = datetime.now()
+        id_list = await self._dataset_members_async(dataset_id)
+        if self.use_shared:
+            return await self._run_in_executor(self._attach_shared, dataset_id, id_list)
+        if self.use_shards:
+            dataset = await self._run_in_executor(self.shard_store.open, dataset_id, self._members(id_list))
+            if dataset is not None:
+                dataset.loaded_at = loaded_at
+                return dataset
+        mongo_query_dict = self._dataset_query(dataset_id, id_list)
+        dataset = self._new_dataset_features(dataset_id, id_list, await self.async_mongo_collection.count_documents(mongo_query_dict))
+        if dataset is None:
+            return None
+        cursor = self.async_mongo_collection.find(mongo_query_dict, _feature_projection()).batch_size(self._MAX_SPLIT_SIZE)
+        while True:
+            docs = await cursor.to_list(length=self._MAX_SPLIT_SIZE)
+            if not docs:
+                break
+            await self._run_in_executor(self._append_docs, dataset, docs)
+        dataset.loaded_at = loaded_at
+        return dataset
+
+    def _attach_shared(self, dataset_id, id_list):
+        """
+        只读打开共享存储中 dataset 的当前版本; 还没有发布时 loader 进程直接物化,
+        其它 worker 请求 loader 物化, 期间走 mongo 扫描
+        """
+        dataset = self.shared_store.attach(dataset_id, members=self._members(id_list))
+        if dataset is not None:
+            return dataset
+        if self.shared_store.is_loader:
+            if self._publish_shared(dataset_id, id_list):
+                return self.shared_store.attach(dataset_id, members=self._members(id_list))
+            return None
+        self.shared_store.request(dataset_id)
+        return None
+
+    def _publish_shared(self, dataset_id, id_list=None):
+        with self._shared_publish_lock:
+            dataset = self._build_dataset_features(dataset_id, id_list if id_list is not None else self._dataset_members(dataset_id))
+            if dataset is None:
+                return False
+            self._publish_and_index(dataset)
+            return True
+
+    def _publish_shared_delta(self, dataset_id, changed_ids):
+        """
+        只从 mongo 读取变更的 id, 与当前发布的版本合并后发布新版本; 无法合并时 (没有当前版本 / 精排需要的
+        float32 特征 / 查询归属关系失败 / 特征只在分片中) 返回 False, 由调用方完整物化
+        """
+        with self._shared_publish_lock:
+            base = self.shared_store.attach(dataset_id)
+            if base is None or (self._exact_dir() is not None and not base.has_exact):
+                return False
+            changed_ids = sorted(changed_ids)
+            docs = list(self.mongo_collection.find({"workspace_file_id": {"$in": changed_ids}}, _feature_projection(status=1, dataset_ids=1)))
+            if self.denormalized_membership:
+                members = {doc["workspace_file_id"] for doc in docs if dataset_id in (doc.get("dataset_ids") or [])}
+            else:
+                membership = dataset_files_service.find_dataset_membership(changed_ids)
+                if membership is None:
+                    return False
+                members = {workspace_file_id for workspace_file_id, dataset_ids in membership.items() if dataset_id in dataset_ids}
+            upserts = [(doc, feature) for doc, feature in zip(docs, self._features_of(docs))
+                       if _is_active(doc) and doc["workspace_file_id"] in members]
+            if any(feature is None for _, feature in upserts):
+                return False
+            # 变更的 id 先从当前版本中去掉, 仍然有效的再按 mongo 中的最新特征写入
+            keep = np.flatnonzero(~np.isin(base.ids, np.asarray(changed_ids, dtype=np.int64)))
+            dataset = self._new_dataset_features(dataset_id, None, len(keep) + len(upserts))
+            if dataset is None:
+                return False
+            dataset.append_rows(base, keep)
+            for doc, feature in upserts:
+                dataset.upsert(doc["workspace_file_id"], feature, doc.get("width", 0), doc.get("height", 0), doc.get("extension"))
+            self._publish_and_index(dataset)
+            logger.info(f"shared features of dataset {dataset_id}: {len(changed_ids)} changed ids merged")
+            return True
+
+    def _publish_and_index(self, dataset: DatasetFeatures):
+        self.shared_store.publish(dataset)
+        # 发布后在后台构建 / 更新索引文件, 其它 worker 检索时加载
+        published = self.shared_store.attach(dataset.dataset_id, members=dataset.members)
+        if published is not None:
+            self.index_manager.get(published)
+
+    def _is_shared_stale(self, dataset: DatasetFeatures):
+        return dataset.version is not None and dataset.version != self.shared_store.latest_version(dataset.dataset_id)
+
+    def _shared_loader_loop(self):
+        """
+        loader 进程中定期物化被请求 / 有新写入的 dataset; 其它进程定期尝试接管 loader 锁
+        """
+        while not self._shared_stop.wait(settings.shared_store_poll_interval):
+            try:
+                if not self.shared_store.try_acquire_loader():
+                    continue
+                for dataset_id, changed_ids in self.shared_store.take_pending():
+                    if changed_ids is None or not self._publish_shared_delta(dataset_id, changed_ids):
+                        self._publish_shared(dataset_id)
+            except Exception as e:
+                logger.error(f"Error publishing shared features: {e}")
+
+    def _search_resident(self, dataset: DatasetFeatures, query_feature, topn, search_filter_options, search_params):
+        query_feature = normalize_rows(query_feature).reshape(-1)
+        with span("filter"):
+            mask = dataset.get_mask(search_filter_options)
+        index = self.index_manager.get(dataset)
+        # 量化矩阵上先取 topn * rerank-factor 个候选, 再用常驻的 float32 特征精排
+        rerank = self._reranks(dataset)
+        with span("search"), self.score_slots.slot():
+            top_n_rows, top_n_score = index.search(query_feature, topn * settings.rerank_factor if rerank else topn, mask=mask, **search_params)
+        if rerank:
+            with span("rerank"):
+                top_n_rows, top_n_score = self._rerank_rows(dataset, query_feature.reshape(1, -1), [(top_n_rows, top_n_score)], topn)[0]
+        return self._rows_to_ids(dataset, top_n_rows, top_n_score)
+
+    @staticmethod
+    def _rows_to_ids(dataset: DatasetFeatures, rows, scores):
+        """
+        检索结果的行号换算为 workspace_file_id; ids 在检索之后读取, 检索期间追加的行也在其中
+        """
+        ids = dataset.ids
+        return ([int(ids[row]) for row in rows if row < len(ids)],
+                [float(score) for row, score in zip(rows, scores) if row < len(ids)])
+
+    @staticmethod
+    def _reranks(dataset: DatasetFeatures):
+        """
+        量化的 dataset 有 float32 特征时精排; 分片中只有量化数据, 不精排
+        """
+        return dataset.quantization != "none" and settings.rerank_factor > 1 and dataset.has_exact
+
+    @staticmethod
+    def _rerank_rows(dataset: DatasetFeatures, query_features, searched, topn):
+        """
+        用常驻的 float32 特征重新计算每个 query 候选行的分数, 返回每个 query 的 topn 个 (rows, scores)
+        """
+        reranked = []
+        for query_feature, (rows, _) in zip(query_features, searched):
+            rows = np.asarray(rows, dtype=np.int64)
+            if len(rows) == 0:
+                reranked.append((rows, np.empty(0, dtype=np.float32)))
+                continue
+            scores = dataset.exact_vectors(rows) @ query_feature
+            top = topk(scores, topn)
+            reranked.append((rows[top], scores[top]))
+        return reranked
+
+    def _search_resident_many(self, dataset: DatasetFeatures, query_features, topn, search_filter_options, search_params):
+        """
+        _search_resident 的多 query 版本, 暴力检索时所有 query 共用一次矩阵乘
+        """
+        query_features = normalize_rows(query_features)
+        with span("filter"):
+            mask = dataset.get_mask(search_filter_options)
+        index = self.index_manager.get(dataset)
+        rerank = self._reranks(dataset)
+        with span("search"), self.score_slots.slot():
+            searched = index.search_many(query_features, topn * settings.rerank_factor if rerank else topn, mask=mask, **search_params)
+        if rerank:
+            with span("rerank"):
+                searched = self._rerank_rows(dataset, query_features, searched, topn)
+        return [self._rows_to_ids(dataset, rows, scores) for rows, scores in searched]
+
+    def _score_chunk(self, query_feature, docs, topn):
+        """
+        对一个 chunk 打分, 只返回其中 topn 个候选 (scores, ids), 峰值内存为 O(chunk + topn)
+        """
+        metrics.inc("clip_search_vectors_scanned_total", len(docs), help="feature vectors scored", path="mongo")
+        with span("score"):
+            docs, features = self._with_features(docs)
+            if not docs:
+                return np.empty(0, dtype=np.float32), []
+            feature_list = np.array(features)
+            filename_list = [doc["workspace_file_id"] for doc in docs]
+            sim_score = cosine_similarity(query_feature, feature_list)
+        with span("topk"):
+            top = topk(sim_score, topn)
+            return sim_score[top], [filename_list[idx] for idx in top]
+
+    def _submit_chunk(self, scorer, query_feature, docs, topn):
+        if scorer.pool is None:
+            future = Future()
+            future.set_result(self._score_chunk(query_feature, docs, topn))
+            return future
+        return scorer.pool.submit(contextvars.copy_context().run, self._score_chunk, query_feature, docs, topn)
+
+    def _score_chunk_many(self, query_features, docs, topn):
+        """
+        多个 query 对同一个 chunk 打分, 返回每个 query 的 topn 个候选 (scores, ids)
+        """
+        metrics.inc("clip_search_vectors_scanned_total", len(docs) * len(query_features), help="feature vectors scored", path="mongo")
+        with span("score"):
+            docs, features = self._with_features(docs)
+            if not docs:
+                return [(np.empty(0, dtype=np.float32), []) for _ in range(len(query_features))]
+            feature_list = normalize_rows(np.array(features))
+            filename_list = [doc["workspace_file_id"] for doc in docs]
+            sim_score = feature_list @ query_features.T
+        results = []
+        with span("topk"):
+            for q in range(len(query_features)):
+                top = topk(sim_score[:, q], topn)
+                results.append((sim_score[top, q], [filename_list[idx] for idx in top]))
+        return results
+
+    @staticmethod
+    def _sorted_heap(top_n_heap):
+        top_n = sorted(top_n_heap, reverse=True)
+        top_n_filename = [filename for _, filename in top_n]
+        top_n_score = [score for score, _ in top_n]
+        return top_n_filename, top_n_score
+
+    def search_nearest_clip_feature(self, query_feature, dataset_id, topn=20, search_filter_options={}, search_params=None):
+        logger.info(f"search_filter_options: {search_filter_options}")
+        search_params = {k: v for k, v in (search_params or {}).items() if v is not None}
         try:
-            for doc in cursor:  
-                feature_list.append(np.frombuffer(doc["feature"], settings.storage_type))
-                ## 打印feature_list的长度 
-                filename_list.append(doc["workspace_file_id"])
-                if len(feature_list) >= self._MAX_SPLIT_SIZE:
-                    feature_list = np.array(feature_list)
-                    sim_score_list.append(cosine_similarity(query_feature, feature_list))
-                    feature_list = []
-            if len(feature_list) > 0:
-                feature_list = np.array(feature_list)
-                sim_score_list.append(cosine_similarity(query_feature, feature_list))
-            if len(sim_score_list) == 0:
-                return [], []
-            sim_score = np.concatenate(sim_score_list, axis=0)
-            top_n_idx = np.argsort(sim_score)[::-1][:topn]
-            top_n_filename = [filename_list[idx] for idx in top_n_idx]
-            top_n_score = [float(sim_score[idx]) for idx in top_n_idx]
+            with span("feature_cache"):
+                dataset = self.feature_cache.get(dataset_id)
+            if dataset is not None:
+                return self._search_resident(dataset, query_feature, topn, search_filter_options, search_params)
         except Exception as e:
             logger.error(f"Error searching image: {e}")
             return [], []
 
-        return top_n_filename, top_n_score
-    
+        # dataset 超出 feature cache 预算, 退回到逐块扫描 mongo
+        mongo_query_dict = self._dataset_query(dataset_id, self._dataset_members(dataset_id), search_filter_options)
+        cursor = self.mongo_collection.find(mongo_query_dict, _feature_projection())
+        query_feature = normalize_rows(query_feature)
+        docs = []
+        top_n_heap = []
+        # 打分交给 score 线程池, 与游标读取下一个 chunk 重叠; 同时在途的 chunk 数不超过线程数
+        scorer = get_scorer()
+        pending = deque()
+        try:
+            for doc in timed_iter(cursor, "mongo_cursor"):  
+                docs.append(doc)
+                if len(docs) >= self._MAX_SPLIT_SIZE:
+                    pending.append(self._submit_chunk(scorer, query_feature, docs, topn))
+                    docs = []
+                    while len(pending) > scorer.threads:
+                        merge_topk(top_n_heap, *pending.popleft().result(), topn)
+            if len(docs) > 0:
+                pending.append(self._submit_chunk(scorer, query_feature, docs, topn))
+            while pending:
+                merge_topk(top_n_heap, *pending.popleft().result(), topn)
+        except Exception as e:
+            logger.error(f"Error searching image: {e}")
+            return [], []
+
+        return self._sorted_heap(top_n_heap)
+
+    async def search_nearest_clip_feature_async(self, query_feature, dataset_id, topn=20, search_filter_options={}, search_params=None):
+        """
+        search_nearest_clip_feature 的 async 版本: mongo 读取走 motor, 打分在线程池中执行
+        """
+        logger.info(f"search_filter_options: {search_filter_options}")
+        search_params = {k: v for k, v in (search_params or {}).items() if v is not None}
+        try:
+            with span("feature_cache"):
+                dataset = await self.feature_cache.get_async(dataset_id)
+            if dataset is not None:
+                return await self._run_in_executor(self._search_resident, dataset, query_feature, topn, search_filter_options, search_params)
+
+            mongo_query_dict = self._dataset_query(dataset_id, await self._dataset_members_async(dataset_id), search_filter_options)
+            cursor = self.async_mongo_collection.find(mongo_query_dict, _feature_projection()).batch_size(self._MAX_SPLIT_SIZE)
+            query_feature = normalize_rows(query_feature)
+            top_n_heap = []
+            while True:
+                with span("mongo_cursor"):
+                    docs = await cursor.to_list(length=self._MAX_SPLIT_SIZE)
+                if not docs:
+                    break
+                merge_topk(top_n_heap, *await self._run_in_executor(self._score_chunk, query_feature, docs, topn), topn)
+        except Exception as e:
+            logger.error(f"Error searching image: {e}")
+            return [], []
+
+        return self._sorted_heap(top_n_heap)
+
+    async def search_nearest_clip_features_async(self, query_features, dataset_id, topn=20, search_filter_options={}, search_params=None):
+        """
+        多个 query 对同一个 dataset 检索, 数据只读取/扫描一次; 返回每个 query 的 (filename_list, score_list)
+        """
+        logger.info(f"search_filter_options: {search_filter_options}, queries: {len(query_features)}")
+        search_params = {k: v for k, v in (search_params or {}).items() if v is not None}
+        try:
+            with span("feature_cache"):
+                dataset = await self.feature_cache.get_async(dataset_id)
+            if dataset is not None:
+                return await self._run_in_executor(self._search_resident_many, dataset, query_features, topn, search_filter_options, search_params)
+
+            mongo_query_dict = self._dataset_query(dataset_id, await self._dataset_members_async(dataset_id), search_filter_options)
+            cursor = self.async_mongo_collection.find(mongo_query_dict, _feature_projection()).batch_size(self._MAX_SPLIT_SIZE)
+            query_features = normalize_rows(query_features)
+            top_n_heaps = [[] for _ in range(len(query_features))]
+            while True:
+                with span("mongo_cursor"):
+                    docs = await cursor.to_list(length=self._MAX_SPLIT_SIZE)
+                if not docs:
+                    break
+                chunk_results = await self._run_in_executor(self._score_chunk_many, query_features, docs, topn)
+                for top_n_heap, (scores, filenames) in zip(top_n_heaps, chunk_results):
+                    merge_topk(top_n_heap, scores, filenames, topn)
+        except Exception as e:
+            logger.error(f"Error searching image: {e}")
+            return [([], []) for _ in range(len(query_features))]
+
+        return [self._sorted_heap(top_n_heap) for top_n_heap in top_n_heaps]
+
+    def _embedding_cache_key(self, query, image_digest=None):
+        if isinstance(query, str):
+            # CLIP tokenizer 本身会转小写并合并空白, 归一化后不影响编码结果
+            return ("text", settings.clip_model, " ".join(query.lower().split()))
+        if image_digest is not None:
+            return ("image", settings.clip_model, image_digest)
+        return None
+
+    def encode_query(self, query, image_digest=None):
+        """
+        编码 text / image query, 重复的 query 直接命中 embedding cache
+
+        image_digest 为 query 图片原始字节的 md5, 为空时图片 query 不走缓存
+        """
+        key = self._embedding_cache_key(query, image_digest)
+        if key is not None:
+            feature = self.embedding_cache.get(key)
+            if feature is not None:
+                return feature
+        feature = self._encode_query(query)
+        if key is not None:
+            self.embedding_cache.put(key, feature)
+        return feature
+
+    async def encode_query_async(self, query, image_digest=None):
+        """
+        encode_query 的 async 版本, 开启 batcher 时直接等待 batcher 的 future, 不占用线程池
+        """
+        key = self._embedding_cache_key(query, image_digest)
+        if key is not None:
+            feature = self.embedding_cache.get(key)
+            if feature is not None:
+                return feature
+        feature = await self._encode_query_async(query)
+        if key is not None:
+            self.embedding_cache.put(key, feature)
+        return feature
+
+    async def _encode_query_async(self, query):
+        """
+        不经过 embedding cache 编码 query
+        """
+        if self.batcher is not None and isinstance(query, (str, Image.Image)):
+            kind = EmbeddingBatcher.TEXT if isinstance(query, str) else EmbeddingBatcher.IMAGE
+            return await asyncio.wrap_future(self.batcher.submit(kind, query))
+        return await self._run_in_executor(self._encode_query, query)
+
+    async def _digest_images_async(self, queries, image_digests=None):
+        """
+        原始字节的图片 query 在线程池中计算 md5, 返回与 queries 对齐的 image_digests
+        """
+        image_digests = list(image_digests or [None] * len(queries))
+        raw = [i for i, query in enumerate(queries) if isinstance(query, bytes) and image_digests[i] is None]
+        if raw:
+            digests = await self._run_in_executor(lambda: [calc_bytes_md5(queries[i]) for i in raw])
+            for i, digest in zip(raw, digests):
+                image_digests[i] = digest
+        return image_digests
+
+    def _decode_images(self, image_data_list):
+        return [decode_image(image_data, self.model.input_resolution) for image_data in image_data_list]
 
-    def search_image(self, query, dataset_id, topn, minimum_width, minimum_height, extension_choice):
-        with torch.no_grad():
-            if isinstance(query, str):
-                target_feature = self.model.get_text_feature(query) 
-            elif isinstance(query, Image.Image):
-                image_input = self.model.preprocess(query).unsqueeze(0).to(self.model.device)
-                image_feature = self.model.model.encode_image(image_input) 
-                target_feature = image_feature.detach().cpu().numpy() 
+    async def _encode_image_bytes_async(self, image_data, image_digest):
+        """
+        原始字节的图片 query: 先按 md5 查 embedding cache, 未命中时才在线程池中解码图片再编码
+        """
+        key = self._embedding_cache_key(image_data, image_digest)
+        feature = self.embedding_cache.get(key)
+        if feature is not None:
+            return feature
+        with span("decode"):
+            image = (await self._run_in_executor(self._decode_images, [image_data]))[0]
+        if image is None:
+            raise ValueError("Invalid image")
+        # 已经查过一次缓存, 直接编码, 未命中只计一次
+        feature = await self._encode_query_async(image)
+        self.embedding_cache.put(key, feature)
+        return feature
+
+    async def encode_queries_async(self, queries, image_digests=None):
+        """
+        批量编码多个 text / image query: 未命中 embedding cache 的文本与图片各做一次批量编码
+
+        图片 query 可以是原始字节, 命中 embedding cache 时不再解码, 未命中的在线程池中一起解码.
+        返回与 queries 对齐的 (1, D) 特征列表, 无法解码 / 编码的 query 为 None; 批量编码失败时逐个重新编码,
+        只有出错的 query 为 None
+        """
+        image_digests = await self._digest_images_async(queries, image_digests)
+        keys = [self._embedding_cache_key(query, image_digest) for query, image_digest in zip(queries, image_digests)]
+        features = [self.embedding_cache.get(key) if key is not None else None for key in keys]
+        raw = [i for i, query in enumerate(queries) if features[i] is None and isinstance(query, bytes)]
+        if raw:
+            queries = list(queries)
+            with span("decode"):
+                for i, image in zip(raw, await self._run_in_executor(self._decode_images, [queries[i] for i in raw])):
+                    queries[i] = image
+        texts = [i for i, query in enumerate(queries) if features[i] is None and isinstance(query, str)]
+        images = [i for i, query in enumerate(queries) if features[i] is None and isinstance(query, Image.Image)]
+        if texts:
+            for i, feature in zip(texts, await self._run_in_executor(self._encode_queries, self._encode_texts, [queries[i] for i in texts])):
+                features[i] = feature
+        if images:
+            for i, feature in zip(images, await self._run_in_executor(self._encode_queries, self._encode_images, [queries[i] for i in images])):
+                features[i] = feature
+        for i in texts + images:
+            if keys[i] is not None and features[i] is not None:
+                self.embedding_cache.put(keys[i], features[i])
+        return features
+
+    def _encode_query(self, query):
+        """
+        编码 text / image query, 开启 batcher 时与其它并发请求合并成一个 batch
+        """
+        if isinstance(query, str):
+            if self.batcher is not None:
+                return self.batcher.encode_text(query)
+            with self.encode_slots.slot(INTERACTIVE):
+                return self.model.get_text_feature(query)
+        elif isinstance(query, Image.Image):
+            if self.batcher is not None:
+                return self.batcher.encode_image(query)
+            with self.encode_slots.slot(INTERACTIVE):
+                image_feature, _ = self.model.get_image_feature(query)
+            if image_feature is None:
+                raise ValueError("Invalid image")
+            return image_feature
+        else:
+            assert False, "Invalid query type"
+
+    def _encode_with_slot(self, encode_fn, queries):
+        with self.encode_slots.slot(INTERACTIVE):
+            return encode_fn(queries)
+
+    def _encode_texts(self, texts):
+        feats = self._encode_with_slot(self.model.get_text_features, texts)
+        return [feats[row:row + 1] for row in range(len(texts))]
+
+    def _encode_images(self, images):
+        feats, image_sizes = self._encode_with_slot(self.model.get_image_features, images)
+        features = []
+        row = 0
+        for image_size in image_sizes:
+            if image_size is None:
+                features.append(None)
             else:
-                assert False, "Invalid query type"
-        
+                features.append(feats[row:row + 1])
+                row += 1
+        return features
+
+    def _encode_queries(self, encode_fn, queries):
+        """
+        批量编码, 失败时逐个重新编码, 出错的 query 为 None
+        """
+        try:
+            return encode_fn(queries)
+        except Exception as e:
+            if len(queries) == 1:
+                logger.error(f"Error encoding query: {e}")
+                return [None]
+            logger.warning(f"Error encoding query batch of {len(queries)}, retrying one by one: {e}")
+            return [self._encode_queries(encode_fn, [query])[0] for query in queries]
+
+    def _run_in_executor(self, fn, *args):
+        """
+        在线程池中执行, 带上当前的 contextvars, span 能记入当前请求的 Server-Timing
+        """
+        return asyncio.get_running_loop().run_in_executor(self.executor, functools.partial(contextvars.copy_context().run, fn, *args))
+
+    def _register_metrics(self):
+        def cache_counter(attr):
+            return lambda: [({"cache": "embedding"}, getattr(self.embedding_cache, attr)),
+                            ({"cache": "result"}, getattr(self.result_cache, attr))]
+
+        metrics.register_collector("clip_search_cache_hits_total", "counter", cache_counter("hits"), help="query embedding / search result cache hits")
+        metrics.register_collector("clip_search_cache_misses_total", "counter", cache_counter("misses"), help="query embedding / search result cache misses")
+        metrics.register_collector("clip_search_feature_cache_bytes", "gauge", lambda: [({}, self.feature_cache.nbytes)], help="memory used by resident feature matrices")
+        slots = (self.encode_slots, self.score_slots)
+        metrics.register_collector("clip_search_slot_active", "gauge", lambda: [({"slot": s.name}, s.active) for s in slots], help="encode / score operations running")
+        metrics.register_collector("clip_search_slot_waiting", "gauge", lambda: [({"slot": s.name}, sum(s.waiting)) for s in slots], help="encode / score operations waiting for a slot")
+
+    def close(self):
+        if self.batcher is not None:
+            self.batcher.close()
+        self.executor.shutdown(wait=False)
+        self.index_manager.flush()
+        if self.shared_store is not None:
+            self._shared_stop.set()
+            self.shared_store.release_loader()
+
+    def get_dataset_version(self, dataset_id):
+        if self.use_shared:
+            # 其它 worker 写入的特征通过共享存储的新版本生效
+            return (self._dataset_versions.get(dataset_id, 0), self.shared_store.latest_version(dataset_id))
+        return self._dataset_versions.get(dataset_id, 0)
+
+    def bump_dataset_versions(self, dataset_ids):
+        """
+        新特征写入后, 所属 dataset 的版本号加一
+        """
+        if dataset_ids is None:
+            # 查不到归属关系时无法精确失效, 直接清空结果缓存
+            self.result_cache.clear()
+            return
+        with self._versions_lock:
+            for dataset_id in dataset_ids:
+                self._dataset_versions[dataset_id] = self._dataset_versions.get(dataset_id, 0) + 1
+
+    def _result_cache_key(self, query, dataset_id, topn, search_option, search_params, image_digest):
+        key = self._embedding_cache_key(query, image_digest)
+        if key is None:
+            return None
+        extension_choice = search_option["extension_choice"]
+        return (
+            dataset_id,
+            self.get_dataset_version(dataset_id),
+            key,
+            int(search_option["minimum_width"] or 0),
+            int(search_option["minimum_height"] or 0),
+            tuple(sorted(extension_choice)) if extension_choice else None,
+            int(topn),
+            tuple(sorted((k, v) for k, v in (search_params or {}).items() if v is not None)),
+        )
+
+    def search_image(self, query, dataset_id, topn, minimum_width, minimum_height, extension_choice, search_params=None, image_digest=None):
         search_option = {
             "minimum_width": minimum_width,
             "minimum_height": minimum_height,
             "extension_choice": extension_choice,
         }
+        result_key = self._result_cache_key(query, dataset_id, topn, search_option, search_params, image_digest)
+        if result_key is not None:
+            result = self.result_cache.get(result_key)
+            if result is not None:
+                return result
 
-        filename_list, score_list = self.search_nearest_clip_feature(target_feature, dataset_id, topn=int(topn), search_filter_options=search_option)
+        with span("encode"):
+            target_feature = self.encode_query(query, image_digest=image_digest)
+        filename_list, score_list = self.search_nearest_clip_feature(target_feature, dataset_id, topn=int(topn), search_filter_options=search_option, search_params=search_params)
 
-       
+        # 检索出错时 search_nearest_clip_feature 返回空列表, 空结果不缓存
+        if result_key is not None and filename_list:
+            self.result_cache.put(result_key, (filename_list, score_list))
         return filename_list, score_list
     
     
-    def import_image_dir_sync(self, id, image: Image.Image, model: CLIPModel, copy=False):
+    async def search_image_async(self, query, dataset_id, topn, minimum_width, minimum_height, extension_choice, search_params=None, image_digest=None):
+        """
+        search_image 的 async 版本; query 可以是图片的原始字节, md5 与解码都在线程池中执行,
+        命中缓存时不解码图片
+        """
+        search_option = {
+            "minimum_width": minimum_width,
+            "minimum_height": minimum_height,
+            "extension_choice": extension_choice,
+        }
+        if isinstance(query, bytes) and image_digest is None:
+            image_digest = (await self._digest_images_async([query]))[0]
+        result_key = self._result_cache_key(query, dataset_id, topn, search_option, search_params, image_digest)
+        if result_key is not None:
+            result = self.result_cache.get(result_key)
+            if result is not None:
+                return result
+
+        with span("encode"):
+            if isinstance(query, bytes):
+                target_feature = await self._encode_image_bytes_async(query, image_digest)
+            else:
+                target_feature = await self.encode_query_async(query, image_digest=image_digest)
+        filename_list, score_list = await self.search_nearest_clip_feature_async(target_feature, dataset_id, topn=int(topn), search_filter_options=search_option, search_params=search_params)
+
+        if result_key is not None and filename_list:
+            self.result_cache.put(result_key, (filename_list, score_list))
+        return filename_list, score_list
+
+    async def search_batch_async(self, queries, dataset_id, topn, minimum_width, minimum_height, extension_choice, search_params=None, image_digests=None):
+        """
+        多个 query 共用 dataset_id 与过滤条件: 批量编码, 一次矩阵乘打分, 返回每个 query 的 topn
+
+        图片 query 可以是原始字节, 见 encode_queries_async. 返回与 queries 对齐的 (filename_list, score_list),
+        无法解码 / 编码的 query 为 None
+        """
+        search_option = {
+            "minimum_width": minimum_width,
+            "minimum_height": minimum_height,
+            "extension_choice": extension_choice,
+        }
+        image_digests = await self._digest_images_async(queries, image_digests)
+        result_keys = [self._result_cache_key(query, dataset_id, topn, search_option, search_params, image_digest)
+                       for query, image_digest in zip(queries, image_digests)]
+        results = [self.result_cache.get(key) if key is not None else None for key in result_keys]
+        pending = [i for i, result in enumerate(results) if result is None and queries[i] is not None]
+        if not pending:
+            return results
+
+        metrics.observe("clip_search_batch_size", len(pending), help="number of items per batch", kind="search_batch")
+        with span("encode"):
+            features = await self.encode_queries_async([queries[i] for i in pending], [image_digests[i] for i in pending])
+        encoded = [(i, feature) for i, feature in zip(pending, features) if feature is not None]
+        if not encoded:
+            return results
+        searched = await self.search_nearest_clip_features_async(
+            np.concatenate([feature for _, feature in encoded]), dataset_id, topn=int(topn),
+            search_filter_options=search_option, search_params=search_params)
+        for (i, _), (filename_list, score_list) in zip(encoded, searched):
+            results[i] = (filename_list, score_list)
+            if result_keys[i] is not None and filename_list:
+                self.result_cache.put(result_keys[i], results[i])
+        return results
+
+    def import_image_dir_sync(self, id, image: Image.Image, model: "CLIPModel", copy=False, extension=None):
         logger.info(f"Importing image: {image}")
-        
-        image_feature, image_size = model.get_image_feature(image)
-        logger.info(f"Image size: {image_size}")
-        if image_feature is None:
+        imported = self.import_image_batch_sync([id], [image], model, copy, extensions=[extension])
+        if len(imported) == 0:
             logger.info(f"skip file: {image}")
             return
-        # 这里可以添加将图像特征保存到数据库的逻辑
-        document = {
-            "workspace_file_id": id,
-            "height": image_size[0],
-            "width": image_size[1],
-            "feature": image_feature.tobytes(),  
-            "status":1,
-            "created_time": datetime.now(),
-        }
-        self.mongo_collection.insert_one(document)
-        logger.info(f"Image imported: {id}")
         return id
-    
 
-    async def import_image_dir(self, id_list, base64_str_list, model: CLIPModel, copy=False):
-        loop = asyncio.get_event_loop()
-        with ThreadPoolExecutor() as pool:
-            tasks = []
-            for id, base64_str in zip(id_list, base64_str_list):
-                # file_path = os.path.join(settings.root_path, file_path)
-                tasks.append(loop.run_in_executor(pool, self.import_image_dir_sync, id, base64_str, model, copy))
-            results = await asyncio.gather(*tasks)
-        return results
+    def import_image_batch_sync(self, id_list, images, model: "CLIPModel", copy=False, extensions=None):
+        """
+        一个 micro-batch 的导入: 批量提取特征后用一次 bulk_write 写入, 返回成功导入的 id
+
+        extensions 为由文件头识别的类型 (get_file_types), 缺失时使用 PIL 解析出的 image.format
+        """
+        with span("import_encode"), self.encode_slots.slot(BULK):
+            image_features, image_sizes = model.get_image_features(images)
+        extensions = extensions or [None] * len(id_list)
+        decoded = [(id, image_size, extension or image_extension(image))
+                   for id, image, image_size, extension in zip(id_list, images, image_sizes, extensions) if image_size is not None]
+        imported = self.write_image_features([id for id, _, _ in decoded], image_features,
+                                             [image_size for _, image_size, _ in decoded],
+                                             [extension for _, _, extension in decoded])
+        logger.info(f"Images imported: {len(imported)}/{len(id_list)}")
+        return imported
+
+    def write_image_features(self, id_list, image_features, image_sizes, extensions):
+        """
+        写入已经提取好的特征: 一次 bulk_write, 并同步 feature cache / 索引 / dataset 版本号
+
+        image_features 的第 i 行对应 id_list[i], image_sizes 为原图的 image.size. 返回写入的 id
+        """
+        metrics.observe("clip_search_batch_size", len(id_list), help="number of items per batch", kind="import")
+        with span("import_write"):
+            return self._write_image_features(id_list, image_features, image_sizes, extensions)
+
+    def _write_image_features(self, id_list, image_features, image_sizes, extensions):
+        documents = []
+        for id, image_feature, image_size, extension in zip(id_list, image_features, image_sizes, extensions):
+            documents.append({
+                "workspace_file_id": id,
+                "height": image_size[0],
+                "width": image_size[1],
+                "extension": extension,
+                "feature": image_feature.tobytes(),  
+                "status":1,
+                "created_time": datetime.now(),
+            })
+            if _reads_quantized():
+                # 精排或不量化时加载读取 float32 后在本地量化, 不需要量化副本
+                documents[-1].update(quantized_document_fields(image_feature, settings.feature_quantization))
+        if len(documents) == 0:
+            return []
+        imported = [document["workspace_file_id"] for document in documents]
+        # dataset 归属关系冗余写入特征文档, 查询失败时不覆盖已有的 dataset_ids
+        membership = dataset_files_service.find_dataset_membership(imported)
+        if membership is not None:
+            for document in documents:
+                document["dataset_ids"] = membership.get(document["workspace_file_id"], [])
+        if self.use_shards and membership is not None:
+            self._append_shards(documents, image_features)
+        self.write_documents(documents)
+        dataset_ids = None if membership is None else {dataset_id for ids in membership.values() for dataset_id in ids}
+        if self.use_shared:
+            # 共享矩阵是只读的, 由 loader 合并变更的 id 后所有 worker 切换到新版本
+            self.shared_store.mark_dirty(dataset_ids, imported)
+        else:
+            for document, image_feature in zip(documents, image_features):
+                self.feature_cache.add_feature(document["workspace_file_id"], image_feature, document["width"], document["height"], document.get("dataset_ids"), document["extension"])
+                self.index_manager.add_feature(document["workspace_file_id"], image_feature, document.get("dataset_ids"))
+        self.bump_dataset_versions(dataset_ids)
+        return imported
+
+    def apply_changes(self, docs):
+        """
+        把其它实例 / 外部任务写入 search_datas 的变更同步到常驻 dataset (IncrementalSync 调用)
+
+        有效文档追加或覆盖原来的行并插入已加载的索引, 已删除的文档记为墓碑; 向量只在分片中的文档
+        (feature-store 为 shard 时由其它实例写入) 使包含它的常驻 dataset 重新打开分片.
+        shared 模式下只标记 dirty, 由 loader 重新物化. 返回同步的文档数
+        """
+        if not docs:
+            return 0
+        if self.denormalized_membership:
+            membership = {doc["workspace_file_id"]: doc.get("dataset_ids") or [] for doc in docs}
+        else:
+            membership = dataset_files_service.find_dataset_membership([doc["workspace_file_id"] for doc in docs])
+        dataset_ids = None if membership is None else {dataset_id for ids in membership.values() for dataset_id in ids}
+        if self.use_shared:
+            self.shared_store.mark_dirty(dataset_ids, [doc["workspace_file_id"] for doc in docs])
+            self.bump_dataset_versions(dataset_ids)
+            return len(docs)
+        reopen = set()
+        shard_deletes = {}
+        for doc, feature in zip(docs, self._features_of(docs)):
+            workspace_file_id = doc["workspace_file_id"]
+            doc_dataset_ids = membership.get(workspace_file_id, []) if membership is not None else None
+            if not _is_active(doc):
+                self.feature_cache.remove_feature(workspace_file_id, doc_dataset_ids)
+                for dataset_id in doc_dataset_ids or []:
+                    shard_deletes.setdefault(dataset_id, []).append(workspace_file_id)
+            elif feature is not None:
+                self.feature_cache.add_feature(workspace_file_id, feature, doc.get("width", 0), doc.get("height", 0), doc_dataset_ids, doc.get("extension"))
+                self.index_manager.add_feature(workspace_file_id, feature, doc_dataset_ids)
+            else:
+                reopen.update(dataset.dataset_id for dataset in self.feature_cache.datasets() if dataset.accepts(workspace_file_id, doc_dataset_ids))
+        if self.use_shards:
+            # 删除标记写入分片, 重新打开 / compact 后仍然生效
+            for dataset_id, id_list in shard_deletes.items():
+                self.shard_store.delete(dataset_id, id_list)
+        for dataset_id in reopen:
+            self.feature_cache.invalidate(dataset_id)
+        self._reload_tombstoned()
+        self.bump_dataset_versions(dataset_ids)
+        return len(docs)
+
+    def apply_membership_changes(self, docs):
+        """
+        把 dataset_files 中新增 / 删除 (status 不为 1) 的归属关系同步到常驻 dataset, 返回同步的文档数
+
+        dataset-membership 为 denormalized 时同时把变更写回特征文档的 dataset_ids, 之后加载 dataset 与
+        按 dataset_ids 过滤的查询立即生效
+        """
+        if not docs:
+            return 0
+        added, removed = {}, {}
+        for doc in docs:
+            (added if _is_active(doc) else removed).setdefault(doc["dataset_id"], []).append(doc["workspace_file_id"])
+        if self.denormalized_membership:
+            self._write_membership(docs)
+        if self.use_shared:
+            for dataset_id in set(added) | set(removed):
+                self.shared_store.mark_dirty([dataset_id], added.get(dataset_id, []) + removed.get(dataset_id, []))
+            self.bump_dataset_versions(set(added) | set(removed))
+            return len(docs)
+        resident = {dataset.dataset_id: dataset for dataset in self.feature_cache.datasets()}
+        for dataset_id, id_list in removed.items():
+            if self.use_shards:
+                self.shard_store.delete(dataset_id, id_list)
+            if dataset_id in resident:
+                for workspace_file_id in id_list:
+                    resident[dataset_id].delete(workspace_file_id, remove_member=True)
+        for dataset_id, id_list in added.items():
+            if dataset_id not in resident:
+                continue
+            member_docs = list(self.mongo_collection.find({"workspace_file_id": {"$in": id_list}, "status": {"$in": _ACTIVE_STATUS}}, _feature_projection()))
+            for doc, feature in zip(member_docs, self._features_of(member_docs)):
+                if feature is None:
+                    self.feature_cache.invalidate(dataset_id)
+                    break
+                self.feature_cache.add_feature(doc["workspace_file_id"], feature, doc.get("width", 0), doc.get("height", 0), [dataset_id], doc.get("extension"))
+                self.index_manager.add_feature(doc["workspace_file_id"], feature, [dataset_id])
+        self._reload_tombstoned()
+        self.bump_dataset_versions(set(added) | set(removed))
+        return len(docs)
+
+    def _write_membership(self, docs):
+        """
+        归属关系按文档顺序 $addToSet / $pull 到特征文档的 dataset_ids, 同一批中先加入后删除的以最后一次为准
+        """
+        requests = [UpdateMany({"workspace_file_id": doc["workspace_file_id"]},
+                               {"$addToSet": {"dataset_ids": doc["dataset_id"]}} if _is_active(doc) else {"$pull": {"dataset_ids": doc["dataset_id"]}})
+                    for doc in docs]
+        result = self.mongo_collection.bulk_write(requests, ordered=True)
+        logger.info(f"dataset_ids of {result.modified_count} feature documents updated")
+
+    def _reload_tombstoned(self):
+        """
+        墓碑过多的 dataset 从 feature cache 中移除, 下一次检索时重新加载 (mongo 查询与分片都会跳过已删除的行)
+        """
+        for dataset in self.feature_cache.datasets():
+            if dataset.tombstones > len(dataset) * _TOMBSTONE_RELOAD_RATIO:
+                logger.info(f"dataset {dataset.dataset_id} has {dataset.tombstones} deleted vectors, reloading")
+                self.feature_cache.invalidate(dataset.dataset_id)
+
+    def _append_shards(self, documents, image_features):
+        """
+        特征追加到所属 dataset 的分片; mongo 中的文档保留 float32 特征, 之后加入还没有分片的 dataset 时仍然可以读取
+        """
+        rows_by_dataset = {}
+        for row, document in enumerate(documents):
+            for dataset_id in document["dataset_ids"]:
+                rows_by_dataset.setdefault(dataset_id, []).append(row)
+        has_shards = {dataset_id: self.shard_store.exists(dataset_id) for dataset_id in rows_by_dataset}
+        for dataset_id, rows in rows_by_dataset.items():
+            if not has_shards[dataset_id]:
+                # 还没有 export 过的 dataset 只写 mongo, 避免分片中只有部分数据
+                continue
+            self.shard_store.append(dataset_id,
+                                    [documents[row]["workspace_file_id"] for row in rows],
+                                    image_features[rows],
+                                    [documents[row]["width"] for row in rows],
+                                    [documents[row]["height"] for row in rows],
+                                    [documents[row]["extension"] for row in rows])
+
+    def export_dataset_shards(self, dataset_id):
+        """
+        从 mongo 导出 dataset 的特征, 重建分片
+        """
+        mongo_query_dict = self._dataset_query(dataset_id, self._dataset_members(dataset_id))
+        # 分片按 feature-quantization 重新量化, 没有量化副本的文档使用 float32 特征
+        cursor = self.mongo_collection.find(mongo_query_dict, _feature_projection(feature=1))
+        rows = self.shard_store.export(dataset_id, cursor, _doc_feature)
+        self.feature_cache.invalidate(dataset_id)
+        return rows
+
+    def write_documents(self, documents):
+        """
+        按 workspace_file_id 无序 upsert, 重复导入同一张图片只会覆盖原来的特征
+        """
+        requests = [UpdateOne({"workspace_file_id": document["workspace_file_id"]}, {"$set": document}, upsert=True)
+                    for document in documents]
+        try:
+            self.mongo_collection.bulk_write(requests, ordered=False)
+        except BulkWriteError as e:
+            # 并发 upsert 同一个 workspace_file_id 时唯一索引拒绝其中一个插入, 重试时会更新已经插入的文档
+            errors = e.details.get("writeErrors", [])
+            if any(error.get("code") != 11000 for error in errors):
+                raise
+            self.mongo_collection.bulk_write([requests[error["index"]] for error in errors], ordered=False)
+
+    def find_imported_ids(self, id_list):
+        """
+        返回 id_list 中已经有特征的 workspace_file_id
+        """
+        return set(self.mongo_collection.distinct("workspace_file_id", {"workspace_file_id": {"$in": list(id_list)}}))
 
     # def _import_image_dir_sync(self, data_url, model, copy):
     #     try:
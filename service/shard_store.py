@@ -0,0 +1,263 @@
+import os
+import json
+import fcntl
+import threading
+from contextlib import contextmanager
+import numpy as np
+from utils.logger import logger
+from models.model_utils import QUANTIZATION_DTYPES, quantize, extension_code
+from service.feature_cache import DatasetFeatures, normalize_rows
+
+
+class ShardStore:
+    """
+    按 dataset 保存在磁盘上的特征分片, 以 np.memmap 打开, 检索直接读 page cache
+
+    每个 dataset 一个目录, 分片为只追加的原始文件:
+        shard_00000.vec    归一化 (并按 quantization 量化) 后的特征, (rows, dim)
+        shard_00000.ids    int64 workspace_file_id
+        shard_00000.wh     uint16 (width, height)
+        shard_00000.ext    uint8 extension 编码
+        shard_00000.scale  float32, 仅 int8
+        manifest.json      维度 / 量化方式 / 每个分片的有效行数 / 删除标记
+        manifest.lock      fcntl 排它锁, 多个进程修改 manifest 时串行化
+    mongo 中仍保留 float32 特征 (还没有分片的 dataset / export 时使用). manifest 中的行数是唯一可信的
+    长度, 写了一半的追加会在下一次追加前截断. 同一个 id 追加多次时以最后一行为准, compact 时去掉旧行.
+    """
+
+    _SUFFIXES = ("vec", "ids", "wh", "ext", "scale")
+    # 分片文件格式版本, 格式变化后需要重新 export
+    _FORMAT = 2
+
+    def __init__(self, root_dir: str, feat_dim: int, quantization: str = "none", shard_rows: int = 1000000):
+        self.root_dir = root_dir
+        self.feat_dim = feat_dim
+        self.quantization = quantization
+        self.shard_rows = shard_rows
+        self._lock = threading.Lock()
+
+    def dataset_dir(self, dataset_id):
+        return os.path.join(self.root_dir, str(dataset_id))
+
+    def _manifest_path(self, dataset_id):
+        return os.path.join(self.dataset_dir(dataset_id), "manifest.json")
+
+    def _shard_path(self, dataset_id, name, suffix):
+        return os.path.join(self.dataset_dir(dataset_id), f"{name}.{suffix}")
+
+    @contextmanager
+    def _locked(self, dataset_id):
+        """
+        进程内的锁 + dataset 目录下的文件锁, 其它进程的 append / delete / compact 不会覆盖 manifest
+        """
+        with self._lock:
+            os.makedirs(self.dataset_dir(dataset_id), exist_ok=True)
+            with open(os.path.join(self.dataset_dir(dataset_id), "manifest.lock"), "a") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def exists(self, dataset_id):
+        return os.path.exists(self._manifest_path(dataset_id))
+
+    def read_manifest(self, dataset_id):
+        if not self.exists(dataset_id):
+            return None
+        with open(self._manifest_path(dataset_id), "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def _write_manifest(self, dataset_id, manifest):
+        path = self._manifest_path(dataset_id)
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(manifest, f)
+        os.replace(path + ".tmp", path)
+
+    def _new_manifest(self):
+        return {"format": self._FORMAT, "dim": self.feat_dim, "quantization": self.quantization, "shards": [], "tombstones": []}
+
+    def _row_shapes(self, manifest):
+        dtype = QUANTIZATION_DTYPES[manifest["quantization"]]
+        return {
+            "vec": (dtype, (manifest["dim"],)),
+            "ids": (np.int64, ()),
+            "wh": (np.uint16, (2,)),
+            "ext": (np.uint8, ()),
+            "scale": (np.float32, ()),
+        }
+
+    @staticmethod
+    def _next_shard_name(manifest):
+        """
+        新分片的名字, 序号只增不减; compact 之后分片列表的长度可能与已有分片的序号重复
+        """
+        index = max([int(shard["name"].split("_")[1]) for shard in manifest["shards"]] + [manifest.get("next_shard", 0) - 1]) + 1
+        manifest["next_shard"] = index + 1
+        return f"shard_{index:05d}"
+
+    def _suffixes(self, manifest):
+        return self._SUFFIXES if manifest["quantization"] == "int8" else self._SUFFIXES[:4]
+
+    def append(self, dataset_id, ids, features, widths, heights, extensions=None):
+        """
+        追加特征到 dataset 最后一个分片, 超过 shard_rows 时新建分片
+        """
+        if len(ids) == 0:
+            return
+        with self._locked(dataset_id):
+            manifest = self.read_manifest(dataset_id) or self._new_manifest()
+            # 重新写入的 id 不再带删除标记, 旧行在读取时被新行覆盖
+            manifest["tombstones"] = sorted(set(manifest["tombstones"]) - {int(i) for i in ids})
+            data, scales = quantize(normalize_rows(features), manifest["quantization"])
+            columns = {
+                "vec": data,
+                "ids": np.asarray(ids, dtype=np.int64),
+                "wh": np.minimum(np.stack([np.asarray(widths, dtype=np.int64), np.asarray(heights, dtype=np.int64)], axis=1), 65535),
+                "ext": np.array([extension_code(extension) for extension in (extensions or [None] * len(ids))], dtype=np.uint8),
+                "scale": scales,
+            }
+            shapes = self._row_shapes(manifest)
+            start = 0
+            while start < len(ids):
+                if not manifest["shards"] or manifest["shards"][-1]["rows"] >= self.shard_rows:
+                    manifest["shards"].append({"name": self._next_shard_name(manifest), "rows": 0})
+                shard = manifest["shards"][-1]
+                end = min(len(ids), start + self.shard_rows - shard["rows"])
+                for suffix in self._suffixes(manifest):
+                    dtype, row_shape = shapes[suffix]
+                    path = self._shard_path(dataset_id, shard["name"], suffix)
+                    row_bytes = np.dtype(dtype).itemsize * int(np.prod(row_shape, dtype=np.int64))
+                    with open(path, "ab") as f:
+                        # 丢弃上次写了一半、没有记入 manifest 的数据
+                        f.truncate(shard["rows"] * row_bytes)
+                        f.write(np.ascontiguousarray(columns[suffix][start:end], dtype=dtype).tobytes())
+                shard["rows"] += end - start
+                start = end
+            self._write_manifest(dataset_id, manifest)
+
+    def delete(self, dataset_id, ids):
+        """
+        记录删除标记, 数据在 compact 时才真正删除
+        """
+        if len(ids) == 0 or not self.exists(dataset_id):
+            return
+        with self._locked(dataset_id):
+            manifest = self.read_manifest(dataset_id)
+            if manifest is None:
+                return
+            manifest["tombstones"] = sorted(set(manifest["tombstones"]) | {int(i) for i in ids})
+            self._write_manifest(dataset_id, manifest)
+
+    def _map(self, dataset_id, manifest, shard, suffix, mode="c"):
+        dtype, row_shape = self._row_shapes(manifest)[suffix]
+        if shard["rows"] == 0:
+            return np.empty((0,) + row_shape, dtype=dtype)
+        return np.memmap(self._shard_path(dataset_id, shard["name"], suffix), dtype=dtype, mode=mode,
+                         shape=(shard["rows"],) + row_shape)
+
+    def _columns(self, dataset_id, manifest):
+        columns = {}
+        for suffix in self._suffixes(manifest):
+            parts = [self._map(dataset_id, manifest, shard, suffix) for shard in manifest["shards"]]
+            # 单个分片时直接使用 memmap, 多个分片需要拼接 (compact 后恢复零拷贝)
+            columns[suffix] = parts[0] if len(parts) == 1 else np.concatenate(parts)
+        ids = columns["ids"]
+        # 同一个 id 只保留最后追加的一行
+        _, last = np.unique(ids[::-1], return_index=True)
+        keep = None
+        if len(last) < len(ids):
+            keep = np.zeros(len(ids), dtype=bool)
+            keep[len(ids) - 1 - last] = True
+        if manifest["tombstones"]:
+            alive = ~np.isin(ids, np.asarray(manifest["tombstones"], dtype=np.int64))
+            keep = alive if keep is None else keep & alive
+        if keep is not None:
+            columns = {suffix: column[keep] for suffix, column in columns.items()}
+        return columns
+
+    def open(self, dataset_id, members=None):
+        """
+        以 memmap 打开 dataset 的分片, 返回 DatasetFeatures; 没有分片时返回 None
+        """
+        manifest = self.read_manifest(dataset_id)
+        if manifest is None or not manifest["shards"]:
+            return None
+        if (manifest.get("format", 1) != self._FORMAT or manifest["quantization"] != self.quantization
+                or manifest["dim"] != self.feat_dim):
+            logger.warning(f"feature shards of dataset {dataset_id} were built with format {manifest.get('format', 1)} {manifest['quantization']}/{manifest['dim']}, rebuild them with export-shards")
+            return None
+        columns = self._columns(dataset_id, manifest)
+        if len(manifest["shards"]) > 1:
+            logger.info(f"dataset {dataset_id} has {len(manifest['shards'])} feature shards, run compact-shards to map them without copying")
+        return DatasetFeatures.from_arrays(
+            dataset_id, columns["vec"], columns["ids"], columns["wh"][:, 0], columns["wh"][:, 1],
+            extensions=columns["ext"], scales=columns.get("scale"), members=members, quantization=manifest["quantization"])
+
+    def compact(self, dataset_id):
+        """
+        合并所有分片, 删除带删除标记的行与被覆盖的旧行, 写入新分片后原子替换 manifest
+        """
+        if not self.exists(dataset_id):
+            return 0
+        with self._locked(dataset_id):
+            manifest = self.read_manifest(dataset_id)
+            if manifest is None:
+                return 0
+            columns = self._columns(dataset_id, manifest)
+            old_shards = manifest["shards"]
+            name = self._next_shard_name(manifest)
+            rows = len(columns["ids"])
+            for suffix, column in columns.items():
+                with open(self._shard_path(dataset_id, name, suffix), "wb") as f:
+                    f.write(np.ascontiguousarray(column).tobytes())
+            manifest["shards"] = [{"name": name, "rows": rows}]
+            manifest["tombstones"] = []
+            self._write_manifest(dataset_id, manifest)
+            for shard in old_shards:
+                for suffix in self._suffixes(manifest):
+                    path = self._shard_path(dataset_id, shard["name"], suffix)
+                    if os.path.exists(path):
+                        os.remove(path)
+            logger.info(f"feature shards of dataset {dataset_id} compacted: {rows} rows")
+            return rows
+
+    def export(self, dataset_id, docs, doc_feature, batch_size=8192):
+        """
+        用 mongo 中的特征文档重建 dataset 的分片
+        """
+        with self._locked(dataset_id):
+            manifest = self.read_manifest(dataset_id)
+            if manifest is not None:
+                for shard in manifest["shards"]:
+                    for suffix in self._suffixes(manifest):
+                        path = self._shard_path(dataset_id, shard["name"], suffix)
+                        if os.path.exists(path):
+                            os.remove(path)
+                os.remove(self._manifest_path(dataset_id))
+        total = 0
+        batch = []
+        for doc in docs:
+            batch.append(doc)
+            if len(batch) >= batch_size:
+                total += self._export_batch(dataset_id, batch, doc_feature)
+                batch = []
+        if batch:
+            total += self._export_batch(dataset_id, batch, doc_feature)
+        logger.info(f"feature shards of dataset {dataset_id} exported: {total} rows")
+        return total
+
+    def _export_batch(self, dataset_id, docs, doc_feature):
+        features = [doc_feature(doc) for doc in docs]
+        # 没有特征的文档 (doc_feature 返回 None) 无法导出
+        docs = [doc for doc, feature in zip(docs, features) if feature is not None]
+        features = [feature for feature in features if feature is not None]
+        if not docs:
+            return 0
+        self.append(dataset_id,
+                    [doc["workspace_file_id"] for doc in docs],
+                    np.array(features),
+                    [doc.get("width") or 0 for doc in docs],
+                    [doc.get("height") or 0 for doc in docs],
+                    [doc.get("extension") for doc in docs])
+        return len(docs)
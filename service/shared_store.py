@@ -0,0 +1,276 @@
+import os
+import json
+import time
+import fcntl
+import threading
+import numpy as np
+from utils.logger import logger
+from models.model_utils import QUANTIZATION_DTYPES
+from service.feature_cache import DatasetFeatures
+
+
+class SharedFeatureStore:
+    """
+    多个 uvicorn worker 共享的只读特征矩阵 (feature-store 为 shared)
+
+    持有 loader.lock 文件锁的进程是 loader, 负责把 dataset 的特征物化为文件并发布版本;
+    其它 worker 以只读 np.memmap 打开, 矩阵只在 page cache 中存在一份, 内存不随 worker 数增长.
+        loader.lock                 fcntl 排它锁, loader 进程退出后由其它 worker 接管
+        <dataset_id>/current.json   当前版本: version / rows / dim / quantization, os.replace 原子发布
+        <dataset_id>/v00000003.*    某个版本的 vec / ids / wh / ext / scale, 与 ShardStore 的分片格式相同;
+                                    量化且有 float32 特征时另有 exact, 用于精排
+        <dataset_id>/requested      worker 请求 loader 物化该 dataset
+        <dataset_id>/dirty          有新特征写入但不知道具体的 id, loader 从 mongo 重新物化并发布新版本
+        <dataset_id>/changed        有变更的 workspace_file_id, 每行一个; loader 只读取这些 id, 合并到当前版本后发布
+    发布新版本时保留上一个版本, 正在打开旧版本的 worker 不会读到被删除的文件;
+    已经 map 的文件被删除后数据仍然有效, 直到 worker 切换到新版本.
+    """
+
+    _FORMAT = 2
+    _MARKERS = ("requested", "dirty")
+
+    def __init__(self, root_dir: str, feat_dim: int, quantization: str = "none", check_interval: float = 1.0):
+        self.root_dir = root_dir
+        self.feat_dim = feat_dim
+        self.quantization = quantization
+        self.check_interval = check_interval
+        self._lock_file = None
+        self._versions = {}
+        self._lock = threading.Lock()
+        os.makedirs(root_dir, exist_ok=True)
+
+    @property
+    def is_loader(self) -> bool:
+        return self._lock_file is not None
+
+    def try_acquire_loader(self) -> bool:
+        """
+        非阻塞地获取 loader 锁, 同一时间只有一个进程成为 loader
+        """
+        if self._lock_file is not None:
+            return True
+        lock_file = open(os.path.join(self.root_dir, "loader.lock"), "a")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self._lock_file = lock_file
+        logger.info(f"process {os.getpid()} is the shared feature store loader")
+        return True
+
+    def release_loader(self):
+        if self._lock_file is not None:
+            fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+            self._lock_file.close()
+            self._lock_file = None
+
+    def dataset_dir(self, dataset_id):
+        return os.path.join(self.root_dir, str(dataset_id))
+
+    def _current_path(self, dataset_id):
+        return os.path.join(self.dataset_dir(dataset_id), "current.json")
+
+    def _version_path(self, dataset_id, version, suffix):
+        return os.path.join(self.dataset_dir(dataset_id), f"v{version:08d}.{suffix}")
+
+    def read_current(self, dataset_id):
+        try:
+            with open(self._current_path(dataset_id), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def latest_version(self, dataset_id):
+        """
+        当前发布的版本号, 每个 dataset 最多每 check_interval 秒读取一次 current.json
+        """
+        now = time.monotonic()
+        with self._lock:
+            cached = self._versions.get(dataset_id)
+            if cached is not None and now - cached[0] < self.check_interval:
+                return cached[1]
+        current = self.read_current(dataset_id)
+        version = current["version"] if current is not None else None
+        with self._lock:
+            self._versions[dataset_id] = (now, version)
+        return version
+
+    def attach(self, dataset_id, members=None):
+        """
+        以只读 memmap 打开当前版本, 没有发布过或格式不一致时返回 None
+        """
+        current = self.read_current(dataset_id)
+        if current is None:
+            return None
+        if current["format"] != self._FORMAT or current["quantization"] != self.quantization or current["dim"] != self.feat_dim:
+            logger.warning(f"shared features of dataset {dataset_id} were published with {current['quantization']}/{current['dim']}, waiting for the loader to republish")
+            return None
+        rows = current["rows"]
+        version = current["version"]
+        columns = {}
+        for suffix, (dtype, row_shape) in self._row_shapes(current["quantization"], current["dim"]).items():
+            if suffix == "scale" and current["quantization"] != "int8":
+                continue
+            if suffix == "exact" and not current.get("exact"):
+                continue
+            if rows == 0:
+                columns[suffix] = np.empty((0,) + row_shape, dtype=dtype)
+                continue
+            try:
+                columns[suffix] = np.memmap(self._version_path(dataset_id, version, suffix), dtype=dtype, mode="r", shape=(rows,) + row_shape)
+            except FileNotFoundError:
+                # 打开期间 loader 连续发布了两个版本, 下一次访问时重新打开
+                logger.warning(f"shared features v{version} of dataset {dataset_id} were removed while attaching")
+                return None
+        dataset = DatasetFeatures.from_arrays(
+            dataset_id, columns["vec"], columns["ids"], columns["wh"][:, 0], columns["wh"][:, 1],
+            extensions=columns["ext"], scales=columns.get("scale"), members=members, quantization=current["quantization"],
+            exact=columns.get("exact"))
+        dataset.version = version
+        with self._lock:
+            self._versions[dataset_id] = (time.monotonic(), version)
+        return dataset
+
+    @staticmethod
+    def _row_shapes(quantization, dim):
+        return {
+            "vec": (QUANTIZATION_DTYPES[quantization], (dim,)),
+            "ids": (np.int64, ()),
+            "wh": (np.uint16, (2,)),
+            "ext": (np.uint8, ()),
+            "scale": (np.float32, ()),
+            "exact": (np.float32, (dim,)),
+        }
+
+    def publish(self, dataset: DatasetFeatures):
+        """
+        把 dataset 写成新版本的文件后原子替换 current.json, 删除上上个版本. 只由 loader 调用
+        """
+        dataset_id = dataset.dataset_id
+        os.makedirs(self.dataset_dir(dataset_id), exist_ok=True)
+        current = self.read_current(dataset_id)
+        version = current["version"] + 1 if current is not None else 1
+        columns = {
+            "vec": dataset.features,
+            "ids": dataset.ids,
+            "wh": np.stack([dataset.widths, dataset.heights], axis=1) if len(dataset) else np.empty((0, 2), dtype=np.uint16),
+            "ext": dataset.extensions,
+        }
+        if dataset.quantization == "int8":
+            columns["scale"] = dataset.scales
+        if dataset.quantization != "none" and dataset.exact is not None:
+            columns["exact"] = dataset.exact
+        for suffix, column in columns.items():
+            path = self._version_path(dataset_id, version, suffix)
+            dtype = self._row_shapes(dataset.quantization, dataset.feat_dim)[suffix][0]
+            with open(path + ".tmp", "wb") as f:
+                np.ascontiguousarray(column, dtype=dtype).tofile(f)
+            os.replace(path + ".tmp", path)
+        manifest = {"format": self._FORMAT, "version": version, "rows": len(dataset), "dim": dataset.feat_dim,
+                    "quantization": dataset.quantization, "exact": "exact" in columns, "published_time": time.time()}
+        path = self._current_path(dataset_id)
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(manifest, f)
+        os.replace(path + ".tmp", path)
+        self._remove_versions(dataset_id, keep={version, version - 1})
+        logger.info(f"shared features of dataset {dataset_id} published: v{version}, {len(dataset)} vectors")
+        return version
+
+    def _remove_versions(self, dataset_id, keep):
+        for name in os.listdir(self.dataset_dir(dataset_id)):
+            if not name.startswith("v") or name.endswith(".tmp"):
+                continue
+            try:
+                version = int(name[1:].split(".")[0])
+            except ValueError:
+                continue
+            if version not in keep:
+                os.remove(os.path.join(self.dataset_dir(dataset_id), name))
+
+    def _touch(self, dataset_id, marker):
+        os.makedirs(self.dataset_dir(dataset_id), exist_ok=True)
+        with open(os.path.join(self.dataset_dir(dataset_id), marker), "a"):
+            pass
+
+    def request(self, dataset_id):
+        """
+        worker 请求 loader 物化还没有发布过的 dataset
+        """
+        self._touch(dataset_id, "requested")
+
+    def mark_dirty(self, dataset_ids=None, workspace_file_ids=None):
+        """
+        新特征写入 mongo 之后调用, 只标记已经发布过的 dataset; dataset_ids 为 None 时标记全部.
+        传入 workspace_file_ids 时记录变更的 id, loader 只把这些 id 合并到当前版本, 不重新扫描整个 dataset
+        """
+        if dataset_ids is None:
+            dataset_ids = self.published_dataset_ids()
+        for dataset_id in dataset_ids:
+            if not os.path.exists(self._current_path(dataset_id)):
+                continue
+            if workspace_file_ids is None:
+                self._touch(dataset_id, "dirty")
+            else:
+                self._append_changed(dataset_id, workspace_file_ids)
+
+    def _append_changed(self, dataset_id, workspace_file_ids):
+        """
+        追加写入 changed 文件; 持有文件锁期间文件被 loader 取走 (改名后删除) 时写入新文件
+        """
+        path = os.path.join(self.dataset_dir(dataset_id), "changed")
+        data = "".join(f"{int(workspace_file_id)}\n" for workspace_file_id in workspace_file_ids)
+        while True:
+            with open(path, "a", encoding="utf-8") as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                if os.fstat(f.fileno()).st_nlink == 0:
+                    continue
+                f.write(data)
+                return
+
+    def _take_changed(self, dataset_id):
+        """
+        取出 changed 文件中的 id, 没有时返回空集合
+        """
+        path = os.path.join(self.dataset_dir(dataset_id), "changed")
+        taken = f"{path}.{os.getpid()}"
+        try:
+            os.replace(path, taken)
+        except FileNotFoundError:
+            return set()
+        with open(taken, "r", encoding="utf-8") as f:
+            # 等待改名前打开文件的写入方写完
+            fcntl.flock(f, fcntl.LOCK_EX)
+            ids = {int(line) for line in f if line.strip()}
+            os.remove(taken)
+        return ids
+
+    def published_dataset_ids(self):
+        return [dataset_id for dataset_id in self._dataset_ids() if os.path.exists(self._current_path(dataset_id))]
+
+    def _dataset_ids(self):
+        dataset_ids = []
+        for name in os.listdir(self.root_dir):
+            if os.path.isdir(os.path.join(self.root_dir, name)):
+                dataset_ids.append(int(name) if name.lstrip("-").isdigit() else name)
+        return dataset_ids
+
+    def take_pending(self):
+        """
+        取出并清除 requested / dirty 标记与 changed 中的 id, 返回需要 (重新) 物化的 [(dataset_id, changed_ids)],
+        changed_ids 为 None 时需要从 mongo 完整物化. 先删除标记再读取 mongo, 物化期间新写入的特征会重新留下标记
+        """
+        pending = []
+        for dataset_id in self._dataset_ids():
+            marked = False
+            for marker in self._MARKERS:
+                path = os.path.join(self.dataset_dir(dataset_id), marker)
+                if os.path.exists(path):
+                    os.remove(path)
+                    marked = True
+            changed = self._take_changed(dataset_id)
+            if marked:
+                pending.append((dataset_id, None))
+            elif changed:
+                pending.append((dataset_id, changed))
+        return pending
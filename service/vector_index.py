@@ -0,0 +1,601 @@
+import os
+import json
+import time
+import threading
+import contextvars
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from utils.logger import logger
+from utils.metrics import metrics, span
+from config.config import settings
+from models.model_utils import topk
+from service.feature_cache import DatasetFeatures, normalize_rows
+
+
+def _top_rows(rows, scores, topn):
+    order = topk(scores, topn)
+    return rows[order], scores[order]
+
+
+class ParallelScorer:
+    """
+    把暴力打分按行拆成分片, 在线程池中并行计算
+
+    numpy 的矩阵向量乘与 argpartition 都会释放 GIL, 每个分片只返回自己的
+    topn 个候选, 最后在 threads * topn 个候选上做一次全局 topn. 行数少于
+    min_shard_rows * 2 时不拆分, 避免线程调度的开销超过打分本身.
+    """
+
+    def __init__(self, threads: int = 0, min_shard_rows: int = 65536):
+        self.threads = max(int(threads or os.cpu_count() or 1), 1)
+        self.min_shard_rows = max(int(min_shard_rows), 1)
+        self.pool = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix="score") if self.threads > 1 else None
+
+    def search(self, dataset: DatasetFeatures, query, topn, rows=None):
+        """
+        query 与 dataset 指定行 (默认全部行) 的 topn, 返回 (rows, scores)
+        """
+        return self.search_many(dataset, query.reshape(1, -1), topn, rows)[0]
+
+    def search_many(self, dataset: DatasetFeatures, queries, topn, rows=None, mask=None):
+        """
+        多个 query 共用一次矩阵乘: queries 为 (Q, D), 返回每个 query 的 (rows, scores)
+
+        rows 为只对这些行打分 (选择性高的过滤条件), mask 为对连续的全部行打分后再按掩码过滤
+        (选择性低的过滤条件, 避免按行号复制大部分矩阵).
+        """
+        queries = np.ascontiguousarray(queries.T)
+        size = len(rows) if rows is not None else (len(mask) if mask is not None else len(dataset))
+        metrics.inc("clip_search_vectors_scanned_total", size * queries.shape[1], help="feature vectors scored", path="resident")
+        shards = min(self.threads, size // self.min_shard_rows)
+        if self.pool is None or shards <= 1:
+            return self._shard_topk(dataset, queries, topn, rows, mask, 0, size)
+        bounds = np.linspace(0, size, shards + 1).astype(np.int64)
+        futures = [self.pool.submit(contextvars.copy_context().run, self._shard_topk, dataset, queries, topn, rows, mask, start, end)
+                   for start, end in zip(bounds[:-1], bounds[1:])]
+        results = [future.result() for future in futures]
+        return [_top_rows(np.concatenate([result[q][0] for result in results]),
+                          np.concatenate([result[q][1] for result in results]), topn)
+                for q in range(queries.shape[1])]
+
+    @staticmethod
+    def _shard_topk(dataset, queries, topn, rows, mask, start, end):
+        with span("score"):
+            if rows is None:
+                # 连续的行直接切片, 不复制矩阵
+                shard_rows = np.arange(start, end)
+                scores = dataset.score(queries, slice(start, end))
+                if mask is not None:
+                    keep = mask[start:end]
+                    shard_rows, scores = shard_rows[keep], scores[keep]
+            else:
+                shard_rows = rows[start:end]
+                scores = dataset.score(queries, shard_rows)
+        with span("topk"):
+            return [_top_rows(shard_rows, scores[:, q], topn) for q in range(queries.shape[1])]
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=False)
+
+
+_scorer = None
+_scorer_lock = threading.Lock()
+
+
+def get_scorer() -> ParallelScorer:
+    global _scorer
+    if _scorer is None:
+        with _scorer_lock:
+            if _scorer is None:
+                _scorer = ParallelScorer(settings.score_threads, settings.score_shard_min_rows)
+    return _scorer
+
+
+def _atomic_path(path):
+    # 临时文件名带上进程与线程, 多个 worker 同时保存同一个索引时不会互相覆盖
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+
+class ExactIndex:
+    """
+    暴力检索, 直接对常驻矩阵做矩阵向量乘
+    """
+    kind = "exact"
+    # 过滤后剩余行数超过该比例时对全部行打分再过滤, 否则只对剩余的行打分
+    DENSE_MASK_RATIO = 0.5
+
+    def __init__(self, dim: int):
+        self.dim = dim
+        self.dataset = None
+
+    def build(self, dataset: DatasetFeatures):
+        self.dataset = dataset
+
+    def bind(self, dataset: DatasetFeatures):
+        self.dataset = dataset
+
+    def add(self, workspace_file_id, row, feature):
+        pass
+
+    def search(self, query, topn, mask=None, **params):
+        return self.search_many(query.reshape(1, -1), topn, mask=mask)[0]
+
+    def search_many(self, queries, topn, mask=None, **params):
+        """
+        多个 query 一次矩阵乘打分, 返回每个 query 的 (rows, scores)
+        """
+        rows = None
+        if mask is not None:
+            mask = mask[:len(self.dataset)]
+            selected = int(np.count_nonzero(mask))
+            if selected == 0:
+                return [(np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)) for _ in range(len(queries))]
+            if selected < len(mask) * self.DENSE_MASK_RATIO:
+                # 过滤后剩下的行少, 只对这些行打分
+                rows, mask = np.flatnonzero(mask), None
+        return get_scorer().search_many(self.dataset, queries, topn, rows, mask)
+
+    def save(self, path):
+        pass
+
+    @classmethod
+    def load(cls, path, dim):
+        return None
+
+
+class IVFFlatIndex:
+    """
+    IVF-flat: 球面 k-means 聚类出 nlist 个倒排桶, 检索时只扫描与 query 最近的 nprobe 个桶
+
+    桶中保存的是 workspace_file_id, 绑定到 DatasetFeatures 后换算为行号,
+    向量本身不重复存储, 直接使用常驻矩阵.
+    """
+    kind = "ivf_flat"
+
+    def __init__(self, dim: int, nlist: int = 0, nprobe: int = 16):
+        self.dim = dim
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.centroids = None
+        self.list_ids = []
+        self.list_rows = []
+        self.dataset = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _kmeans(dataset, nlist, niter=10, seed=0):
+        rng = np.random.default_rng(seed)
+        sample_size = min(len(dataset), nlist * 64)
+        sample = dataset.vectors(np.sort(rng.choice(len(dataset), sample_size, replace=False)))
+        centroids = sample[rng.choice(sample_size, nlist, replace=False)].copy()
+        for _ in range(niter):
+            assign = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assign, sample)
+            empty = np.bincount(assign, minlength=nlist) == 0
+            # 空桶重新随机取样, 避免 centroid 退化
+            sums[empty] = sample[rng.choice(sample_size, int(empty.sum()))]
+            centroids = normalize_rows(sums)
+        return centroids
+
+    def _assign(self, dataset, rows, chunk_size=8192):
+        assign = np.empty(len(rows), dtype=np.int64)
+        for start in range(0, len(rows), chunk_size):
+            block = dataset.vectors(rows[start:start + chunk_size])
+            assign[start:start + chunk_size] = np.argmax(block @ self.centroids.T, axis=1)
+        return assign
+
+    def _fill(self, ids, rows, assign):
+        order = np.argsort(assign, kind="stable")
+        bounds = np.searchsorted(assign[order], np.arange(len(self.centroids) + 1))
+        self.list_ids = [ids[order[lo:hi]].copy() for lo, hi in zip(bounds[:-1], bounds[1:])]
+        self.list_rows = [rows[order[lo:hi]].copy() for lo, hi in zip(bounds[:-1], bounds[1:])]
+
+    def build(self, dataset: DatasetFeatures):
+        size = len(dataset)
+        nlist = self.nlist or max(1, int(np.sqrt(size)))
+        nlist = min(nlist, size)
+        _time_start = time.time()
+        self.centroids = self._kmeans(dataset, nlist)
+        rows = np.arange(size)
+        self._fill(dataset.ids[:size], rows, self._assign(dataset, rows))
+        self.dataset = dataset
+        logger.info(f"ivf_flat index built for dataset {dataset.dataset_id}: nlist={nlist}, {size} vectors in {time.time() - _time_start:.2f}s")
+
+    def bind(self, dataset: DatasetFeatures):
+        """
+        绑定到新加载的 DatasetFeatures: 重新换算行号, 丢弃已不在 dataset 中的 id, 补上索引中缺失的 id
+        """
+        ids = np.concatenate(self.list_ids) if self.list_ids else np.empty(0, dtype=np.int64)
+        list_index = np.repeat(np.arange(len(self.list_ids)), [len(x) for x in self.list_ids])
+        rows = dataset.rows_of(ids)
+        keep = rows >= 0
+        ids, rows, list_index = ids[keep], rows[keep], list_index[keep]
+
+        missing = np.setdiff1d(dataset.ids, ids)
+        if len(missing) > 0:
+            missing_rows = dataset.rows_of(missing)
+            ids = np.concatenate([ids, missing])
+            rows = np.concatenate([rows, missing_rows])
+            list_index = np.concatenate([list_index, self._assign(dataset, missing_rows)])
+            logger.info(f"ivf_flat index for dataset {dataset.dataset_id}: {len(missing)} vectors added on load")
+        with self._lock:
+            self._fill(ids, rows, list_index)
+            self.dataset = dataset
+        return len(missing)
+
+    def add(self, workspace_file_id, row, feature):
+        c = int(np.argmax(self.centroids @ feature))
+        with self._lock:
+            self.list_ids[c] = np.append(self.list_ids[c], workspace_file_id)
+            self.list_rows[c] = np.append(self.list_rows[c], row)
+
+    def search(self, query, topn, mask=None, nprobe=None, **params):
+        nprobe = min(int(nprobe or self.nprobe), len(self.centroids))
+        probe = np.argpartition(-(self.centroids @ query), nprobe - 1)[:nprobe]
+        list_rows = self.list_rows
+        # 同一个 id 重复导入时会落在多个桶里, 去重
+        rows = np.unique(np.concatenate([list_rows[c] for c in probe]))
+        if mask is not None:
+            rows = rows[rows < len(mask)]
+            rows = rows[mask[rows]]
+        if len(rows) == 0:
+            return rows, np.empty(0, dtype=np.float32)
+        return get_scorer().search(self.dataset, query, topn, rows)
+
+    def search_many(self, queries, topn, mask=None, **params):
+        # 每个 query 探测的桶不同, 逐个检索
+        return [self.search(query, topn, mask=mask, **params) for query in queries]
+
+    def save(self, path):
+        tmp_path = _atomic_path(path)
+        with open(tmp_path, "wb") as f:
+            np.savez(f,
+                     centroids=self.centroids,
+                     ids=np.concatenate(self.list_ids),
+                     sizes=np.array([len(x) for x in self.list_ids], dtype=np.int64))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, dim):
+        if not os.path.exists(path):
+            return None
+        data = np.load(path)
+        index = cls(dim, nlist=len(data["centroids"]), nprobe=settings.ivf_nprobe)
+        index.centroids = data["centroids"]
+        offsets = np.concatenate([[0], np.cumsum(data["sizes"])])
+        ids = data["ids"]
+        index.list_ids = [ids[lo:hi] for lo, hi in zip(offsets[:-1], offsets[1:])]
+        return index
+
+
+class HNSWIndex:
+    """
+    HNSW 图索引, 依赖 hnswlib; label 为 workspace_file_id, 向量由 hnswlib 自己保存
+    """
+    kind = "hnsw"
+
+    def __init__(self, dim: int, M: int = 16, ef_construction: int = 200, ef: int = 64):
+        self.dim = dim
+        self.M = M
+        self.ef_construction = ef_construction
+        self.ef = ef
+        self.index = None
+        self.dataset = None
+        self._current_ef = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _hnswlib():
+        try:
+            import hnswlib
+        except ImportError:
+            raise ImportError("index-type hnsw requires hnswlib, please `pip install hnswlib`")
+        return hnswlib
+
+    def _new_index(self, max_elements):
+        index = self._hnswlib().Index(space="ip", dim=self.dim)
+        index.init_index(max_elements=max(max_elements, 1), M=self.M, ef_construction=self.ef_construction)
+        return index
+
+    def _add_items(self, features, ids):
+        needed = self.index.get_current_count() + len(ids)
+        if needed > self.index.get_max_elements():
+            self.index.resize_index(max(needed, self.index.get_max_elements() * 2))
+        self.index.add_items(features, ids)
+
+    def build(self, dataset: DatasetFeatures):
+        _time_start = time.time()
+        size = len(dataset)
+        self.index = self._new_index(size)
+        for start in range(0, size, 65536):
+            rows = np.arange(start, min(start + 65536, size))
+            self.index.add_items(dataset.vectors(rows), dataset.ids[rows])
+        self.dataset = dataset
+        logger.info(f"hnsw index built for dataset {dataset.dataset_id}: {len(dataset)} vectors in {time.time() - _time_start:.2f}s")
+
+    def bind(self, dataset: DatasetFeatures):
+        missing = np.setdiff1d(dataset.ids, np.asarray(self.index.get_ids_list(), dtype=np.int64))
+        with self._lock:
+            if len(missing) > 0:
+                self._add_items(dataset.vectors(dataset.rows_of(missing)), missing)
+                logger.info(f"hnsw index for dataset {dataset.dataset_id}: {len(missing)} vectors added on load")
+            self.dataset = dataset
+        return len(missing)
+
+    def add(self, workspace_file_id, row, feature):
+        with self._lock:
+            self._add_items(feature.reshape(1, -1), [workspace_file_id])
+
+    def _knn(self, query, k, ef):
+        with self._lock:
+            if ef != self._current_ef:
+                self.index.set_ef(ef)
+                self._current_ef = ef
+            return self.index.knn_query(query.reshape(1, -1), k=k)
+
+    def search(self, query, topn, mask=None, ef=None, **params):
+        count = self.index.get_current_count()
+        if count == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        k = min(topn, count)
+        while True:
+            labels, distances = self._knn(query, k, max(int(ef or self.ef), k))
+            # hnswlib 的 ip 距离为 1 - <q, x>
+            rows = self.dataset.rows_of(labels[0])
+            scores = 1.0 - distances[0]
+            keep = rows >= 0
+            if mask is not None:
+                keep &= rows < len(mask)
+                keep[keep] = mask[rows[keep]]
+            # 过滤后不足 topn 时扩大 k 重新检索
+            if keep.sum() >= topn or k >= count:
+                return _top_rows(rows[keep], scores[keep], topn)
+            k = min(k * 4, count)
+
+    def search_many(self, queries, topn, mask=None, **params):
+        return [self.search(query, topn, mask=mask, **params) for query in queries]
+
+    def save(self, path):
+        tmp_path = _atomic_path(path)
+        self.index.save_index(tmp_path)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, dim):
+        if not os.path.exists(path):
+            return None
+        index = cls(dim, M=settings.hnsw_m, ef_construction=settings.hnsw_ef_construction, ef=settings.hnsw_ef)
+        index.index = index._hnswlib().Index(space="ip", dim=dim)
+        index.index.load_index(path)
+        return index
+
+
+INDEX_TYPES = {
+    ExactIndex.kind: ExactIndex,
+    IVFFlatIndex.kind: IVFFlatIndex,
+    HNSWIndex.kind: HNSWIndex,
+}
+
+_INDEX_FILES = {
+    IVFFlatIndex.kind: "ivf_flat.npz",
+    HNSWIndex.kind: "hnsw.bin",
+}
+
+
+def create_index(index_type: str, dim: int):
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"Unknown index type: {index_type}")
+    if index_type == IVFFlatIndex.kind:
+        return IVFFlatIndex(dim, nlist=settings.ivf_nlist, nprobe=settings.ivf_nprobe)
+    if index_type == HNSWIndex.kind:
+        return HNSWIndex(dim, M=settings.hnsw_m, ef_construction=settings.hnsw_ef_construction, ef=settings.hnsw_ef)
+    return ExactIndex(dim)
+
+
+class IndexManager:
+    """
+    管理每个 dataset 的向量索引: 首次检索时从 root_path 加载, 不存在则构建并保存,
+    导入新图片时增量插入已加载的索引
+
+    加载 / 构建在后台线程中进行, 不持有全局锁; 完成之前该 dataset 的检索走暴力检索.
+    can_build() 为 False 的进程 (共享特征存储中的非 loader worker) 只加载 loader 保存的索引文件,
+    不构建也不保存; 文件还不存在或构建失败时 retry_interval 秒后再尝试.
+    """
+
+    def __init__(self, index_type: str, dim: int, root_dir: str, min_size: int = 0, save_interval: int = 1000,
+                 can_build=None, retry_interval: float = 5.0):
+        if index_type not in INDEX_TYPES:
+            raise ValueError(f"Unknown index type: {index_type}")
+        self.index_type = index_type
+        self.dim = dim
+        self.root_dir = root_dir
+        self.min_size = min_size
+        self.save_interval = save_interval
+        self._indexes = {}
+        self._dirty = {}
+        self.can_build = can_build or (lambda: True)
+        self.retry_interval = retry_interval
+        # 正在后台加载 / 构建的索引, 完成时置位
+        self._building = {}
+        # 没有加载到索引的 key 下一次尝试的时间
+        self._retry_at = {}
+        self._lock = threading.RLock()
+
+    def index_path(self, dataset_id, index_type=None):
+        index_type = index_type or self.index_type
+        return os.path.join(self.root_dir, str(dataset_id), _INDEX_FILES[index_type])
+
+    def get(self, dataset: DatasetFeatures, index_type=None, wait=False):
+        """
+        返回 dataset 的索引, 规模小于 min_size 的 dataset 直接走暴力检索; 索引还在后台加载 / 构建时
+        返回暴力检索, wait 为 True 时等待完成
+        """
+        index_type = index_type or self.index_type
+        if index_type == ExactIndex.kind or len(dataset) < max(self.min_size, 1):
+            return self._exact(dataset)
+
+        key = (dataset.dataset_id, index_type)
+        with self._lock:
+            index = self._indexes.get(key)
+            if index is not None:
+                if index.dataset is not dataset:
+                    self._dirty[key] += index.bind(dataset)
+                return index
+            done = self._building.get(key)
+            if done is None:
+                if not wait and time.monotonic() < self._retry_at.get(key, 0):
+                    return self._exact(dataset)
+                done = self._building[key] = threading.Event()
+                threading.Thread(target=self._build, args=(key, dataset, done), name=f"index-build-{dataset.dataset_id}", daemon=True).start()
+        if wait:
+            done.wait()
+            with self._lock:
+                index = self._indexes.get(key)
+                if index is not None:
+                    if index.dataset is not dataset:
+                        self._dirty[key] += index.bind(dataset)
+                    return index
+        return self._exact(dataset)
+
+    def _exact(self, dataset: DatasetFeatures):
+        index = ExactIndex(self.dim)
+        index.bind(dataset)
+        return index
+
+    def _build(self, key, dataset: DatasetFeatures, done: threading.Event):
+        """
+        后台加载或构建索引; 期间追加到 dataset 的行在注册前由 bind 补上, dataset 被淘汰时丢弃
+        """
+        dataset_id, index_type = key
+        path = self.index_path(dataset_id, index_type)
+        self._retry_at[key] = time.monotonic() + self.retry_interval
+        try:
+            can_build = self.can_build()
+            index = INDEX_TYPES[index_type].load(path, self.dim)
+            if index is None:
+                if not can_build:
+                    return
+                index = create_index(index_type, self.dim)
+                index.build(dataset)
+                index.save(path)
+            else:
+                logger.info(f"{index_type} index loaded for dataset {dataset_id}")
+                if index.bind(dataset) > 0 and can_build:
+                    index.save(path)
+            with self._lock:
+                if self._building.get(key) is not done:
+                    logger.info(f"{index_type} index of dataset {dataset_id} dropped while building")
+                    return
+                self._indexes[key] = index
+                self._dirty[key] = index.bind(dataset)
+                self._retry_at.pop(key, None)
+        except Exception as e:
+            logger.error(f"Error building {index_type} index for dataset {dataset_id}: {e}")
+        finally:
+            with self._lock:
+                if self._building.get(key) is done:
+                    del self._building[key]
+            done.set()
+
+    def add_feature(self, workspace_file_id, feature, dataset_ids=None):
+        feature = normalize_rows(np.asarray(feature, dtype=np.float32).reshape(-1))
+        with self._lock:
+            for key, index in list(self._indexes.items()):
+                dataset = index.dataset
+                if not dataset.accepts(workspace_file_id, dataset_ids):
+                    continue
+                index.add(workspace_file_id, dataset.row_of(workspace_file_id), feature)
+                self._dirty[key] += 1
+                if self._dirty[key] >= self.save_interval:
+                    self._save(key)
+
+    def _save(self, key):
+        dataset_id, index_type = key
+        if not self.can_build():
+            # 非 loader 的 worker 只在内存中更新索引, 文件由 loader 保存
+            self._dirty[key] = 0
+            return
+        self._indexes[key].save(self.index_path(dataset_id, index_type))
+        self._dirty[key] = 0
+
+    def drop(self, dataset_id):
+        """
+        dataset 被 feature cache 淘汰时保存并释放其索引
+        """
+        with self._lock:
+            for key in [key for key in self._building if key[0] == dataset_id]:
+                del self._building[key]
+            for key in [key for key in self._indexes if key[0] == dataset_id]:
+                if self._dirty[key] > 0:
+                    self._save(key)
+                del self._indexes[key]
+                del self._dirty[key]
+
+    def flush(self):
+        with self._lock:
+            for key in list(self._indexes):
+                if self._dirty[key] > 0:
+                    self._save(key)
+
+
+def recall_report(dataset: DatasetFeatures, index, param_grid, topn=10, num_queries=100, seed=0):
+    """
+    以暴力检索为基准, 统计索引在不同参数下的 recall@topn 与单次检索耗时
+    """
+    rng = np.random.default_rng(seed)
+    sample_rows = rng.choice(len(dataset), min(num_queries, len(dataset)), replace=False)
+    # 在 dataset 向量上加噪声作为 query, 避免直接命中自身
+    queries = normalize_rows(dataset.vectors(sample_rows) + rng.normal(0, 0.05, (len(sample_rows), dataset.feat_dim)))
+
+    exact = ExactIndex(dataset.feat_dim)
+    exact.bind(dataset)
+    truth = [set(exact.search(query, topn)[0].tolist()) for query in queries]
+
+    report = []
+    for params in param_grid:
+        latencies = []
+        recalls = []
+        for query, expected in zip(queries, truth):
+            _time_start = time.perf_counter()
+            rows, _ = index.search(query, topn, **params)
+            latencies.append((time.perf_counter() - _time_start) * 1000)
+            recalls.append(len(expected & set(rows.tolist())) / max(len(expected), 1))
+        report.append({
+            "index_type": index.kind,
+            "params": params,
+            "topn": topn,
+            "recall": float(np.mean(recalls)),
+            "latency_ms_p50": float(np.percentile(latencies, 50)),
+            "latency_ms_p95": float(np.percentile(latencies, 95)),
+        })
+    return report
+
+
+if __name__ == "__main__":
+    import argparse
+    from utils.client import MongoDBClient
+    from service.server import SearchServer
+
+    parser = argparse.ArgumentParser(description="recall-vs-exact report for a dataset index")
+    parser.add_argument("dataset_id", type=int)
+    parser.add_argument("--index-type", default=settings.index_type, choices=[IVFFlatIndex.kind, HNSWIndex.kind])
+    parser.add_argument("--nprobe", type=int, nargs="*", default=[1, 4, 8, 16, 32, 64])
+    parser.add_argument("--ef", type=int, nargs="*", default=[16, 32, 64, 128, 256])
+    parser.add_argument("--topn", type=int, default=10)
+    parser.add_argument("--queries", type=int, default=100)
+    args = parser.parse_args()
+
+    server = SearchServer(MongoDBClient(settings.mongodb_collection), None)
+    server.index_manager.min_size = 0
+    dataset = server.feature_cache.get(args.dataset_id)
+    if dataset is None:
+        raise SystemExit(f"dataset {args.dataset_id} does not fit in feature-cache-mb")
+    index = server.index_manager.get(dataset, index_type=args.index_type, wait=True)
+    if args.index_type == IVFFlatIndex.kind:
+        grid = [{"nprobe": nprobe} for nprobe in args.nprobe]
+    else:
+        grid = [{"ef": ef} for ef in args.ef]
+    print(json.dumps(recall_report(dataset, index, grid, topn=args.topn, num_queries=args.queries), indent=4))
@@ -0,0 +1,18 @@
+import pytest
+
+
+@pytest.fixture
+def mongo(monkeypatch, tmp_path):
+    """
+    进程内的 mongomock 数据库, 替换 database.mongodb 中的 MongoClient, 与 benchmarks 的 setup_mongo 相同
+    """
+    mongomock = pytest.importorskip("mongomock")
+    import database.mongodb
+    from config.config import settings
+    from utils.client import MongoDBClient
+    client = mongomock.MongoClient()
+    monkeypatch.setattr(database.mongodb, "MongoClient", lambda *args, **kwargs: client)
+    monkeypatch.setattr(MongoDBClient, "_mongodb", None)
+    monkeypatch.setattr(settings, "mongodb_database", "clip_search_test")
+    monkeypatch.setattr(settings, "root_path", str(tmp_path))
+    yield client[settings.mongodb_database]
@@ -0,0 +1,121 @@
+from datetime import datetime, timedelta
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from config.config import settings
+from utils.client import MongoDBClient
+from service.server import SearchServer
+from service.incremental_sync import IncrementalSync
+
+
+BASE_TIME = datetime(2024, 1, 1)
+
+
+@pytest.fixture
+def server(mongo, monkeypatch):
+    monkeypatch.setattr(settings, "feature_store", "mongo")
+    monkeypatch.setattr(settings, "feature_quantization", "none")
+    monkeypatch.setattr(settings, "index_type", "exact")
+    monkeypatch.setattr(settings, "dataset_membership", "lookup")
+    # 较小的分页, 一轮同步需要读取多页
+    monkeypatch.setattr(settings, "incremental_sync_batch_size", 2)
+    monkeypatch.setattr(settings, "incremental_sync_interval", 3600)
+    server = SearchServer(MongoDBClient(settings.mongodb_collection), None)
+    yield server
+    server.close()
+
+
+@pytest.fixture
+def sync(server):
+    sync = IncrementalSync(server)
+    yield sync
+    sync.close()
+
+
+def _features(mongo):
+    return mongo[settings.mongodb_collection]
+
+
+def _feature_doc(server, workspace_file_id, created_time, dataset_ids=None):
+    feature = np.random.default_rng(workspace_file_id).standard_normal(server.feat_dim).astype(settings.storage_type)
+    doc = {"workspace_file_id": workspace_file_id, "feature": feature.tobytes(), "width": 100, "height": 100,
+           "extension": "jpg", "status": 1, "created_time": created_time}
+    if dataset_ids is not None:
+        doc["dataset_ids"] = dataset_ids
+    return doc
+
+
+def _add_images(mongo, server, id_list, dataset_id, created_time, denormalized=False):
+    _features(mongo).insert_many([_feature_doc(server, i, created_time, [dataset_id] if denormalized else None) for i in id_list])
+    mongo["dataset_files"].insert_many([{"dataset_id": dataset_id, "workspace_file_id": i, "status": 1, "created_time": created_time}
+                                        for i in id_list])
+
+
+def _alive_ids(dataset):
+    mask = dataset.get_mask({})
+    ids = dataset.ids
+    return set((ids if mask is None else ids[:len(mask)][mask]).tolist())
+
+
+def test_pages_cover_equal_timestamps(mongo, server, sync):
+    _add_images(mongo, server, range(1, 6), 1, BASE_TIME)
+    pages = list(sync._pages(_features(mongo), "created_time", BASE_TIME - timedelta(seconds=1), {"workspace_file_id": 1, "created_time": 1}))
+    assert [len(page) for page in pages] == [2, 2, 1]
+    assert sorted(doc["workspace_file_id"] for page in pages for doc in page) == [1, 2, 3, 4, 5]
+
+
+def test_new_features_are_appended_once(mongo, server, sync):
+    _add_images(mongo, server, [1, 2, 3], 1, BASE_TIME)
+    sync.start()
+    assert sync._watermarks[(settings.mongodb_collection, "created_time")] == BASE_TIME
+    dataset = server.feature_cache.get(1)
+    assert _alive_ids(dataset) == {1, 2, 3}
+
+    later = BASE_TIME + timedelta(seconds=10)
+    _add_images(mongo, server, [4, 5, 6, 7, 8], 1, later)
+    synced, _ = sync.sync_once()
+    # 第一轮从水位之前 lookback 秒开始读取, 水位上的 3 个文档也会再处理一次
+    assert synced == 8
+    assert _alive_ids(dataset) == {1, 2, 3, 4, 5, 6, 7, 8}
+    assert sync._watermarks[(settings.mongodb_collection, "created_time")] == later
+
+    # 回看窗口内已经处理过的文档不会重复处理
+    assert sync.sync_once() == (0, 0)
+
+
+def test_membership_add_and_remove(mongo, server, sync):
+    _add_images(mongo, server, [1, 2, 3], 1, BASE_TIME)
+    _features(mongo).insert_one(_feature_doc(server, 4, BASE_TIME))
+    sync.start()
+    dataset = server.feature_cache.get(1)
+    assert _alive_ids(dataset) == {1, 2, 3}
+
+    later = BASE_TIME + timedelta(seconds=10)
+    mongo["dataset_files"].update_one({"dataset_id": 1, "workspace_file_id": 2}, {"$set": {"status": 0, "updated_time": later}})
+    mongo["dataset_files"].insert_one({"dataset_id": 1, "workspace_file_id": 4, "status": 1, "created_time": later})
+    sync.sync_once()
+    assert _alive_ids(dataset) == {1, 3, 4}
+
+    # 重新加载时删除的归属关系也不会回来
+    server.feature_cache.invalidate(1)
+    assert _alive_ids(server.feature_cache.get(1)) == {1, 3, 4}
+
+
+def test_denormalized_membership_is_written_to_features(mongo, server, sync, monkeypatch):
+    monkeypatch.setattr(settings, "dataset_membership", "denormalized")
+    _add_images(mongo, server, [1, 2], 1, BASE_TIME, denormalized=True)
+    sync.start()
+    dataset = server.feature_cache.get(1)
+    assert _alive_ids(dataset) == {1, 2}
+
+    later = BASE_TIME + timedelta(seconds=10)
+    mongo["dataset_files"].update_one({"dataset_id": 1, "workspace_file_id": 1}, {"$set": {"status": 0, "updated_time": later}})
+    mongo["dataset_files"].insert_one({"dataset_id": 2, "workspace_file_id": 2, "status": 1, "created_time": later})
+    sync.sync_once()
+
+    assert _features(mongo).find_one({"workspace_file_id": 1})["dataset_ids"] == []
+    assert sorted(_features(mongo).find_one({"workspace_file_id": 2})["dataset_ids"]) == [1, 2]
+    assert _alive_ids(dataset) == {2}
+    server.feature_cache.invalidate(1)
+    assert _alive_ids(server.feature_cache.get(1)) == {2}
@@ -0,0 +1,56 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from service.shard_store import ShardStore
+
+
+DIM = 4
+
+
+def _features(n, seed=0):
+    features = np.random.default_rng(seed).standard_normal((n, DIM)).astype(np.float32)
+    return features / np.linalg.norm(features, axis=1, keepdims=True)
+
+
+def _append(store, dataset_id, ids, seed=0):
+    features = _features(len(ids), seed)
+    store.append(dataset_id, ids, features, [100] * len(ids), [100] * len(ids), ["jpg"] * len(ids))
+    return features
+
+
+def test_append_after_compact_keeps_compacted_rows(tmp_path):
+    store = ShardStore(str(tmp_path), DIM, shard_rows=2)
+    first = _append(store, 1, [1, 2], seed=1)
+    assert store.compact(1) == 2
+    compacted = [shard["name"] for shard in store.read_manifest(1)["shards"]]
+
+    # 最后一个分片已满, 追加时新建分片, 不能与 compact 输出的分片同名
+    second = _append(store, 1, [3], seed=2)
+    names = [shard["name"] for shard in store.read_manifest(1)["shards"]]
+    assert names[:-1] == compacted
+    assert len(set(names)) == len(names)
+
+    dataset = store.open(1)
+    assert dataset.ids.tolist() == [1, 2, 3]
+    np.testing.assert_allclose(dataset.vectors(), np.concatenate([first, second]), atol=1e-6)
+
+
+def test_repeated_compact_and_append(tmp_path):
+    store = ShardStore(str(tmp_path), DIM, shard_rows=2)
+    for round_ in range(3):
+        _append(store, 1, [round_ * 2 + 1, round_ * 2 + 2], seed=round_)
+        store.compact(1)
+    _append(store, 1, [7], seed=7)
+    assert store.open(1).ids.tolist() == [1, 2, 3, 4, 5, 6, 7]
+
+
+def test_upsert_into_fully_deleted_shards(tmp_path):
+    store = ShardStore(str(tmp_path), DIM, shard_rows=2)
+    _append(store, 1, [1, 2])
+    store.delete(1, [1, 2])
+    dataset = store.open(1)
+    assert len(dataset) == 0
+
+    dataset.upsert(3, _features(1)[0], 10, 20, "png")
+    assert dataset.ids.tolist() == [3]
@@ -0,0 +1,164 @@
+"""
+准入控制与 CPU 密集操作的并发上限
+
+    AdmissionGate    每类接口 (search / import) 同时执行的请求数与排队数上限, 在 event loop 中使用;
+                     排队已满立即拒绝 (429), 排队超时拒绝 (503), 都带 Retry-After
+    PrioritySlots    线程间的有界信号量, 限制同时执行的模型 encode / 常驻矩阵打分, 避免 torch 与
+                     numpy 的线程互相争抢 CPU; 交互检索优先于批量导入获得空闲的 slot
+"""
+import time
+import asyncio
+import threading
+from collections import deque
+from contextlib import contextmanager
+from config.config import settings
+from utils.metrics import metrics
+
+
+INTERACTIVE = 0
+BULK = 1
+
+
+class Overloaded(Exception):
+    def __init__(self, name: str, reason: str):
+        super().__init__(f"{name} is overloaded: {reason}")
+        self.name = name
+        self.reason = reason
+
+
+class AdmissionGate:
+    """
+    最多 max_concurrency 个请求同时执行, 最多 max_queue 个请求按 FIFO 排队等待
+
+    只在 event loop 线程中调用, 不需要加锁; 等待的 future 在第一次 acquire 时才创建, 与具体的 loop 无关.
+    """
+
+    def __init__(self, name: str, max_concurrency: int, max_queue: int, queue_timeout: float):
+        self.name = name
+        self.max_concurrency = max(int(max_concurrency), 1)
+        self.max_queue = max(int(max_queue), 0)
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self._waiters = deque()
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._waiters)
+
+    async def acquire(self):
+        if self.active < self.max_concurrency and not self._waiters:
+            self.active += 1
+            return
+        if len(self._waiters) >= self.max_queue:
+            self._reject("queue_full")
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.append(future)
+        _time_start = time.perf_counter()
+        try:
+            # release() 直接把 slot 交给排在最前面的 future, active 不变
+            await asyncio.wait_for(future, self.queue_timeout)
+        except asyncio.TimeoutError:
+            self._remove(future)
+            self._reject("timeout")
+        except asyncio.CancelledError:
+            # 客户端断开; slot 已经交过来时转交给下一个
+            if not self._remove(future) and future.done() and not future.cancelled():
+                self.release()
+            raise
+        finally:
+            metrics.observe("clip_search_admission_wait_seconds", time.perf_counter() - _time_start,
+                            help="time spent waiting in the admission queue", endpoint=self.name)
+
+    def _remove(self, future) -> bool:
+        try:
+            self._waiters.remove(future)
+            return True
+        except ValueError:
+            return False
+
+    def _reject(self, reason: str):
+        metrics.inc("clip_search_admission_rejected_total", help="requests rejected by admission control",
+                    endpoint=self.name, reason=reason)
+        raise Overloaded(self.name, reason)
+
+    def release(self):
+        while self._waiters:
+            future = self._waiters.popleft()
+            if not future.done():
+                future.set_result(None)
+                return
+        self.active -= 1
+
+
+class AdmissionController:
+    """
+    按接口类别创建 AdmissionGate, 参数读取 config.json 中的 admission-*
+    """
+
+    def __init__(self):
+        self._gates = {}
+        self._lock = threading.Lock()
+        metrics.register_collector("clip_search_admission_in_flight", "gauge",
+                                   lambda: [({"endpoint": name}, gate.active) for name, gate in self.gates()],
+                                   help="requests being served per endpoint class")
+        metrics.register_collector("clip_search_admission_queue_depth", "gauge",
+                                   lambda: [({"endpoint": name}, gate.queue_depth) for name, gate in self.gates()],
+                                   help="requests waiting for admission per endpoint class")
+
+    def gates(self):
+        with self._lock:
+            return list(self._gates.items())
+
+    def gate(self, name: str) -> AdmissionGate:
+        with self._lock:
+            gate = self._gates.get(name)
+            if gate is None:
+                gate = self._gates[name] = AdmissionGate(
+                    name,
+                    getattr(settings, f"admission_{name}_concurrency"),
+                    getattr(settings, f"admission_{name}_queue"),
+                    settings.admission_queue_timeout_ms / 1000.0,
+                )
+            return gate
+
+
+admission = AdmissionController()
+
+
+class PrioritySlots:
+    """
+    线程间的有界信号量; 有 INTERACTIVE 线程在等待时, BULK 线程不会拿到空闲的 slot
+    """
+
+    def __init__(self, name: str, value: int):
+        self.name = name
+        self.value = max(int(value), 1)
+        self.active = 0
+        self.waiting = [0, 0]
+        self._cond = threading.Condition()
+
+    def _blocked(self, priority) -> bool:
+        return self.active >= self.value or any(self.waiting[p] for p in range(priority))
+
+    @contextmanager
+    def slot(self, priority: int = INTERACTIVE):
+        _time_start = time.perf_counter()
+        with self._cond:
+            self.waiting[priority] += 1
+            try:
+                while self._blocked(priority):
+                    self._cond.wait()
+            finally:
+                self.waiting[priority] -= 1
+                # 高优先级的等待者离开队列后, 低优先级的等待者可能可以继续
+                self._cond.notify_all()
+            self.active += 1
+        metrics.observe("clip_search_slot_wait_seconds", time.perf_counter() - _time_start,
+                        help="time spent waiting for an encode / score slot", slot=self.name,
+                        priority="bulk" if priority == BULK else "interactive")
+        try:
+            yield
+        finally:
+            with self._cond:
+                self.active -= 1
+                self._cond.notify_all()
@@ -0,0 +1,59 @@
+import time
+import threading
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    线程安全的 LRU 缓存, 支持容量与 TTL 淘汰, 并统计命中/未命中次数
+
+    ttl <= 0 表示不过期.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 0):
+        self.maxsize = int(maxsize)
+        self.ttl = float(ttl)
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                value, expire_at = item
+                if expire_at is None or expire_at > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        expire_at = time.monotonic() + self.ttl if self.ttl > 0 else None
+        with self._lock:
+            self._data[key] = (value, expire_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total > 0 else 0.0,
+        }
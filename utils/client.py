@@ -1,15 +1,54 @@
+import threading
 from config.config import settings
-from database.mongodb import MongoDB
+from database.mongodb import MongoDB, AsyncMongoDB
 
 class MongoDBClient:
+    """
+    同一个进程内的 collection 共享一个 MongoClient 连接池, 第一次 get_collection 时才连接,
+    由 main.lifespan 在退出时关闭
+    """
+    _mongodb = None
+    _lock = threading.Lock()
+
     def __init__(self, collection, mongodb_url: str=settings.mongodb_url):
-        self.mongodb = MongoDB()
-        self.client = None
+        self.collection = collection
+
+    @classmethod
+    def get_mongodb(cls) -> MongoDB:
+        with cls._lock:
+            if cls._mongodb is None:
+                cls._mongodb = MongoDB()
+            if not cls._mongodb.client:
+                cls._mongodb.connect()
+            return cls._mongodb
+
+    def get_collection(self):
+        return self.get_mongodb().client[settings.mongodb_database][self.collection]
+
+    @classmethod
+    def close(cls):
+        with cls._lock:
+            if cls._mongodb is not None:
+                cls._mongodb.close()
+
+
+class AsyncMongoDBClient:
+    """
+    MongoDBClient 的 motor 版本, 同一个进程内的 async collection 共享一个连接池
+    """
+    _mongodb = None
+
+    def __init__(self, collection):
         self.collection = collection
 
     def get_collection(self):
-        if not self.mongodb.client:
-            self.mongodb.connect()
-        return self.mongodb.client[settings.mongodb_database][self.collection]
-    
-    
\ No newline at end of file
+        if AsyncMongoDBClient._mongodb is None:
+            AsyncMongoDBClient._mongodb = AsyncMongoDB()
+        if not AsyncMongoDBClient._mongodb.client:
+            AsyncMongoDBClient._mongodb.connect()
+        return AsyncMongoDBClient._mongodb.client[settings.mongodb_database][self.collection]
+
+    @classmethod
+    def close(cls):
+        if cls._mongodb is not None:
+            cls._mongodb.close()
@@ -0,0 +1,59 @@
+"""
+导入流水线中在子进程执行的读取 + 解码
+
+只依赖 PIL / numpy, 子进程以 spawn 方式启动时不需要加载 torch 与 CLIP 模型.
+"""
+import io
+import os
+import time
+import numpy as np
+from PIL import Image
+
+# 识别文件类型只需要文件头
+HEADER_SIZE = 12
+
+
+def resize_center_crop(image: Image.Image, n_px: int) -> np.ndarray:
+    """
+    与 CLIP preprocess 中的 Resize(n_px, bicubic) + CenterCrop(n_px) 一致, 返回 (n_px, n_px, 3) uint8
+    """
+    width, height = image.size
+    if width <= height:
+        size = (n_px, int(n_px * height / width))
+    else:
+        size = (int(n_px * width / height), n_px)
+    image = image.resize(size, Image.BICUBIC)
+    left = int(round((size[0] - n_px) / 2.0))
+    top = int(round((size[1] - n_px) / 2.0))
+    return np.asarray(image.crop((left, top, left + n_px, top + n_px)), dtype=np.uint8)
+
+
+def read_and_decode(root_path: str, file_paths: list, n_px: int):
+    """
+    读取 root_path 下的图片并解码为模型输入分辨率的像素
+
+    返回 (pixels, results, elapsed):
+    - pixels: (N_ok, n_px, n_px, 3) uint8, 只包含解码成功的图片
+    - results: 与 file_paths 对齐, 成功时为 (原图 image.size, 文件头), 失败时为 None
+    - elapsed: 本批次耗时 (秒)
+    """
+    _time_start = time.time()
+    pixels = []
+    results = []
+    for file_path in file_paths:
+        try:
+            with open(os.path.join(root_path, file_path), "rb") as f:
+                data = f.read()
+            image = Image.open(io.BytesIO(data))
+            image_size = image.size
+            if image.format == "JPEG":
+                image.draft("RGB", (n_px, n_px))
+            pixels.append(resize_center_crop(image.convert("RGB"), n_px))
+            results.append((image_size, data[:HEADER_SIZE]))
+        except Exception:
+            results.append(None)
+    if pixels:
+        pixels = np.stack(pixels)
+    else:
+        pixels = np.empty((0, n_px, n_px, 3), dtype=np.uint8)
+    return pixels, results, time.time() - _time_start
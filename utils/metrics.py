@@ -0,0 +1,179 @@
+"""
+进程内的延迟 / 计数指标, 以 Prometheus 文本格式输出
+
+    with span("encode"):
+        ...
+
+span 的耗时写入 clip_search_stage_seconds{stage="encode"} (p50 / p95 / p99 为最近
+window 个样本的分位数), 当前请求开启了 Server-Timing 时同时累加到该请求的 timings 中.
+"""
+import time
+import threading
+import contextvars
+from collections import deque
+from contextlib import contextmanager
+
+
+QUANTILES = (0.5, 0.95, 0.99)
+STAGE_SECONDS = "clip_search_stage_seconds"
+
+
+def _label_key(labels: dict):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(labels, extra=None):
+    items = list(labels) + list(extra or [])
+    if not items:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in items) + "}"
+
+
+class _Summary:
+    def __init__(self, window: int):
+        self.samples = deque(maxlen=window)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.samples.append(value)
+        self.count += 1
+        self.sum += value
+
+    def quantiles(self):
+        samples = sorted(self.samples)
+        if not samples:
+            return [(q, 0.0) for q in QUANTILES]
+        return [(q, samples[min(int(q * len(samples)), len(samples) - 1)]) for q in QUANTILES]
+
+
+class Metrics:
+    """
+    线程安全的 summary (分位数) 与 counter 集合, 另外可以注册在输出时才读取的 collector
+    """
+
+    def __init__(self, window: int = 2048):
+        self.window = window
+        self._summaries = {}
+        self._counters = {}
+        self._collectors = {}
+        self._help = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name: str, value: float, help: str = "", **labels):
+        key = _label_key(labels)
+        with self._lock:
+            summary = self._summaries.setdefault(name, {}).get(key)
+            if summary is None:
+                summary = self._summaries[name][key] = _Summary(self.window)
+            summary.observe(float(value))
+            if help:
+                self._help.setdefault(name, help)
+
+    def inc(self, name: str, value: float = 1, help: str = "", **labels):
+        key = _label_key(labels)
+        with self._lock:
+            counters = self._counters.setdefault(name, {})
+            counters[key] = counters.get(key, 0) + value
+            if help:
+                self._help.setdefault(name, help)
+
+    def register_collector(self, name: str, kind: str, collect, help: str = ""):
+        """
+        collect() 返回 [(labels dict, value)], 用于缓存命中数等已经在别处统计的值
+        """
+        with self._lock:
+            self._collectors[name] = (kind, collect)
+            if help:
+                self._help[name] = help
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            summaries = {name: {key: (summary.quantiles(), summary.sum, summary.count) for key, summary in series.items()}
+                         for name, series in self._summaries.items()}
+            counters = {name: dict(series) for name, series in self._counters.items()}
+            collectors = dict(self._collectors)
+            help = dict(self._help)
+
+        for name, series in sorted(summaries.items()):
+            if name in help:
+                lines.append(f"# HELP {name} {help[name]}")
+            lines.append(f"# TYPE {name} summary")
+            for key, (quantiles, total, count) in sorted(series.items()):
+                for q, value in quantiles:
+                    lines.append(f"{name}{_format_labels(key, [('quantile', q)])} {value:.6g}")
+                lines.append(f"{name}_sum{_format_labels(key)} {total:.6g}")
+                lines.append(f"{name}_count{_format_labels(key)} {count}")
+        for name, series in sorted(counters.items()):
+            if name in help:
+                lines.append(f"# HELP {name} {help[name]}")
+            lines.append(f"# TYPE {name} counter")
+            for key, value in sorted(series.items()):
+                lines.append(f"{name}{_format_labels(key)} {value:.6g}")
+        for name, (kind, collect) in sorted(collectors.items()):
+            if name in help:
+                lines.append(f"# HELP {name} {help[name]}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in collect():
+                lines.append(f"{name}{_format_labels(_label_key(labels))} {value:.6g}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+# 当前请求的 Server-Timing, 未开启时为 None
+_timings = contextvars.ContextVar("server_timings", default=None)
+
+
+def start_timing():
+    return _timings.set({})
+
+
+def finish_timing(token) -> dict:
+    timings = _timings.get()
+    _timings.reset(token)
+    return timings or {}
+
+
+def server_timing_header(timings: dict) -> str:
+    """
+    并行执行的阶段 (例如分片打分) 为各线程耗时之和
+    """
+    return ", ".join(f"{stage};dur={seconds * 1000:.2f}" for stage, seconds in timings.items())
+
+
+def observe_stage(stage: str, seconds: float):
+    metrics.observe(STAGE_SECONDS, seconds, help="latency of search / import stages", stage=stage)
+    timings = _timings.get()
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.0) + seconds
+
+
+@contextmanager
+def span(stage: str):
+    _time_start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage, time.perf_counter() - _time_start)
+
+
+def timed_iter(iterable, stage: str):
+    """
+    只统计迭代 (例如 mongo 游标取数据) 本身的耗时, 迭代结束后记录一次
+    """
+    elapsed = 0.0
+    iterator = iter(iterable)
+    try:
+        while True:
+            _time_start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                elapsed += time.perf_counter() - _time_start
+            yield item
+    finally:
+        observe_stage(stage, elapsed)
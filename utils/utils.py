@@ -17,6 +17,10 @@ def calc_md5(filepath):
         return md5.hexdigest()
     
 
+def calc_bytes_md5(data: bytes):
+    return hashlib.md5(data).hexdigest()
+
+
 def get_full_path(basedir, basename):
     md5hash, ext = basename.split(".") 
     return "{}/{}/{}/{}".format(basedir, ext, md5hash[:2], basename)
@@ -45,6 +49,53 @@ def base64_to_image(base64_str: str) -> np.ndarray:
         return None
 
 
+def decode_base64(base64_str: str) -> bytes:
+    """
+    解码base64字符串, 失败时返回 None
+    """
+    try:
+        return base64.b64decode(base64_str)
+    except Exception as e:
+        logger.error(f"Failed to decode base64 string: {e}")
+        return None
+
+
+def bytes_to_image(image_data: bytes) -> Image.Image:
+    """
+    将图片字节数据转换为PIL图像, PIL 只读取文件头, 像素在首次使用时才解码
+    """
+    try:
+        return Image.open(io.BytesIO(image_data))
+    except Exception as e:
+        logger.error(f"Failed to convert bytes to image: {e}")
+        return None
+
+
+def decode_image(image_data: bytes, size: int = 224) -> Image.Image:
+    """
+    解码 query 图片, 失败时返回 None
+
+    JPEG 使用 draft() 在 DCT 阶段直接缩小到不小于 size x size 的分辨率, 不再按原始
+    分辨率解码; 模式只转换一次为 RGB, 之后 preprocess 只需要 resize / crop.
+    draft 会改变 image.size, 导入时需要记录原始宽高, 仍然使用 bytes_to_image.
+    """
+    try:
+        image = Image.open(io.BytesIO(image_data))
+        image_format = image.format
+        if image_format == "JPEG":
+            image.draft("RGB", (size, size))
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        else:
+            image.load()
+        # convert 返回的新图片没有 format, 保留给 image_extension 使用
+        image.format = image_format
+        return image
+    except Exception as e:
+        logger.error(f"Failed to decode image: {e}")
+        return None
+
+
 def image_array_to_pil(image_array: np.ndarray) -> Image.Image:
     """
     将图像数组转换为PIL图像